@@ -0,0 +1,98 @@
+""" Frames/sec through Slack.on_message, old getattr dispatch vs Dispatcher.
+
+    python benchmarks/bench_dispatch.py [frames]
+"""
+import argparse
+import json
+import logging
+import time
+
+from slack_mirror.slack_mirror_script import PublicTranslator, Slack
+
+LOGGER = logging.getLogger('slack_mirror.bench_dispatch')
+
+
+# Roughly what a busy team's RTM stream looks like: mostly noise.
+FRAME_MIX = [
+    ({'type': 'presence_change', 'user': 'U1', 'presence': 'away'}, 40),
+    ({'type': 'user_typing', 'channel': 'C1', 'user': 'U1'}, 25),
+    ({'type': 'pong', 'reply_to': 1}, 10),
+    ({'type': 'reconnect_url', 'url': 'wss://example.com/abc'}, 5),
+    ({'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': 'hi',
+      'ts': '1.0'}, 15),
+    ({'type': 'message', 'subtype': 'channel_join', 'channel': 'C1',
+      'user': 'U1', 'text': 'joined', 'ts': '2.0'}, 5),
+]
+
+
+class NullZulip(object):
+    def send_message(self, msg, callback=None, source_time=None):
+        pass
+
+
+class LegacySlack(Slack):
+    """ The dispatch Slack.on_message used before the Dispatcher. """
+
+    def _dispatch(self, callback_name, msg):
+        callback_name = '__'.join(callback_name)
+        LOGGER.debug('slack dispatch: %r', callback_name)
+        callback = getattr(self.translator, callback_name, None)
+        LOGGER.debug('slack callback: %r', callback)
+        if callback:
+            callback(msg)
+            return True
+        return False
+
+    def on_message(self, ws, raw_msg):
+        msg = json.loads(raw_msg)
+        callback_name = ['slack', msg['type']]
+        subtype = msg.get('subtype')
+        if subtype:
+            callback_name.append(subtype)
+        success = self._dispatch(callback_name, msg)
+        if not success and subtype:
+            callback_name.pop()
+            self._dispatch(callback_name, msg)
+
+
+def make_frames(count):
+    frames = []
+    for frame, weight in FRAME_MIX:
+        frames.extend([json.dumps(frame)] * weight)
+    return (frames * (count // len(frames) + 1))[:count]
+
+
+def make_translator():
+    translator = PublicTranslator()
+    translator.slack_init(
+        [{'id': 'U1', 'name': 'alice', 'profile': {'email': 'a@b.com'}}],
+        [{'id': 'C1', 'name': 'general'}],
+        {'email_domain': 'example.com'},
+    )
+    translator.zulip = NullZulip()
+    return translator
+
+
+def run(slack_cls, frames):
+    slack = slack_cls(make_translator(), None)
+    start = time.time()
+    for frame in frames:
+        slack.on_message(None, frame)
+    return len(frames) / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('frames', nargs='?', type=int, default=200000)
+    args = parser.parse_args()
+    frames = make_frames(args.frames)
+
+    legacy = run(LegacySlack, frames)
+    current = run(Slack, frames)
+    print('legacy:     {:>10.0f} frames/sec'.format(legacy))
+    print('dispatcher: {:>10.0f} frames/sec'.format(current))
+    print('speedup:    {:>10.2f}x'.format(current / legacy))
+
+
+if __name__ == '__main__':
+    main()
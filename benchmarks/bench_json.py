@@ -0,0 +1,41 @@
+""" Decode cost of an RTM frame mix for each available JSON backend, with
+and without the Dispatcher type pre-filter.
+
+    python benchmarks/bench_json.py [frames]
+"""
+import argparse
+import time
+
+from slack_mirror import jsoncodec
+from slack_mirror.dispatch import Dispatcher
+
+from bench_dispatch import make_frames, make_translator
+
+
+def run(loads, frames, wants=None):
+    start = time.time()
+    for frame in frames:
+        if wants is None or wants(frame):
+            loads(frame)
+    return len(frames) / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('frames', nargs='?', type=int, default=200000)
+    args = parser.parse_args()
+    frames = make_frames(args.frames)
+    wants = Dispatcher(make_translator(), 'slack').wants
+
+    for name in jsoncodec.BACKENDS:
+        try:
+            _, loads = jsoncodec.get_loads(name)
+        except ValueError:
+            print('{:<8} not installed'.format(name))
+            continue
+        print('{:<8} {:>10.0f} frames/sec, {:>10.0f} with pre-filter'.format(
+            name, run(loads, frames), run(loads, frames, wants)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+""" End-to-end load test of public and private mirrors against local fakes.
+
+    python benchmarks/bench_load.py [--users 10] [--rate 50] [--duration 20]
+    python benchmarks/bench_load.py --replay traffic.jsonl
+
+The fake Slack, RTM and Zulip servers run in a child process that also
+drives the traffic, so the CPU and memory reported are the mirrors' own.
+Synthetic traffic sends ``--rate`` messages per second in each direction:
+Slack messages from random users in random channels, which the public
+mirror posts to Zulip, and Zulip messages from random users to ``/slack``
+streams, which those users' private mirrors post to Slack.
+
+A replay file has one JSON object per line, either
+``{"offset": 0.5, "side": "slack", "channel": ..., "user": ..., "text": ...}``
+or ``{"offset": 0.5, "side": "zulip", "sender": ..., "stream": ...,
+"content": ...}``. Users and channels are mapped onto the simulated team.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import time
+
+from fakes import FakeRTM, FakeSlack, FakeZulip
+
+from slack_mirror import sessions
+from slack_mirror.ratelimit import SlackScheduler
+from slack_mirror.slack_mirror_script import PooledZulipClient, build_mirror
+
+LOGGER = logging.getLogger('slack_mirror.bench_load')
+
+PUBLIC_EMAIL = 'public@example.com'
+TAG_RE = re.compile(r'\[load (\d+)\]')
+
+
+def make_team(users, channels):
+    slack_users = [{
+        'id': 'UP',
+        'name': 'public',
+        'profile': {'email': PUBLIC_EMAIL},
+    }] + [{
+        'id': 'U%d' % i,
+        'name': 'user%d' % i,
+        'profile': {'email': 'user%d@example.com' % i},
+    } for i in range(users)]
+    slack_channels = [
+        {'id': 'C%d' % i, 'name': 'chan%d' % i} for i in range(channels)]
+    return slack_users, slack_channels
+
+
+def synthetic_traffic(options):
+    rng = random.Random(options.seed)
+    traffic = []
+    for i in range(int(options.rate * options.duration)):
+        offset = float(i) / options.rate
+        user = rng.randrange(options.users)
+        channel = rng.randrange(options.channels)
+        traffic.append((offset, 'slack', user, channel, 'hello %d' % i))
+        traffic.append((offset, 'zulip', user, channel, 'hi there %d' % i))
+    return traffic
+
+
+def replay_traffic(options):
+    users = {}
+    channels = {}
+    traffic = []
+    with open(options.replay) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if event['side'] == 'slack':
+                user, channel, text = (
+                    event['user'], event['channel'], event['text'])
+            else:
+                user, channel, text = (
+                    event['sender'], event['stream'], event['content'])
+            user = users.setdefault(user, len(users) % options.users)
+            channel = channels.setdefault(
+                channel, len(channels) % options.channels)
+            traffic.append((event['offset'], event['side'], user, channel,
+                            text))
+    traffic.sort(key=lambda event: event[0])
+    return traffic
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def collect(sent, received, echoed):
+    """ Matches received texts to sent ones by their ``[load N]`` tag.
+
+    Tags from ``echoed``, the messages sent the other way, are mirrored
+    echoes that dedup should have dropped.
+    """
+    latencies = []
+    duplicates = 0
+    echoes = 0
+    seen = set()
+    last = None
+    for received_at, text in received:
+        for tag in TAG_RE.findall(text):
+            tag = int(tag)
+            if tag in echoed:
+                echoes += 1
+            if tag not in sent:
+                continue
+            if tag in seen:
+                duplicates += 1
+                continue
+            seen.add(tag)
+            latencies.append(received_at - sent[tag])
+            last = received_at if last is None else max(last, received_at)
+    first = min(sent.values()) if sent else None
+    elapsed = (last - first) if last is not None else 0
+    return {
+        'sent': len(sent),
+        'delivered': len(seen),
+        'duplicates': duplicates,
+        'echoes': echoes,
+        'rate': len(seen) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def run_fakes(conn, options, traffic):
+    slack_users, slack_channels = make_team(options.users, options.channels)
+    rtm = FakeRTM().start()
+    slack = FakeSlack(rtm, slack_users, slack_channels).start()
+    zulip = FakeZulip(
+        ['chan%d/slack' % i for i in range(options.channels)]).start()
+    conn.send({'slack': slack.url, 'zulip': zulip.url})
+
+    mirrors = options.users + 1
+    # Shared mirrors of the team all read the same socket.
+    sockets = 1 if options.shared_rtm else mirrors
+    deadline = time.time() + 60
+    while len(rtm.clients) < sockets or len(zulip.queues) < mirrors:
+        if time.time() > deadline:
+            conn.send({'error': 'mirrors did not connect'})
+            return
+        time.sleep(0.1)
+
+    sent = {'slack': {}, 'zulip': {}}
+    cpu_before = os.times()
+    start = time.time()
+    for tag, (offset, side, user, channel, text) in enumerate(traffic):
+        delay = start + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        text = '[load %d] %s' % (tag, text)
+        now = time.time()
+        sent[side][tag] = now
+        if side == 'slack':
+            rtm.broadcast(json.dumps({
+                'type': 'message',
+                'channel': 'C%d' % channel,
+                'user': 'U%d' % user,
+                'text': text,
+                'ts': '%.6f' % now,
+            }))
+        else:
+            zulip.push_message(
+                'user%d@example.com' % user, 'chan%d/slack' % channel, text)
+
+    # Wait for stragglers, but not forever.
+    expected = len(sent['slack']) + len(sent['zulip'])
+    deadline = time.time() + options.drain
+    while time.time() < deadline:
+        if len(zulip.messages) + len(slack.posts) >= expected:
+            break
+        time.sleep(0.1)
+
+    cpu_after = os.times()
+    conn.send({
+        'zulip_events': zulip.delivered,
+        'slack_sockets': len(rtm.clients),
+        'fakes_cpu': (
+            (cpu_after[0] - cpu_before[0]) + (cpu_after[1] - cpu_before[1])
+        ) / (time.time() - start),
+        'slack_to_zulip': collect(
+            sent['slack'],
+            [(t, text) for t, _, text in zulip.messages],
+            sent['zulip'],
+        ),
+        'zulip_to_slack': collect(
+            sent['zulip'],
+            [(t, text) for t, _, text in slack.posts],
+            sent['slack'],
+        ),
+    })
+
+
+class LocalSlackSession(sessions.TokenSession):
+    """ Sends Slack Web API calls to the fake instead of slack.com. """
+
+    def __init__(self, base_url, token):
+        super(LocalSlackSession, self).__init__(params={'token': token})
+        self.base_url = base_url
+
+    def request(self, method, url, **kwargs):
+        url = url.replace('https://slack.com', self.base_url)
+        return super(LocalSlackSession, self).request(method, url, **kwargs)
+
+
+def build_mirrors(options, urls):
+    settings = {
+        'slack.bootstrap': options.bootstrap,
+        'slack.post_rate': str(options.post_rate),
+        'slack.post_burst': str(int(options.post_rate)),
+        'slack.shared_rtm': str(options.shared_rtm).lower(),
+        'mirror.reconnect_base': '0.1',
+        'http.pool_maxsize': str(options.users * 2 + 2),
+    }
+    sessions.configure(settings)
+    scheduler = SlackScheduler.from_settings(settings)
+    mirrors = []
+    accounts = [(PUBLIC_EMAIL, 'UP', True)] + [
+        ('user%d@example.com' % i, 'U%d' % i, False)
+        for i in range(options.users)]
+    # As the daemon does, so every event queue poll has a pooled connection.
+    sessions.expect_long_polls(len(accounts))
+    for email, user_id, public in accounts:
+        mirrors.append(build_mirror(
+            settings,
+            email,
+            'token-' + user_id,
+            'key',
+            public,
+            contained=True,
+            slack_scheduler=scheduler,
+            slack_api=LocalSlackSession(urls['slack'], 'token-' + user_id),
+            zulip_api=PooledZulipClient(
+                email=email,
+                api_key='key',
+                site=urls['zulip'],
+                client='JabberMirror/slack',
+            ),
+        ))
+    return mirrors
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # ru_maxrss is the peak, in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10,
+                        help='private mirrors, besides the public one')
+    parser.add_argument('--channels', type=int, default=5)
+    parser.add_argument('--rate', type=float, default=50,
+                        help='messages per second in each direction')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--drain', type=float, default=30,
+                        help='seconds to wait for late messages')
+    parser.add_argument('--replay', help='JSON lines traffic file')
+    parser.add_argument('--post-rate', type=float, default=1000,
+                        help='slack.post_rate; the default keeps the '
+                             'per-channel limit out of the numbers')
+    parser.add_argument('--bootstrap', default='connect',
+                        choices=['connect', 'start'])
+    parser.add_argument('--shared-rtm', action='store_true',
+                        help='slack.shared_rtm: one RTM socket per team')
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    traffic = replay_traffic(options) if options.replay else \
+        synthetic_traffic(options)
+    conn, child_conn = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(
+        target=run_fakes, args=(child_conn, options, traffic))
+    fakes.daemon = True
+    fakes.start()
+
+    urls = conn.recv()
+    mirrors = build_mirrors(options, urls)
+    rss_before = rss_bytes()
+    cpu_before = os.times()
+    started = time.time()
+    for mirror in mirrors:
+        mirror.start()
+
+    results = conn.recv()
+    wall = time.time() - started
+    cpu_after = os.times()
+    rss_after = rss_bytes()
+    for mirror in mirrors:
+        mirror.stop()
+    fakes.terminate()
+
+    if 'error' in results:
+        raise SystemExit(results['error'])
+    cpu = (cpu_after[0] - cpu_before[0]) + (cpu_after[1] - cpu_before[1])
+    count = len(mirrors)
+    print('mirrors:          {:>10d}'.format(count))
+    for direction in ('slack_to_zulip', 'zulip_to_slack'):
+        stats = results[direction]
+        print('{}:'.format(direction))
+        print('  delivered:      {:>10d} / {}'.format(
+            stats['delivered'], stats['sent']))
+        print('  duplicates:     {:>10d}'.format(stats['duplicates']))
+        print('  echoes:         {:>10d}'.format(stats['echoes']))
+        print('  msgs/sec:       {:>10.1f}'.format(stats['rate']))
+        print('  p50 latency:    {:>10.1f} ms'.format(stats['p50'] * 1000))
+        print('  p99 latency:    {:>10.1f} ms'.format(stats['p99'] * 1000))
+    print('zulip events:     {:>10d}'.format(results['zulip_events']))
+    print('slack sockets:    {:>10d}'.format(results['slack_sockets']))
+    print('cpu:              {:>10.1f}% of a core'.format(100 * cpu / wall))
+    print('cpu per mirror:   {:>10.3f} s'.format(cpu / count))
+    print('rss:              {:>10.1f} MB'.format(rss_after / 2.0 ** 20))
+    print('rss per mirror:   {:>10.1f} MB'.format(
+        (rss_after - rss_before) / 2.0 ** 20 / count))
+    print('fakes cpu:        {:>10.1f}% of a core'.format(
+        100 * results['fakes_cpu']))
+    if results['fakes_cpu'] > 0.8:
+        print('warning: the fakes were close to saturated; lower --rate or '
+              '--users for numbers that reflect the mirrors')
+    sys.stdout.flush()
+    # Skip tearing down the mirrors' daemon threads mid-request.
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
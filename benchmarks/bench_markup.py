@@ -0,0 +1,94 @@
+""" Cost per message of the Slack->Zulip and Zulip->Slack formatters, next
+to the JSON decode of the frame they arrive in for scale.
+
+    python benchmarks/bench_markup.py [messages]
+"""
+import argparse
+import json
+import random
+import time
+
+from slack_mirror import jsoncodec, markup
+from slack_mirror.state import TeamState
+
+USERS = 2000
+CHANNELS = 200
+
+SLACK_TEXTS = [
+    u'hi',
+    u'lunch at noon?',
+    u'<@U{user}> can you take a look at <#C{channel}|chan{channel}>?',
+    u'see <https://example.com/build/{user}|the build> &amp; '
+    u'<https://example.com/logs>',
+    u'*ship it* _today_ ~not~ `a &lt; b` <!here>',
+    u'```\nfor x in xs: print(x)\n```',
+]
+ZULIP_TEXTS = [
+    u'hi',
+    u'lunch at noon?',
+    u'@**user{user}** can you take a look at #**chan{channel}/slack**?',
+    u'see [the build](https://example.com/build/{user}) & '
+    u'https://example.com/logs',
+    u'**ship it** *today* ~~not~~ `a < b` @**all**',
+    u'```\nfor x in xs: print(x)\n```',
+]
+
+
+def make_state():
+    state = TeamState('T1')
+    state.load(
+        [{'id': 'U%d' % i, 'name': 'user%d' % i} for i in range(USERS)],
+        [{'id': 'C%d' % i, 'name': 'chan%d' % i} for i in range(CHANNELS)],
+        {'email_domain': 'example.com'},
+    )
+    return state
+
+
+def make_texts(templates, count, seed=0):
+    rng = random.Random(seed)
+    return [
+        rng.choice(templates).format(
+            # Most mentions are of the few people who talk the most.
+            user=int(rng.paretovariate(1.2)) % USERS,
+            channel=rng.randrange(CHANNELS),
+        )
+        for _ in range(count)
+    ]
+
+
+def run(func, items):
+    start = time.time()
+    for item in items:
+        func(item)
+    return len(items) / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('messages', nargs='?', type=int, default=100000)
+    args = parser.parse_args()
+    state = make_state()
+    slack_texts = make_texts(SLACK_TEXTS, args.messages)
+    zulip_texts = make_texts(ZULIP_TEXTS, args.messages)
+    frames = [
+        json.dumps({'type': 'message', 'channel': 'C1', 'user': 'U1',
+                    'text': text, 'ts': '1.0'})
+        for text in slack_texts
+    ]
+
+    decode = run(jsoncodec.loads, frames)
+    print('json decode      {:>8.2f} us/message'.format(1e6 / decode))
+    for name, func, texts in [
+        ('slack->zulip', lambda t: markup.slack_to_zulip(t, state),
+         slack_texts),
+        ('zulip->slack', lambda t: markup.zulip_to_slack(t, state),
+         zulip_texts),
+    ]:
+        state.mentions.clear()
+        rate = run(func, texts)
+        print('{:<16} {:>8.2f} us/message, {} cached mentions'.format(
+            name, 1e6 / rate, len(state.mentions)))
+
+
+if __name__ == '__main__':
+    main()
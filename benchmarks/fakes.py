@@ -0,0 +1,398 @@
+""" Local stand-ins for the Slack Web API, the Slack RTM websocket and a
+Zulip server, just faithful enough to run mirrors against.
+
+Every message that reaches a fake is recorded with the time it arrived, so
+the load harness can measure mirror latency without either real service.
+"""
+import base64
+import collections
+import hashlib
+import itertools
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+LOGGER = logging.getLogger('slack_mirror.bench.fakes')
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one write; header-by-header writes run into
+    # Nagle and delayed ACKs and add 40ms to every call.
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def _params(self):
+        url = urlparse(self.path)
+        params = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode('utf-8')
+            params.update(
+                (k, v[-1]) for k, v in parse_qs(body).items())
+        return url.path, params
+
+    def _handle(self, method):
+        path, params = self._params()
+        status, ret = self.server.app.handle(method, path, params, self)
+        body = json.dumps(ret).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class FakeHTTP(object):
+    """ Serves ``handle(method, path, params, request)`` on a local port. """
+
+    def start(self):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.app = self
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def _encode_frame(payload, opcode=0x1):
+    header = bytearray([0x80 | opcode])
+    length = len(payload)
+    if length < 126:
+        header.append(length)
+    elif length < 1 << 16:
+        header.append(126)
+        header.extend(struct.pack('>H', length))
+    else:
+        header.append(127)
+        header.extend(struct.pack('>Q', length))
+    return bytes(header) + payload
+
+
+def _recv_exactly(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError()
+        data += chunk
+    return data
+
+
+def _read_frame(conn):
+    first, second = bytearray(_recv_exactly(conn, 2))
+    length = second & 0x7f
+    if length == 126:
+        length, = struct.unpack('>H', _recv_exactly(conn, 2))
+    elif length == 127:
+        length, = struct.unpack('>Q', _recv_exactly(conn, 8))
+    mask = bytearray(_recv_exactly(conn, 4)) if second & 0x80 else None
+    payload = bytearray(_recv_exactly(conn, length))
+    if mask:
+        for i in range(length):
+            payload[i] ^= mask[i % 4]
+    return first & 0x0f, bytes(payload)
+
+
+class FakeRTM(object):
+    """ A websocket server that broadcasts text frames to every client. """
+
+    def __init__(self):
+        self.clients = []
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(128)
+        self.url = 'ws://127.0.0.1:%d/' % self.sock.getsockname()[1]
+
+    def start(self):
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def _accept(self):
+        while True:
+            conn, _ = self.sock.accept()
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _handshake(self, conn):
+        request = b''
+        while b'\r\n\r\n' not in request:
+            chunk = conn.recv(4096)
+            if not chunk:
+                raise EOFError()
+            request += chunk
+        key = None
+        for line in request.decode('latin-1').split('\r\n'):
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'sec-websocket-key':
+                key = value.strip()
+        accept = base64.b64encode(
+            hashlib.sha1((key + WS_GUID).encode('ascii')).digest())
+        conn.sendall(
+            b'HTTP/1.1 101 Switching Protocols\r\n'
+            b'Upgrade: websocket\r\n'
+            b'Connection: Upgrade\r\n'
+            b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+
+    def _serve(self, conn):
+        client = (conn, threading.Lock())
+        try:
+            self._handshake(conn)
+            with self.lock:
+                self.clients.append(client)
+            while True:
+                opcode, payload = _read_frame(conn)
+                if opcode == 0x9:
+                    with client[1]:
+                        conn.sendall(_encode_frame(payload, 0xA))
+                elif opcode == 0x8:
+                    break
+        except (EOFError, socket.error):
+            pass
+        finally:
+            with self.lock:
+                if client in self.clients:
+                    self.clients.remove(client)
+            conn.close()
+
+    def broadcast(self, text):
+        frame = _encode_frame(text.encode('utf-8'))
+        with self.lock:
+            clients = list(self.clients)
+        for conn, lock in clients:
+            try:
+                with lock:
+                    conn.sendall(frame)
+            except socket.error:
+                pass
+
+
+class FakeSlack(FakeHTTP):
+    """ The Web API methods a mirror calls, for one team.
+
+    Posted messages are echoed back over the RTM socket the way Slack does,
+    so the mirrors' echo suppression is exercised too.
+    """
+
+    def __init__(self, rtm, users, channels):
+        self.rtm = rtm
+        self.users = users
+        self.channels = channels
+        self.tokens = dict(
+            ('token-' + user['id'], user['id']) for user in users)
+        self.posts = []
+        self.lock = threading.Lock()
+        self.ts = itertools.count(1)
+
+    def team(self):
+        return {'id': 'T1', 'email_domain': 'example.com'}
+
+    def handle(self, method, path, params, request):
+        name = path.rsplit('/', 1)[-1]
+        handler = getattr(self, 'api_' + name.replace('.', '_'), None)
+        if handler is None:
+            return 404, {'ok': False, 'error': 'unknown_method'}
+        return 200, dict(handler(params), ok=True)
+
+    def api_rtm_connect(self, params):
+        return {'url': self.rtm.url, 'team': self.team()}
+
+    def api_rtm_start(self, params):
+        return {
+            'url': self.rtm.url,
+            'team': self.team(),
+            'users': self.users,
+            'channels': self.channels,
+        }
+
+    def api_auth_test(self, params):
+        return {'team_id': 'T1', 'user_id': self.tokens.get(params['token'])}
+
+    def api_team_info(self, params):
+        return {'team': self.team()}
+
+    def api_users_list(self, params):
+        return {'members': self.users}
+
+    def api_channels_list(self, params):
+        return {'channels': self.channels}
+
+    def api_users_info(self, params):
+        return {'user': [u for u in self.users if u['id'] == params['user']][0]}
+
+    def api_channels_info(self, params):
+        return {'channel': [
+            c for c in self.channels if c['id'] == params['channel']][0]}
+
+    def api_channels_history(self, params):
+        return {'messages': [], 'has_more': False}
+
+    def api_channels_join(self, params):
+        return {}
+
+    def api_channels_leave(self, params):
+        return {}
+
+    def api_chat_postMessage(self, params):
+        received = time.time()
+        ts = '%d.%06d' % (received, next(self.ts) % 1000000)
+        with self.lock:
+            self.posts.append((received, params['channel'], params['text']))
+        self.rtm.broadcast(json.dumps({
+            'type': 'message',
+            'channel': params['channel'],
+            'user': self.tokens.get(params.get('token')),
+            'text': params['text'],
+            'ts': ts,
+        }))
+        return {'channel': params['channel'], 'ts': ts}
+
+
+class FakeZulip(FakeHTTP):
+    """ Event queues and message sending for any number of users.
+
+    Queues honour the ``event_types`` they were registered with and
+    ``sender`` and ``stream`` narrows, like the real server.
+    """
+
+    def __init__(self, streams):
+        self.streams = streams
+        self.queues = {}
+        self.filters = {}
+        self.delivered = 0
+        self.messages = []
+        self.cond = threading.Condition()
+        self.queue_ids = itertools.count(1)
+        self.event_ids = itertools.count(0)
+        self.message_ids = itertools.count(1)
+
+    def _user(self, request):
+        auth = request.headers.get('Authorization', '')
+        if not auth.startswith('Basic '):
+            return None
+        decoded = base64.b64decode(auth[len('Basic '):]).decode('utf-8')
+        return decoded.split(':', 1)[0]
+
+    def handle(self, method, path, params, request):
+        path = path[len('/api/v1/'):]
+        if path == 'register':
+            event_types = params.get('event_types')
+            with self.cond:
+                queue_id = 'q%d' % next(self.queue_ids)
+                self.queues[queue_id] = collections.deque()
+                self.filters[queue_id] = (
+                    json.loads(event_types) if event_types else None,
+                    json.loads(params.get('narrow') or '[]'),
+                )
+            return 200, {
+                'result': 'success',
+                'queue_id': queue_id,
+                'last_event_id': -1,
+                'max_message_id': 0,
+            }
+        if path == 'events':
+            return 200, self.get_events(
+                params['queue_id'], int(params['last_event_id']))
+        if path == 'messages' and method == 'POST':
+            received = time.time()
+            with self.cond:
+                self.messages.append((received, params['to'], params['content']))
+                message_id = next(self.message_ids)
+            return 200, {'result': 'success', 'id': message_id}
+        if path == 'messages':
+            return 200, {'result': 'success', 'messages': []}
+        if path == 'users/me/subscriptions':
+            return 200, {
+                'result': 'success',
+                'subscriptions': [{'name': s} for s in self.streams],
+            }
+        return 404, {'result': 'error', 'msg': 'unknown endpoint ' + path}
+
+    def start(self):
+        super(FakeZulip, self).start()
+        thread = threading.Thread(target=self._tick)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def _tick(self):
+        # Python 2's Condition.wait(timeout) polls in sleeps of up to 50ms,
+        # which would show up as latency; wake long polls from here instead.
+        while True:
+            time.sleep(0.5)
+            with self.cond:
+                self.cond.notify_all()
+
+    def get_events(self, queue_id, last_event_id, timeout=1.0):
+        deadline = time.time() + timeout
+        with self.cond:
+            queue = self.queues.get(queue_id)
+            if queue is None:
+                return {'result': 'error', 'code': 'BAD_EVENT_QUEUE_ID'}
+            while queue and queue[0]['id'] <= last_event_id:
+                queue.popleft()
+            while not queue and time.time() < deadline:
+                self.cond.wait()
+            return {'result': 'success', 'events': list(queue)}
+
+    def push_message(self, sender_email, stream, content):
+        """ Delivers a stream message to every registered queue. """
+        with self.cond:
+            event = {
+                'type': 'message',
+                'id': next(self.event_ids),
+                'message': {
+                    'id': next(self.message_ids),
+                    'sender_email': sender_email,
+                    'client': 'website',
+                    'display_recipient': stream,
+                    'content': content,
+                    'timestamp': time.time(),
+                },
+            }
+            fields = {'sender': sender_email, 'stream': stream}
+            for queue_id, queue in self.queues.items():
+                event_types, narrow = self.filters[queue_id]
+                if event_types is not None and 'message' not in event_types:
+                    continue
+                if any(fields.get(op) != operand for op, operand in narrow):
+                    continue
+                queue.append(event)
+                self.delivered += 1
+            self.cond.notify_all()
@@ -0,0 +1,32 @@
+"""thread topic
+
+Revision ID: 5c1e2b7f9a3d
+Revises: 432447eda104
+Create Date: 2026-10-17 10:12:41.503217
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c1e2b7f9a3d'
+down_revision = '432447eda104'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('thread_topic',
+    sa.Column('channel_id', sa.Text(), nullable=False),
+    sa.Column('thread_ts', sa.Text(), nullable=False),
+    sa.Column('stream', sa.UnicodeText(), nullable=False),
+    sa.Column('topic', sa.UnicodeText(), nullable=False),
+    sa.Column('created', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('channel_id', 'thread_ts')
+    )
+    op.create_index('ix_thread_topic_stream_topic', 'thread_topic',
+                    ['stream', 'topic'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_thread_topic_stream_topic', table_name='thread_topic')
+    op.drop_table('thread_topic')
@@ -0,0 +1,23 @@
+"""user enabled
+
+Revision ID: 8d3f6a2c41e7
+Revises: 5c1e2b7f9a3d
+Create Date: 2026-10-17 16:40:12.918304
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d3f6a2c41e7'
+down_revision = '5c1e2b7f9a3d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('site_user', sa.Column(
+        'enabled', sa.Boolean(), nullable=False, server_default=sa.true()))
+
+
+def downgrade():
+    op.drop_column('site_user', 'enabled')
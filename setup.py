@@ -26,6 +26,7 @@ setup(name='slack_mirror',
       include_package_data=True,
       zip_safe=False,
       install_requires=requires,
+      extras_require={'gevent': ['gevent']},
       tests_require=requires,
       test_suite="slack_mirror",
       entry_points = """\
@@ -8,12 +8,20 @@ from pyramid.security import Allow, Authenticated
 
 
 class RootFactory(object):
-    __acl__ = [(Allow, Authenticated, 'loggedin')]
+    __acl__ = [
+        (Allow, Authenticated, 'loggedin'),
+        (Allow, 'group:admin', 'admin'),
+    ]
 
     def __init__(self, request):
         pass
 
 
+def groupfinder(userid, request):
+    admins = request.registry.settings.get('admin.users', '').split()
+    return ['group:admin'] if userid in admins else []
+
+
 def get_sessionmaker(settings):
     engine = engine_from_config(settings, 'sqlalchemy.')
     return sessionmaker(bind=engine, extension=ZopeTransactionExtension())
@@ -41,7 +49,8 @@ def main(global_config, **settings):
     config.add_translation_dirs('locale/')
     config.include('pyramid_jinja2')
 
-    authn_policy = AuthTktAuthenticationPolicy(settings['tkt_secret'])
+    authn_policy = AuthTktAuthenticationPolicy(
+        settings['tkt_secret'], callback=groupfinder)
     config.set_authentication_policy(authn_policy)
 
     authz_policy = ACLAuthorizationPolicy()
@@ -56,5 +65,8 @@ def main(global_config, **settings):
     config.add_route('oauth2_callback', '/oauth2callback')
     config.add_route('start_mirror', '/start_mirror')
     config.add_route('stop_mirror', '/stop_mirror')
+    config.add_route('bot_log', '/log/{stream}')
+    config.add_route('metrics', '/metrics')
+    config.add_route('admin_dump', '/admin/{name}/{kind}')
     config.scan()
     return config.make_wsgi_app()
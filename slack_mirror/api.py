@@ -1,8 +1,19 @@
+import logging
+import threading
+import time
+
 import supervisor.xmlrpc
+import transaction
 import xmlrpclib
+from pyramid.settings import asbool
 
 
-def get_proxy(settings):
+LOGGER = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def make_proxy(settings):
     return xmlrpclib.ServerProxy(
         'http://127.0.0.1',
         transport=supervisor.xmlrpc.SupervisorTransport(
@@ -13,6 +24,19 @@ def get_proxy(settings):
     )
 
 
+def get_proxy(settings):
+    # ServerProxy is not thread safe, so keep one per thread. Its transport
+    # keeps the supervisor socket open between requests.
+    proxies = getattr(_local, 'proxies', None)
+    if proxies is None:
+        proxies = _local.proxies = {}
+    sock_path = settings['supervisor.sock_path']
+    proxy = proxies.get(sock_path)
+    if proxy is None:
+        proxy = proxies[sock_path] = make_proxy(settings)
+    return proxy
+
+
 def reload_config(settings):
     proxy = get_proxy(settings)
     changes = proxy.supervisor.reloadConfig()
@@ -20,28 +44,258 @@ def reload_config(settings):
         proxy.supervisor.addProcessGroup(process_name)
 
 
+class ConfigReloader(object):
+    """ Folds the reloads asked for within ``delay`` seconds into one.
+
+    A burst of signups then costs supervisord a single ``reloadConfig``
+    instead of one each. A request made while a reload is running gets a
+    reload of its own, since its config may have been written too late
+    for the running one.
+    """
+
+    def __init__(self, settings, delay=2.0, reload=reload_config):
+        self.settings = settings
+        self.delay = delay
+        self.reload = reload
+        self.pending = False
+        self.lock = threading.Lock()
+
+    def request(self):
+        with self.lock:
+            if self.pending:
+                return
+            self.pending = True
+        timer = threading.Timer(self.delay, self._run)
+        timer.daemon = True
+        timer.start()
+
+    def _run(self):
+        with self.lock:
+            self.pending = False
+        try:
+            self.reload(self.settings)
+        except Exception:
+            LOGGER.exception('Failed to reload supervisor config')
+
+
+_reloaders = {}
+_reloaders_lock = threading.Lock()
+
+
+def request_reload(settings):
+    sock_path = settings['supervisor.sock_path']
+    with _reloaders_lock:
+        reloader = _reloaders.get(sock_path)
+        if reloader is None:
+            reloader = _reloaders[sock_path] = ConfigReloader(
+                settings,
+                delay=float(settings.get('supervisor.reload_delay', 2)),
+            )
+    reloader.request()
+
+
+class LogTail(object):
+    """ The last ``size`` bytes of one process log.
+
+    Each update only asks supervisor for what was written since the last
+    one, using the offset it returned.
+    """
+
+    def __init__(self, size=5000):
+        self.size = size
+        self.data = ''
+        self.offset = 0
+        self.lock = threading.Lock()
+
+    def update(self, tail):
+        """ ``tail(offset, length)`` is one of supervisor's
+        ``tailProcess*Log`` calls, returning ``[data, offset, overflow]``. """
+        with self.lock:
+            data, offset, overflow = tail(self.offset, self.size)
+            if overflow or offset < self.offset:
+                # Too much to catch up on, or the log was rotated.
+                self.data = data[-self.size:]
+            else:
+                self.data = (self.data + data)[-self.size:]
+            self.offset = offset
+            return self.data, self.offset
+
+    def since(self, tail, offset=None):
+        """ What was written after ``offset``, or the whole tail. """
+        data, end = self.update(tail)
+        if offset is not None and end - len(data) <= offset <= end:
+            data = data[len(data) - (end - offset):]
+        return data, end
+
+
+class BotStateCache(object):
+    """ Every bot's process info from a single ``getAllProcessInfo`` call.
+
+    Readers always get the last snapshot straight away. Once it is older
+    than ``ttl`` the next reader starts a refresh in the background, so
+    supervisord sees at most one poll per ``ttl`` however many dashboards
+    are open. Only the very first read waits, for up to ``first_wait``.
+    """
+
+    def __init__(self, settings, ttl=2.0, first_wait=1.0, clock=time.time,
+                 proxy=None):
+        self.settings = settings
+        self.ttl = ttl
+        self.first_wait = first_wait
+        self.clock = clock
+        self.proxy = proxy
+        self.processes = None
+        self.updated = None
+        self.refreshing = False
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.logs = {}
+
+    def refresh(self):
+        processes = None
+        try:
+            if self.proxy is None:
+                # Only one refresh runs at a time, so it can own a proxy.
+                self.proxy = make_proxy(self.settings)
+            processes = dict(
+                (info['name'], info)
+                for info in self.proxy.supervisor.getAllProcessInfo()
+            )
+        except Exception:
+            LOGGER.exception('Failed to poll supervisor')
+        with self.lock:
+            if processes is not None:
+                self.processes = processes
+                self.updated = self.clock()
+            self.refreshing = False
+        self.ready.set()
+
+    def snapshot(self):
+        with self.lock:
+            stale = (
+                self.updated is None or
+                self.clock() - self.updated >= self.ttl
+            )
+            if stale and not self.refreshing:
+                self.refreshing = True
+                thread = threading.Thread(
+                    name='supervisor_poll', target=self.refresh)
+                thread.daemon = True
+                thread.start()
+            processes = self.processes
+        if processes is None:
+            self.ready.wait(self.first_wait)
+            with self.lock:
+                processes = self.processes
+        return processes or {}
+
+    def invalidate(self):
+        with self.lock:
+            self.updated = None
+
+    def get(self, name):
+        info = self.snapshot().get(name)
+        if info is None:
+            return {'state': 'Unknown', 'uptime': 'Unknown'}
+        return {'state': info['statename'], 'uptime': info['description']}
+
+    def tail(self, name, stream, offset=None):
+        with self.lock:
+            log = self.logs.get((name, stream))
+            if log is None:
+                log = self.logs[(name, stream)] = LogTail()
+        method = getattr(
+            get_proxy(self.settings).supervisor,
+            'tailProcess{}Log'.format(stream.capitalize()),
+        )
+        return log.since(lambda o, l: method(name, o, l), offset)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_bot_state_cache(settings):
+    sock_path = settings['supervisor.sock_path']
+    with _caches_lock:
+        cache = _caches.get(sock_path)
+        if cache is None:
+            cache = _caches[sock_path] = BotStateCache(
+                settings,
+                ttl=float(settings.get('supervisor.state_ttl', 2)),
+            )
+        return cache
+
+
+def daemon_mode(settings):
+    """ Whether every mirror runs in ``slack_mirror.daemon`` instead of a
+    supervisor program per user. """
+    return asbool(settings.get('mirror.daemon', False))
+
+
+def daemon_program(settings):
+    return settings.get('mirror.daemon_program', 'mirrors')
+
+
+def reload_daemon(settings):
+    """ Has the daemon read the user table once the current transaction
+    commits, rather than at its next poll. """
+    def hook(committed):
+        if not committed:
+            return
+        try:
+            signal_bot(settings, daemon_program(settings), 'HUP')
+        except Exception:
+            # It still sees the change at its next poll.
+            LOGGER.exception('Failed to signal the mirror daemon')
+    transaction.get().addAfterCommitHook(hook)
+
+
 def get_bot_state(settings, user):
-    proxy = get_proxy(settings)
-    try:
-        state = proxy.supervisor.getProcessInfo(user.email)
-        stdout = proxy.supervisor.tailProcessStdoutLog(user.email, 0, 5000)
-        stderr = proxy.supervisor.tailProcessStderrLog(user.email, 0, 5000)
-    except:
-        raise
-        return {'state': 'Unknown', 'uptime': 'Unknown'}
-    return {
-        'state': state['statename'],
-        'uptime': state['description'],
-        'stdout': stdout[0],
-        'stderr': stderr[0],
-    }
+    if daemon_mode(settings):
+        if not user.enabled:
+            return {'state': 'STOPPED', 'uptime': 'Not running'}
+        return get_bot_state_cache(settings).get(daemon_program(settings))
+    return get_bot_state_cache(settings).get(user.email)
+
+
+def get_bot_log(settings, user, stream, offset=None):
+    if daemon_mode(settings):
+        # The daemon's log is every user's, so it is not shown.
+        return {'data': '', 'offset': 0}
+    data, offset = get_bot_state_cache(settings).tail(
+        user.email, stream, offset)
+    return {'data': data, 'offset': offset}
 
 
 def start_bot(settings, user):
+    if daemon_mode(settings):
+        user.enabled = True
+        reload_daemon(settings)
+        return
     proxy = get_proxy(settings)
     proxy.supervisor.startProcess(user.email)
+    get_bot_state_cache(settings).invalidate()
+
+
+def signal_bot(settings, name, signal):
+    """ Sends ``signal``, named as in ``USR1``, to a process. """
+    get_proxy(settings).supervisor.signalProcess(name, signal)
+
+
+def get_pid(settings, name):
+    """ A running process's pid, or None. """
+    info = get_bot_state_cache(settings).snapshot().get(name)
+    if info is None or not info.get('pid'):
+        return None
+    return info['pid']
 
 
 def stop_bot(settings, user):
+    if daemon_mode(settings):
+        user.enabled = False
+        reload_daemon(settings)
+        return
     proxy = get_proxy(settings)
     proxy.supervisor.stopProcess(user.email)
+    get_bot_state_cache(settings).invalidate()
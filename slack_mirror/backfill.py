@@ -0,0 +1,88 @@
+import logging
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from slack_mirror.outbox import NullOutbox
+
+LOGGER = logging.getLogger(__name__)
+
+
+def ts_key(ts):
+    """ Orders Slack ``ts`` strings without float rounding. """
+    seconds, _, fraction = ts.partition('.')
+    return int(seconds), int(fraction or 0)
+
+
+class Watermarks(object):
+    """ The newest message mirrored per channel, per source.
+
+    Slack marks are ``ts`` strings per channel id; Zulip marks are message
+    ids. Marks only move forward and are written through to the outbox so
+    they survive restarts.
+    """
+
+    KEYS = {
+        'slack': ts_key,
+        'zulip': int,
+    }
+
+    def __init__(self, outbox=None):
+        self.outbox = outbox or NullOutbox()
+        self.marks = {}
+        self.lock = threading.Lock()
+
+    def load(self, source):
+        marks = self.outbox.get_watermarks(source)
+        with self.lock:
+            self.marks[source] = marks
+        return dict(marks)
+
+    def get(self, source):
+        with self.lock:
+            marks = self.marks.get(source)
+        if marks is None:
+            return self.load(source)
+        return dict(marks)
+
+    def advance(self, source, key, mark):
+        mark = str(mark)
+        sort_key = self.KEYS[source]
+        with self.lock:
+            marks = self.marks.setdefault(source, {})
+            old = marks.get(key)
+            if old is not None and sort_key(old) >= sort_key(mark):
+                return
+            marks[key] = mark
+        self.outbox.set_watermark(source, key, mark)
+
+
+def run_limited(func, items, concurrency):
+    """ Calls ``func(item)`` for every item on at most ``concurrency``
+    threads and waits for all of them. """
+    work = queue.Queue()
+    for item in items:
+        work.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                func(item)
+            except Exception:
+                LOGGER.exception('Backfill of %r failed', item)
+
+    threads = []
+    for i in range(min(concurrency, work.qsize())):
+        thread = threading.Thread(name='backfill', target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
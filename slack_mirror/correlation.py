@@ -0,0 +1,212 @@
+""" Which Zulip message each mirrored Slack message became, and back.
+
+Edits and deletes are propagated by looking up the copy of the changed
+message here. Each mirror only records the pairs it posted the copy of, so
+a change is never propagated back to the side it came from.
+"""
+import array
+import collections
+import logging
+import sqlite3
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS correlation (
+    mirror TEXT NOT NULL,
+    zulip_id INTEGER NOT NULL,
+    slack TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (mirror, zulip_id)
+)
+"""
+
+SLACK_INDEX = """
+CREATE INDEX IF NOT EXISTS correlation_slack ON correlation (mirror, slack)
+"""
+
+
+def _slack_key(channel_id, ts):
+    # One string per message rather than a tuple of two.
+    return '{} {}'.format(channel_id, ts)
+
+
+class Spill(object):
+    """ Pairs that aged out of memory, in SQLite, for ``max_age`` seconds. """
+
+    def __init__(self, path, max_age=30 * 86400):
+        self.path = path
+        self.max_age = max_age
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(SCHEMA)
+            conn.execute(SLACK_INDEX)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def write(self, mirror, pairs, now):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO correlation '
+                    '(mirror, zulip_id, slack, created) VALUES (?, ?, ?, ?)',
+                    [(mirror,) + pair for pair in pairs],
+                )
+                conn.execute(
+                    'DELETE FROM correlation WHERE created < ?',
+                    (now - self.max_age,),
+                )
+        finally:
+            conn.close()
+
+    def _select(self, query, params):
+        conn = self._connect()
+        try:
+            row = conn.execute(query, params).fetchone()
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    def zulip_id(self, mirror, slack):
+        return self._select(
+            'SELECT zulip_id FROM correlation WHERE mirror = ? AND slack = ?',
+            (mirror, slack),
+        )
+
+    def slack(self, mirror, zulip_id):
+        return self._select(
+            'SELECT slack FROM correlation WHERE mirror = ? AND zulip_id = ?',
+            (mirror, zulip_id),
+        )
+
+    def forget(self, mirror, zulip_id):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    'DELETE FROM correlation '
+                    'WHERE mirror = ? AND zulip_id = ?',
+                    (mirror, zulip_id),
+                )
+        finally:
+            conn.close()
+
+
+class CorrelationIndex(object):
+    """ One mirror's Slack ``(channel, ts)`` and Zulip id pairs.
+
+    Pairs are kept in memory as two dicts, indexed by time in per-minute
+    buckets of Zulip ids. Once there are more than ``maxsize`` pairs, or a
+    bucket is older than ``max_age``, the oldest bucket is dropped whole,
+    into ``spill`` if there is one. Lookups that miss memory go on to the
+    spill.
+    """
+
+    BUCKET = 60
+
+    def __init__(self, mirror=None, maxsize=50000, max_age=86400,
+                 spill=None, clock=time.time):
+        self.mirror = mirror
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.spill = spill
+        self.clock = clock
+        self.by_zulip = {}
+        self.by_slack = {}
+        self.buckets = collections.deque()
+        self.lock = threading.Lock()
+
+    def add(self, channel_id, ts, zulip_id):
+        now = self.clock()
+        key = _slack_key(channel_id, ts)
+        with self.lock:
+            start = now - now % self.BUCKET
+            if not self.buckets or self.buckets[-1][0] != start:
+                self.buckets.append((start, array.array('l')))
+            self.buckets[-1][1].append(zulip_id)
+            self.by_zulip[zulip_id] = key
+            self.by_slack[key] = zulip_id
+            expired = self._expire(now)
+        if expired and self.spill is not None:
+            try:
+                self.spill.write(self.mirror, expired, now)
+            except sqlite3.Error:
+                LOGGER.exception('Failed to spill %d pairs', len(expired))
+
+    def _expire(self, now):
+        expired = []
+        while self.buckets and (
+                len(self.by_zulip) > self.maxsize or
+                self.buckets[0][0] < now - self.max_age):
+            start, zulip_ids = self.buckets.popleft()
+            for zulip_id in zulip_ids:
+                key = self.by_zulip.pop(zulip_id, None)
+                if key is None:
+                    continue  # Already forgotten.
+                self.by_slack.pop(key, None)
+                expired.append((zulip_id, key, start))
+        return expired
+
+    def zulip_id(self, channel_id, ts):
+        key = _slack_key(channel_id, ts)
+        zulip_id = self.by_slack.get(key)
+        if zulip_id is None and self.spill is not None:
+            zulip_id = self.spill.zulip_id(self.mirror, key)
+        return zulip_id
+
+    def slack(self, zulip_id):
+        """ The ``(channel_id, ts)`` paired with a Zulip id, or None. """
+        key = self.by_zulip.get(zulip_id)
+        if key is None and self.spill is not None:
+            key = self.spill.slack(self.mirror, zulip_id)
+        if key is None:
+            return None
+        return tuple(key.split(' ', 1))
+
+    def forget(self, zulip_id):
+        with self.lock:
+            key = self.by_zulip.pop(zulip_id, None)
+            if key is not None:
+                self.by_slack.pop(key, None)
+        if key is None and self.spill is not None:
+            self.spill.forget(self.mirror, zulip_id)
+
+    def __len__(self):
+        return len(self.by_zulip)
+
+
+_spill = None
+_spill_lock = threading.Lock()
+
+
+def get_correlation_index(settings, mirror):
+    """ A mirror's index; the spill file, if any, is shared. """
+    global _spill
+    path = settings.get('mirror.correlation_spill_path')
+    spill = None
+    if path:
+        with _spill_lock:
+            if _spill is None:
+                _spill = Spill(
+                    path,
+                    float(settings.get(
+                        'mirror.correlation_spill_max_age', 30 * 86400)),
+                )
+            spill = _spill
+    return CorrelationIndex(
+        mirror,
+        maxsize=int(settings.get('mirror.correlation_size', 50000)),
+        max_age=float(settings.get('mirror.correlation_max_age', 86400)),
+        spill=spill,
+    )
@@ -0,0 +1,146 @@
+import argparse
+import collections
+import logging
+import signal
+import threading
+import time
+
+import pyramid.paster
+import transaction
+
+import slack_mirror
+from slack_mirror import jsoncodec, sessions, tracing
+from slack_mirror.metrics import start_exporter
+from slack_mirror.models import User
+from slack_mirror.ratelimit import SlackScheduler
+from slack_mirror.slack_mirror_script import build_mirror
+
+LOGGER = logging.getLogger('slack_mirror.daemon')
+
+
+MirrorConfig = collections.namedtuple(
+    'MirrorConfig',
+    ['email', 'access_token', 'zulip_key', 'public'],
+)
+
+
+class MirrorDaemon(object):
+    """ Runs the mirrors for every enabled user with a zulip key in one
+    process.
+
+    The user table is polled every ``mirror.poll_interval`` seconds (or on
+    SIGHUP) and mirrors are started, stopped or restarted to match it.
+    """
+
+    def __init__(self, settings, sessionmaker):
+        self.settings = settings
+        self.sessionmaker = sessionmaker
+        self.public_email = settings.get('mirror.public_email')
+        self.poll_interval = float(settings.get('mirror.poll_interval', 30))
+        self.start_rate = float(settings.get('mirror.start_rate', 10))
+        self.slack_scheduler = SlackScheduler.from_settings(settings)
+        self.mirrors = {}
+        self.configs = {}
+        self.wakeup = threading.Event()
+        self.stopped = False
+
+    def load_configs(self):
+        db = self.sessionmaker()
+        configs = {}
+        with transaction.manager:
+            users = db.query(
+                User.email, User.access_token, User.zulip_key,
+            ).filter(User.zulip_key != None, User.enabled == True)
+            for email, access_token, zulip_key in users:
+                configs[email] = MirrorConfig(
+                    email,
+                    access_token,
+                    zulip_key,
+                    email == self.public_email,
+                )
+        return configs
+
+    def add_mirror(self, config):
+        mirror = build_mirror(
+            self.settings,
+            config.email,
+            config.access_token,
+            config.zulip_key,
+            config.public,
+            contained=True,
+            slack_scheduler=self.slack_scheduler,
+        )
+        self.mirrors[config.email] = mirror
+        self.configs[config.email] = config
+        mirror.start()
+
+    def remove_mirror(self, email):
+        mirror = self.mirrors.pop(email)
+        del self.configs[email]
+        mirror.stop()
+        LOGGER.info('Stopped mirror for %r', email)
+
+    def reconcile(self):
+        configs = self.load_configs()
+        # Every mirror keeps a zulip event queue poll open.
+        sessions.expect_long_polls(len(configs))
+
+        for email in list(self.mirrors):
+            if configs.get(email) != self.configs[email]:
+                self.remove_mirror(email)
+            elif not self.mirrors[email].alive:
+                LOGGER.info('Restarting dead mirror for %r', email)
+                self.remove_mirror(email)
+
+        # Spread out starts so a restart does not open every Slack and
+        # Zulip connection in the same second.
+        for email, config in configs.items():
+            if self.stopped:
+                return
+            if email not in self.mirrors:
+                self.add_mirror(config)
+                time.sleep(1.0 / self.start_rate)
+
+    def reload(self, *args):
+        self.wakeup.set()
+
+    def run_forever(self):
+        while not self.stopped:
+            try:
+                self.reconcile()
+            except Exception:
+                LOGGER.exception('Failed to reconcile mirrors')
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        for email in list(self.mirrors):
+            self.remove_mirror(email)
+
+
+def main(config_uri):
+    pyramid.paster.setup_logging(config_uri)
+    settings = pyramid.paster.get_appsettings(config_uri)
+    sessions.configure(settings)
+    jsoncodec.configure(settings)
+    tracing.configure(settings)
+    start_exporter(settings)
+    sessionmaker = slack_mirror.get_sessionmaker(settings)
+
+    # Each mirror is two mostly idle I/O threads; the default 8MB stacks are
+    # what made one process per user so expensive.
+    threading.stack_size(
+        int(settings.get('mirror.thread_stack_size', 512 * 1024)))
+
+    daemon = MirrorDaemon(settings, sessionmaker)
+    signal.signal(signal.SIGHUP, daemon.reload)
+    daemon.run_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_uri')
+    args = parser.parse_args()
+    main(args.config_uri)
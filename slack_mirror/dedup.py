@@ -0,0 +1,114 @@
+import collections
+import hashlib
+import re
+import threading
+import time
+
+try:
+    from HTMLParser import HTMLParser
+    _unescape = HTMLParser().unescape
+except ImportError:
+    from html import unescape as _unescape
+
+from slack_mirror.metrics import Counter
+
+DEDUP = Counter(
+    'slack_mirror_dedup_total',
+    'Echo dedup cache lookups and evictions.',
+    ['result'],
+)
+
+_SLACK_LINK_RE = re.compile(r'<([^>|]+)(?:\|([^>]*))?>')
+_MARKUP_RE = re.compile(r'[*_~`]')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def _slack_link(match):
+    target = match.group(1)
+    if target[0] in '@#!':
+        return match.group(2) or target
+    return target
+
+
+def normalize(content):
+    """ Reduces a message body to what survives a Slack/Zulip round trip.
+
+    Slack wraps links in ``<...>`` and escapes ``&<>``; both sides use
+    slightly different emphasis markup; whitespace is not preserved.
+    """
+    content = _SLACK_LINK_RE.sub(_slack_link, content)
+    content = _unescape(content)
+    content = _MARKUP_RE.sub('', content)
+    return _SPACE_RE.sub(' ', content).strip()
+
+
+def fingerprint(sender, stream, content):
+    digest = hashlib.sha1(normalize(content).encode('utf-8')).digest()
+    return ('fp', sender, stream, digest[:8])
+
+
+class DedupCache(object):
+    """ Remembers recently mirrored messages so their echoes can be dropped.
+
+    Keys are slack message ids (``('slack', channel, ts)``) or content
+    fingerprints; zulip posts are known by their client instead. Entries expire after ``ttl`` seconds, and the
+    oldest are evicted once there are more than ``maxsize``.
+    """
+
+    def __init__(self, ttl=60, maxsize=10000, clock=time.time):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            ttl=float(settings.get('mirror.dedup_ttl', 60)),
+            maxsize=int(settings.get('mirror.dedup_size', 10000)),
+        )
+
+    def _expire(self, now):
+        evicted = 0
+        while self.entries:
+            key = next(iter(self.entries))
+            if self.entries[key] > now and len(self.entries) <= self.maxsize:
+                break
+            del self.entries[key]
+            evicted += 1
+        if evicted:
+            DEDUP.labels('eviction').inc(evicted)
+
+    def add(self, key):
+        now = self.clock()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = now + self.ttl
+            self._expire(now)
+
+    def check(self, key):
+        """ Returns True, and forgets the key, if it was added recently. """
+        now = self.clock()
+        with self.lock:
+            self._expire(now)
+            hit = self.entries.pop(key, None) is not None
+        DEDUP.labels('hit' if hit else 'miss').inc()
+        return hit
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def get_dedup_cache(settings):
+    """ The cache shared by every mirror in the process.
+
+    Sharing it lets a private mirror register what it is about to post to
+    Slack before the public mirror can see it come back.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = DedupCache.from_settings(settings)
+        return _shared
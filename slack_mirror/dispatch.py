@@ -0,0 +1,124 @@
+import logging
+import re
+
+from slack_mirror.metrics import Counter
+
+LOGGER = logging.getLogger(__name__)
+
+EVENTS = Counter(
+    'slack_mirror_events_total',
+    'Decoded events, by source and type.',
+    ['source', 'type'],
+)
+DROPPED = Counter(
+    'slack_mirror_events_dropped_total',
+    'Events received but ignored, by source and the filter that dropped '
+    'them.',
+    ['source', 'stage'],
+)
+
+_TYPE_RE = re.compile(r'"type"\s*:\s*"([^"\\]*)"')
+_TYPE_PREFIX = '{"type":"'
+
+_handler_maps = {}
+
+
+class HandlerMap(object):
+    """ The ``<prefix>__<type>[__<subtype>]`` methods of a translator class.
+
+    Built once per class by ``get_handler_map``.
+    """
+
+    def __init__(self, cls, prefix):
+        self.by_type = {}
+        self.by_subtype = {}
+        start = prefix + '__'
+        for name in dir(cls):
+            if not name.startswith(start):
+                continue
+            func = getattr(cls, name)
+            if not callable(func):
+                continue
+            parts = name[len(start):].split('__', 1)
+            if len(parts) == 1:
+                self.by_type[parts[0]] = name
+            else:
+                self.by_subtype[tuple(parts)] = name
+        self.types = frozenset(
+            list(self.by_type) + [t for t, _ in self.by_subtype])
+
+
+def get_handler_map(cls, prefix):
+    key = (cls, prefix)
+    handler_map = _handler_maps.get(key)
+    if handler_map is None:
+        handler_map = _handler_maps[key] = HandlerMap(cls, prefix)
+    return handler_map
+
+
+class Dispatcher(object):
+    """ Routes decoded events to a translator's bound handler methods.
+
+    Subtype handlers win over the type handler, which is the fallback for
+    any subtype without its own method.
+    """
+
+    def __init__(self, translator, prefix, subtype_key='subtype'):
+        handler_map = get_handler_map(type(translator), prefix)
+        self.prefix = prefix
+        self.received = {}
+        self.unhandled = DROPPED.labels(prefix, 'unhandled')
+        self.types = handler_map.types
+        self.subtype_key = subtype_key
+        self.by_type = dict(
+            (k, getattr(translator, name))
+            for k, name in handler_map.by_type.items()
+        )
+        self.by_subtype = dict(
+            (k, getattr(translator, name))
+            for k, name in handler_map.by_subtype.items()
+        )
+
+    def wants(self, raw):
+        """ Cheaply checks whether a raw JSON frame could have a handler.
+
+        Every ``"type": "..."`` in the frame is considered, not just the
+        first, so nested objects can only cause a frame to be decoded, never
+        skipped.
+        """
+        # Slack sends the type first, so most frames are settled by slicing
+        # it out and checking that no nested "type" follows.
+        if raw.startswith(_TYPE_PREFIX):
+            end = raw.find('"', len(_TYPE_PREFIX))
+            if raw[len(_TYPE_PREFIX):end] in self.types:
+                return True
+            if raw.find('"type"', end) == -1:
+                return False
+        for frame_type in _TYPE_RE.findall(raw):
+            if frame_type in self.types:
+                return True
+        return False
+
+    def dispatch(self, msg):
+        msg_type = msg.get('type')
+        received = self.received.get(msg_type)
+        if received is None:
+            received = self.received[msg_type] = EVENTS.labels(
+                self.prefix, msg_type or 'unknown')
+        received.inc()
+        handler = None
+        if self.subtype_key is not None:
+            subtype = msg.get(self.subtype_key)
+            if subtype:
+                handler = self.by_subtype.get((msg_type, subtype))
+        if handler is None:
+            handler = self.by_type.get(msg_type)
+            if handler is None:
+                self.unhandled.inc()
+                return False
+        try:
+            handler(msg)
+        except Exception:
+            LOGGER.exception('Failed to call %r', handler)
+            raise
+        return True
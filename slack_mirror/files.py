@@ -0,0 +1,304 @@
+""" Copies shared files between Slack and Zulip.
+
+A file is streamed from one side into a temporary file, hashing it on the
+way, and streamed from there to the other side, so a transfer holds one
+chunk of it in memory at a time. Transfers run on a few workers per mirror
+instead of the receive thread, and a process wide cache remembers where
+each file was copied to, by source and by content, so a file shared to
+several channels is only copied once.
+"""
+import collections
+import contextlib
+import hashlib
+import io
+import logging
+import re
+import tempfile
+import threading
+import uuid
+
+from slack_mirror.markup import LRUCache
+from slack_mirror.metrics import Counter
+from slack_mirror.transport import SEND_QUEUE_DEPTH, SEND_QUEUE_DROPPED
+
+LOGGER = logging.getLogger(__name__)
+
+
+TRANSFERS = Counter(
+    'slack_mirror_file_transfers_total',
+    'Files shared on one side, by direction and whether they were copied, '
+    'found already copied, too large or failed.',
+    ['direction', 'outcome'],
+)
+TRANSFER_BYTES = Counter(
+    'slack_mirror_file_transfer_bytes_total',
+    'Bytes of files copied to the other side, by direction.',
+    ['direction'],
+)
+
+# A markdown link to a file uploaded to Zulip.
+UPLOAD_RE = re.compile(r'\[([^\]\n]*)\]\((/user_uploads/[^)\s]+)\)')
+
+
+class FileTooLarge(Exception):
+    def __init__(self, size):
+        super(FileTooLarge, self).__init__(size)
+        self.size = size
+
+
+def spool(response, max_size, chunk_size=65536, spool_dir=None):
+    """ Streams a ``requests`` response into a temporary file.
+
+    Returns ``(file, size, sha256 hexdigest)`` with the file rewound, or
+    raises ``FileTooLarge`` as soon as the body goes past ``max_size``.
+    """
+    with contextlib.closing(response):
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        if length is not None and int(length) > max_size:
+            raise FileTooLarge(int(length))
+        digest = hashlib.sha256()
+        size = 0
+        spooled = tempfile.TemporaryFile(dir=spool_dir)
+        try:
+            for chunk in response.iter_content(chunk_size):
+                size += len(chunk)
+                if size > max_size:
+                    raise FileTooLarge(size)
+                digest.update(chunk)
+                spooled.write(chunk)
+        except BaseException:
+            spooled.close()
+            raise
+    spooled.seek(0)
+    return spooled, size, digest.hexdigest()
+
+
+def _quote(value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return value.replace(b'"', b'%22').replace(b'\r', b'').replace(b'\n', b'')
+
+
+class MultipartFile(object):
+    """ A ``multipart/form-data`` body for one file, read from ``fileobj``
+    as it is sent.
+
+    Passed as ``data``, ``requests`` sends it in blocks with its
+    ``Content-Length``, where ``files=`` would build the whole body in
+    memory first.
+    """
+
+    def __init__(self, fileobj, size, filename, fields=(), name='file',
+                 content_type=None):
+        token = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + token
+        boundary = token.encode('ascii')
+        head = b''
+        for field, value in fields:
+            head += (
+                b'--' + boundary + b'\r\n'
+                b'Content-Disposition: form-data; name="' + _quote(field) +
+                b'"\r\n\r\n' + _quote(value) + b'\r\n'
+            )
+        head += (
+            b'--' + boundary + b'\r\n'
+            b'Content-Disposition: form-data; name="' + _quote(name) +
+            b'"; filename="' + _quote(filename) + b'"\r\n'
+            b'Content-Type: ' +
+            _quote(content_type or 'application/octet-stream') +
+            b'\r\n\r\n'
+        )
+        tail = b'\r\n--' + boundary + b'--\r\n'
+        self.parts = collections.deque(
+            [io.BytesIO(head), fileobj, io.BytesIO(tail)])
+        self.length = len(head) + size + len(tail)
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        data = b''
+        while self.parts and (size < 0 or len(data) < size):
+            chunk = self.parts[0].read(-1 if size < 0 else size - len(data))
+            if not chunk:
+                self.parts.popleft()
+            data += chunk
+        return data
+
+
+class TransferCache(object):
+    """ Where files were copied to, by ``(scope, source)`` and by
+    ``(scope, content hash)``.
+
+    ``scope`` names the destination, as a copy is only useful there. While
+    a file is being copied, other copies of the same source wait for it
+    instead of starting their own.
+    """
+
+    def __init__(self, size=1024):
+        self.copies = LRUCache(size)
+        self.copying = {}
+        self.lock = threading.Lock()
+
+    def copy(self, scope, source, fetch, upload):
+        """ Returns ``(destination, cached)``.
+
+        ``fetch()`` returns what ``spool`` does, and ``upload(file, size)``
+        the destination; neither is called when the source was copied
+        before, and ``upload`` is not when the content was.
+        """
+        key = (scope, source)
+        while True:
+            destination = self.copies.get(key)
+            if destination is not None:
+                return destination, True
+            with self.lock:
+                done = self.copying.get(key)
+                if done is None:
+                    done = self.copying[key] = threading.Event()
+                    break
+            # If that copy fails, the loop makes this one try in turn.
+            done.wait()
+
+        try:
+            spooled, size, digest = fetch()
+            with contextlib.closing(spooled):
+                by_content = (scope, 'sha256:' + digest)
+                destination = self.copies.get(by_content)
+                cached = destination is not None
+                if not cached:
+                    destination = upload(spooled, size)
+                    self.copies.put(by_content, destination)
+            self.copies.put(key, destination)
+            return destination, cached
+        finally:
+            with self.lock:
+                del self.copying[key]
+            done.set()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_transfer_cache(settings):
+    """ The cache shared by every mirror in the process. """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = TransferCache(int(settings.get('files.cache_size', 1024)))
+        return _cache
+
+
+class FileTransfers(object):
+    """ One mirror's file copies, run on at most ``concurrency`` threads.
+
+    Threads are started as work comes in and exit once there is none, so
+    the hundreds of mirrors that share nothing cost no threads. At most
+    ``maxsize`` copies wait; further ones are dropped.
+    """
+
+    def __init__(self, name='files', cache=None, concurrency=2, maxsize=100,
+                 max_size=25 * 1024 * 1024, chunk_size=65536,
+                 spool_dir=None):
+        self.name = name
+        self.cache = cache or TransferCache()
+        self.concurrency = concurrency
+        self.maxsize = maxsize
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.spool_dir = spool_dir
+        self.pending = collections.deque()
+        self.active = 0
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.depth = SEND_QUEUE_DEPTH.labels('files')
+        self.dropped = SEND_QUEUE_DROPPED.labels('files')
+
+    @classmethod
+    def from_settings(cls, settings, name='files'):
+        return cls(
+            name,
+            cache=get_transfer_cache(settings),
+            concurrency=int(settings.get('files.concurrency', 2)),
+            maxsize=int(settings.get('files.queue_size', 100)),
+            max_size=int(settings.get('files.max_size', 25 * 1024 * 1024)),
+            chunk_size=int(settings.get('files.chunk_size', 65536)),
+            spool_dir=settings.get('files.spool_dir'),
+        )
+
+    def put(self, func, *args):
+        """ Returns False, without calling ``func``, when stopped or full. """
+        with self.lock:
+            if self.stopped:
+                return False
+            if len(self.pending) >= self.maxsize:
+                self.dropped.inc()
+                LOGGER.warning('%s: file queue full, dropping %r',
+                               self.name, func)
+                return False
+            self.pending.append((func, args))
+            self.depth.inc()
+            if self.active >= self.concurrency:
+                return True
+            self.active += 1
+        thread = threading.Thread(name=self.name, target=self._work)
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _work(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.active -= 1
+                    return
+                func, args = self.pending.popleft()
+                self.depth.dec()
+            try:
+                func(*args)
+            except Exception:
+                LOGGER.exception('%s: failed to call %r', self.name, func)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.depth.dec(len(self.pending))
+            self.pending.clear()
+
+    def copied(self, scope, source):
+        """ Where ``source`` was copied to in ``scope``, if it still is
+        cached. """
+        return self.cache.copies.get((scope, source))
+
+    def copy(self, direction, scope, source, download, upload, size=None):
+        """ Copies one file, returning ``(destination, cached)`` as
+        ``TransferCache.copy`` does.
+
+        ``download()`` returns a streamed ``requests`` response. ``size`` is
+        what the source side says the file's size is, if it says.
+        """
+        try:
+            if size is not None and size > self.max_size:
+                raise FileTooLarge(size)
+
+            def fetch():
+                return spool(download(), self.max_size, self.chunk_size,
+                             self.spool_dir)
+
+            def counted_upload(fileobj, size):
+                destination = upload(fileobj, size)
+                TRANSFER_BYTES.labels(direction).inc(size)
+                return destination
+
+            destination, cached = self.cache.copy(
+                scope, source, fetch, counted_upload)
+        except FileTooLarge:
+            TRANSFERS.labels(direction, 'too_large').inc()
+            raise
+        except Exception:
+            TRANSFERS.labels(direction, 'failed').inc()
+            raise
+        TRANSFERS.labels(direction, 'cached' if cached else 'copied').inc()
+        return destination, cached
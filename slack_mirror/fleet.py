@@ -0,0 +1,147 @@
+""" Starts, stops or restarts many supervisord mirror processes at once.
+
+    python -m slack_mirror.fleet development.ini restart --all
+    python -m slack_mirror.fleet development.ini stop a@example.com b@...
+
+Calls go out on ``--parallel`` threads, and process starts are spaced out
+to ``--rate`` per second so hundreds of mirrors do not all call
+``rtm.start`` in the same second.
+"""
+import argparse
+import logging
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import pyramid.paster
+from supervisor.xmlrpc import Faults
+import xmlrpclib
+
+from slack_mirror.api import get_proxy
+
+LOGGER = logging.getLogger(__name__)
+
+ACTIONS = ('start', 'stop', 'restart')
+
+
+class Fleet(object):
+
+    def __init__(self, settings, parallel=8, rate=5.0, clock=time.time,
+                 sleep=time.sleep):
+        self.settings = settings
+        self.parallel = parallel
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self.exclude = set(
+            settings.get('fleet.exclude', 'ui_server').split())
+        self.next_start = 0
+        self.lock = threading.Lock()
+
+    def _proxy(self):
+        return get_proxy(self.settings)
+
+    def names(self):
+        return sorted(
+            info['name']
+            for info in self._proxy().supervisor.getAllProcessInfo()
+            if info['name'] not in self.exclude
+        )
+
+    def _pace(self):
+        with self.lock:
+            now = self.clock()
+            slot = max(now, self.next_start)
+            self.next_start = slot + 1.0 / self.rate
+        if slot > now:
+            self.sleep(slot - now)
+
+    def start(self, name):
+        self._pace()
+        try:
+            self._proxy().supervisor.startProcess(name, False)
+        except xmlrpclib.Fault as e:
+            if e.faultCode != Faults.ALREADY_STARTED:
+                raise
+
+    def stop(self, name):
+        try:
+            self._proxy().supervisor.stopProcess(name, True)
+        except xmlrpclib.Fault as e:
+            if e.faultCode != Faults.NOT_RUNNING:
+                raise
+
+    def restart(self, name):
+        self.stop(name)
+        self.start(name)
+
+    def run(self, action, names):
+        """ Applies ``action`` to every name; returns the ones that failed,
+        mapped to their error. """
+        func = getattr(self, action)
+        work = queue.Queue()
+        for name in names:
+            work.put(name)
+        failed = {}
+
+        def worker():
+            while True:
+                try:
+                    name = work.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    func(name)
+                except Exception as e:
+                    LOGGER.exception('Failed to %s %r', action, name)
+                    failed[name] = e
+
+        threads = []
+        for i in range(min(self.parallel, work.qsize())):
+            thread = threading.Thread(name='fleet', target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return failed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_uri')
+    parser.add_argument('action', choices=ACTIONS)
+    parser.add_argument('names', nargs='*')
+    parser.add_argument('--all', action='store_true',
+                        help='every process except fleet.exclude')
+    parser.add_argument('--parallel', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=5.0,
+                        help='process starts per second')
+    args = parser.parse_args()
+    if not args.names and not args.all:
+        parser.error('name some processes or pass --all')
+
+    pyramid.paster.setup_logging(args.config_uri)
+    settings = pyramid.paster.get_appsettings(args.config_uri)
+    fleet = Fleet(settings, args.parallel, args.rate)
+    names = fleet.names() if args.all else args.names
+
+    started = time.time()
+    failed = fleet.run(args.action, names)
+    LOGGER.info(
+        '%s: %d ok, %d failed in %.1fs',
+        args.action,
+        len(names) - len(failed),
+        len(failed),
+        time.time() - started,
+    )
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
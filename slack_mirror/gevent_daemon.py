@@ -0,0 +1,17 @@
+# Runs slack_mirror.daemon on the gevent hub. Patching has to happen before
+# websocket, requests and zulip import socket/ssl, so it lives in its own
+# entry point. Every mirror thread and send worker becomes a greenlet and all
+# sockets share one event loop.
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+
+from slack_mirror.daemon import main
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_uri')
+    args = parser.parse_args()
+    main(args.config_uri)
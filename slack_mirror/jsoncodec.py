@@ -0,0 +1,57 @@
+""" JSON decoding for websocket frames.
+
+``loads`` is the fastest available backend unless ``mirror.json_backend``
+picks one. orjson and ujson are optional; the stdlib json module is always
+there as a fallback.
+
+``prefilter`` says whether frames should go through ``Dispatcher.wants``
+before being decoded. That only pays off with the stdlib decoder; the C
+decoders parse a small frame faster than the pre-filter can look at it.
+"""
+import json
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+BACKENDS = ('orjson', 'ujson', 'json')
+
+
+def _import(name):
+    if name == 'json':
+        return json.loads
+    try:
+        module = __import__(name)
+    except ImportError:
+        return None
+    return module.loads
+
+
+def get_loads(backend='auto'):
+    if backend == 'auto':
+        for name in BACKENDS:
+            loads = _import(name)
+            if loads is not None:
+                return name, loads
+    loads = _import(backend)
+    if loads is None:
+        raise ValueError('JSON backend %r is not available' % backend)
+    return backend, loads
+
+
+def _use_prefilter(backend, setting='auto'):
+    if setting == 'auto':
+        return backend == 'json'
+    return setting.lower() in ('true', 'yes', 'on', '1')
+
+
+backend, loads = get_loads()
+prefilter = _use_prefilter(backend)
+
+
+def configure(settings):
+    global backend, loads, prefilter
+    backend, loads = get_loads(settings.get('mirror.json_backend', 'auto'))
+    prefilter = _use_prefilter(
+        backend, settings.get('mirror.json_prefilter', 'auto'))
+    LOGGER.info(
+        'Using %s to decode JSON frames, prefilter %s', backend, prefilter)
@@ -0,0 +1,248 @@
+""" Translates message markup between Slack and Zulip.
+
+Slack sends mentions and links as ``<@U123>``, ``<#C123|name>`` and
+``<url|label>``, escapes ``&<>`` as entities and uses single-character
+emphasis. Zulip uses ``@**name**``, ``#**stream**``, markdown links and
+markdown emphasis. Each direction is one pass of one precompiled regex, and
+what mentions resolve to is kept in the team state's ``mentions`` cache.
+"""
+import re
+import threading
+
+
+class LRUCache(object):
+    """ A dict that forgets its least recently used entries past ``size``.
+
+    Recency is tracked in two generations rather than exactly: entries are
+    written to ``recent``, and once it holds ``size / 2`` the older
+    generation is dropped and ``recent`` takes its place. Reading an old
+    entry copies it back into ``recent``. A hit is then a plain dict lookup
+    with no lock, where an exact LRU would reorder a Python 2
+    ``OrderedDict`` under a lock.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.recent = {}
+        self.old = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        value = self.recent.get(key)
+        if value is None:
+            with self.lock:
+                # Under the lock, so a concurrent pop is not undone.
+                value = self.old.get(key)
+                if value is not None:
+                    self._put(key, value)
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._put(key, value)
+
+    def _put(self, key, value):
+        if len(self.recent) >= self.size // 2:
+            self.old = self.recent
+            self.recent = {}
+        self.recent[key] = value
+
+    def pop(self, key):
+        with self.lock:
+            self.recent.pop(key, None)
+            self.old.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.recent = {}
+            self.old = {}
+
+    def __len__(self):
+        return len(set(self.recent) | set(self.old))
+
+
+# The lookaheads skip, in one test, the characters that cannot start any of
+# the alternatives. Without them plain text costs several times as much.
+_SLACK_RE = re.compile(r'''
+    (?=[`<&*_~])
+    (?:
+        (?P<code>```.*?```|`[^`\n]*`)
+      | <(?P<target>[^>|\n]+)(?:\|(?P<label>[^>\n]*))?>
+      | &(?P<entity>amp|lt|gt);
+      | (?<![\w*])\*(?P<bold>[^*\n]+)\*(?![\w*])
+      | (?<![\w_])_(?P<italic>[^_\n]+)_(?![\w_])
+      | (?<![\w~])~(?P<strike>[^~\n]+)~(?![\w~])
+    )
+''', re.VERBOSE | re.DOTALL)
+
+_ENTITY_RE = re.compile(r'&(amp|lt|gt);')
+_ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>'}
+
+_ZULIP_RE = re.compile(r'''
+    (?=[`@#\[*~&<>])
+    (?:
+        (?P<code>```.*?```|`[^`\n]*`)
+      | @_?\*\*(?P<user>[^*\n]+)\*\*
+      | \#\*\*(?P<stream>[^*\n]+)\*\*
+      | \[(?P<label>[^\]\n]+)\]\((?P<url>[^)\s]+)\)
+      | \*\*(?P<bold>[^*\n]+)\*\*
+      | (?<![\w*])\*(?P<italic>[^*\n]+)\*(?![\w*])
+      | ~~(?P<strike>[^~\n]+)~~
+      | (?P<char>[&<>])
+    )
+''', re.VERBOSE | re.DOTALL)
+
+_ESCAPE_RE = re.compile(r'[&<>]')
+_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+
+# Slack's <!here> and friends, and Zulip's names for notifying everyone.
+_SLACK_BROADCASTS = frozenset(['here', 'channel', 'everyone'])
+_ZULIP_BROADCASTS = frozenset(['all', 'everyone', 'stream'])
+
+
+def _unescape(text):
+    return _ENTITY_RE.sub(lambda m: _ENTITIES[m.group(1)], text)
+
+
+def _escape(text):
+    return _ESCAPE_RE.sub(lambda m: _ESCAPES[m.group(0)], text)
+
+
+def _cached(state, key, resolve):
+    value = state.mentions.get(key)
+    if value is None:
+        value = resolve()
+        # Misses are cached too, as False; the state drops both kinds of
+        # entry when the user or channel behind them changes.
+        state.mentions.put(key, False if value is None else value)
+    return value or None
+
+
+class _SlackToZulip(object):
+
+    def __init__(self, state, fetch_user, fetch_channel):
+        self.state = state
+        self.fetch_user = fetch_user
+        self.fetch_channel = fetch_channel
+
+    def user(self, user_id):
+        try:
+            user = self.state.get_user(user_id, self.fetch_user)
+        except KeyError:
+            return None
+        return u'@**{}**'.format(user.name)
+
+    def channel(self, channel_id):
+        try:
+            channel = self.state.get_channel(channel_id, self.fetch_channel)
+        except KeyError:
+            return None
+        return u'#**{}/slack**'.format(channel.name)
+
+    def link(self, target, label):
+        kind = target[0]
+        if kind == '@':
+            return _cached(
+                self.state, ('@', target[1:]),
+                lambda: self.user(target[1:]),
+            ) or u'@' + _unescape(label or target[1:])
+        if kind == '#':
+            return _cached(
+                self.state, ('#', target[1:]),
+                lambda: self.channel(target[1:]),
+            ) or u'#' + _unescape(label or target[1:])
+        if kind == '!':
+            name = target[1:].split('^', 1)[0]
+            if name in _SLACK_BROADCASTS:
+                return u'@**all**'
+            return _unescape(label or u'@' + name)
+        url = _unescape(target)
+        if label is None or _unescape(label) == url:
+            return url
+        if url.startswith('mailto:'):
+            return _unescape(label)
+        return u'[{}]({})'.format(_unescape(label), url)
+
+    def __call__(self, match):
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'code':
+            return _unescape(value)
+        if kind in ('target', 'label'):
+            return self.link(match.group('target'), match.group('label'))
+        if kind == 'entity':
+            return _ENTITIES[value]
+        if kind == 'bold':
+            return u'**{}**'.format(self.convert(value))
+        if kind == 'italic':
+            return u'*{}*'.format(self.convert(value))
+        return u'~~{}~~'.format(self.convert(value))
+
+    def convert(self, text):
+        return _SLACK_RE.sub(self, text)
+
+
+class _ZulipToSlack(object):
+
+    def __init__(self, state):
+        self.state = state
+
+    def user(self, name):
+        # Zulip mentions name people, Slack mentions need their id.
+        user_id = self.state.user_ids.get(name)
+        if user_id is None:
+            return None
+        return u'<@{}>'.format(user_id)
+
+    def stream(self, name):
+        if not name.endswith('/slack'):
+            return None
+        channel_id = self.state.channel_ids.get(name[:-6])
+        if channel_id is None:
+            return None
+        return u'<#{}>'.format(channel_id)
+
+    def __call__(self, match):
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'code':
+            return _escape(value)
+        if kind == 'user':
+            name = value.split('|', 1)[0]
+            if name in _ZULIP_BROADCASTS:
+                return u'<!channel>'
+            return _cached(
+                self.state, ('@name', name), lambda: self.user(name),
+            ) or u'@' + _escape(name)
+        if kind == 'stream':
+            name = value.split('>', 1)[0]
+            return _cached(
+                self.state, ('#name', name), lambda: self.stream(name),
+            ) or u'#' + _escape(name)
+        if kind == 'url':
+            return u'<{}|{}>'.format(
+                _escape(value), _escape(match.group('label')))
+        if kind == 'bold':
+            return u'*{}*'.format(self.convert(value))
+        if kind == 'italic':
+            return u'_{}_'.format(self.convert(value))
+        if kind == 'strike':
+            return u'~{}~'.format(self.convert(value))
+        return _ESCAPES[value]
+
+    def convert(self, text):
+        return _ZULIP_RE.sub(self, text)
+
+
+def slack_to_zulip(text, state, fetch_user=None, fetch_channel=None):
+    """ Zulip markdown for a Slack message's ``text``.
+
+    ``fetch_user`` and ``fetch_channel`` look up ids missing from ``state``,
+    as for ``TeamState.get_user``.
+    """
+    return _SlackToZulip(state, fetch_user, fetch_channel).convert(text)
+
+
+def zulip_to_slack(text, state):
+    """ Slack ``text`` for a Zulip message's markdown ``content``. """
+    return _ZulipToSlack(state).convert(text)
@@ -0,0 +1,310 @@
+""" In-process counters, gauges and histograms.
+
+Mirror processes write a snapshot of their registry to ``mirror.metrics_dir``
+every few seconds; the web app merges those snapshots and serves them in
+the Prometheus text format at ``/metrics``.
+"""
+import bisect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+    def collect(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        return [metric.collect() for metric in metrics]
+
+
+REGISTRY = Registry()
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, doc, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+        registry.register(self)
+
+    def labels(self, *values):
+        assert len(values) == len(self.labelnames)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self):
+        with self.lock:
+            children = list(self.children.items())
+        return {
+            'name': self.name,
+            'kind': self.kind,
+            'doc': self.doc,
+            'labelnames': list(self.labelnames),
+            'samples': [
+                [list(values), child.snapshot()] for values, child in children
+            ],
+        }
+
+
+class _CounterValue(object):
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class _GaugeValue(_CounterValue):
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramValue(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self.lock:
+            return [list(self.counts), self.sum]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+DEFAULT_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS,
+                 registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, doc, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def collect(self):
+        family = super(Histogram, self).collect()
+        family['buckets'] = list(self.buckets)
+        return family
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+def _add(a, b):
+    if isinstance(a, list):
+        return [_add(x, y) for x, y in zip(a, b)]
+    return a + b
+
+
+def merge(snapshots):
+    """ Sums the samples of several processes' ``collect()`` output. """
+    families = {}
+    for snapshot in snapshots:
+        for family in snapshot:
+            merged = families.get(family['name'])
+            if merged is None:
+                merged = families[family['name']] = dict(family, samples={})
+            elif merged.get('buckets') != family.get('buckets'):
+                continue
+            samples = merged['samples']
+            for values, value in family['samples']:
+                key = tuple(values)
+                if key in samples:
+                    value = _add(samples[key], value)
+                samples[key] = value
+    for family in families.values():
+        family['samples'] = sorted(
+            [list(k), v] for k, v in family['samples'].items())
+    return [families[name] for name in sorted(families)]
+
+
+def _escape(value):
+    return (
+        value.replace('\\', '\\\\')
+        .replace('"', '\\"')
+        .replace('\n', '\\n')
+    )
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, _escape(u'%s' % value)) for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def render(families):
+    """ Formats ``collect()`` or ``merge()`` output as Prometheus text. """
+    lines = []
+    for family in families:
+        name = family['name']
+        names = family['labelnames']
+        lines.append('# HELP %s %s' % (name, _escape(family['doc'])))
+        lines.append('# TYPE %s %s' % (name, family['kind']))
+        for values, value in family['samples']:
+            if family['kind'] != 'histogram':
+                lines.append('%s%s %s' % (
+                    name, _format_labels(names, values), _format_value(value)))
+                continue
+            counts, total = value
+            cumulative = 0
+            bounds = family['buckets'] + [float('inf')]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append('%s_bucket%s %s' % (
+                    name,
+                    _format_labels(
+                        names, values, [('le', _format_value(bound))]),
+                    _format_value(cumulative),
+                ))
+            labels = _format_labels(names, values)
+            lines.append('%s_sum%s %s' % (name, labels, _format_value(total)))
+            lines.append('%s_count%s %s' % (
+                name, labels, _format_value(cumulative)))
+    return '\n'.join(lines) + '\n'
+
+
+def read_snapshots(directory, max_age):
+    """ Loads the snapshots in ``directory`` written in the last
+    ``max_age`` seconds; older ones belong to processes that are gone. """
+    snapshots = []
+    cutoff = time.time() - max_age
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.json'):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                continue
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (IOError, OSError, ValueError):
+            LOGGER.warning('Skipping unreadable metrics snapshot %r', path)
+    return snapshots
+
+
+class FileExporter(object):
+    """ Writes this process's registry to ``path`` every ``interval``
+    seconds. """
+
+    def __init__(self, path, interval=15, registry=REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+
+    def write(self):
+        directory = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.registry.collect(), f)
+        os.rename(tmp_path, self.path)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except (IOError, OSError):
+                LOGGER.exception('Failed to write metrics to %r', self.path)
+
+    def start(self):
+        thread = threading.Thread(name='metrics', target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def start_exporter(settings):
+    directory = settings.get('mirror.metrics_dir')
+    if not directory:
+        return None
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    exporter = FileExporter(
+        os.path.join(directory, '%d.json' % os.getpid()),
+        float(settings.get('mirror.metrics_interval', 15)),
+    )
+    exporter.start()
+    return exporter
@@ -3,14 +3,18 @@ import logging
 from datetime import datetime
 
 from sqlalchemy import (
+    Boolean,
     Column,
     Text,
     UnicodeText,
     DateTime,
+    Index,
+    true,
 )
 from sqlalchemy.ext.declarative import declarative_base
 from rauth.service import OAuth2Service
-import requests
+
+from slack_mirror.sessions import TokenSession
 
 Base = declarative_base()
 
@@ -26,6 +30,10 @@ def get_service(settings):
         authorize_url='https://slack.com/oauth/authorize')
 
 
+def slack_session(access_token):
+    return TokenSession(params={'token': access_token})
+
+
 BASE_PATH = os.path.dirname(os.path.abspath(__file__))
 
 BOT_CONFIG_TEMPLATE = """
@@ -53,14 +61,37 @@ class User(Base):
     last_log = Column(DateTime, nullable=False, default=datetime.utcnow())
     access_token = Column(Text, nullable=False)
     zulip_key = Column(Text)
+    # Read by slack_mirror.daemon; per user programs are started and
+    # stopped through supervisor instead.
+    enabled = Column(Boolean, nullable=False, default=True,
+                     server_default=true())
 
     def __init__(self, id_, email, access_token):
         self.id = id_
         self.email = email
         self.access_token = access_token
+        self.enabled = True
 
     @property
     def slack_api(self):
-        session = requests.Session()
-        session.params = {'token': self.access_token}
-        return session
+        return slack_session(self.access_token)
+
+
+class ThreadTopic(Base):
+    """ The Zulip topic a Slack thread is mirrored to. """
+    __tablename__ = 'thread_topic'
+    __table_args__ = (
+        Index('ix_thread_topic_stream_topic', 'stream', 'topic', unique=True),
+    )
+
+    channel_id = Column(Text, primary_key=True)
+    thread_ts = Column(Text, primary_key=True)
+    stream = Column(UnicodeText, nullable=False)
+    topic = Column(UnicodeText, nullable=False)
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __init__(self, channel_id, thread_ts, stream, topic):
+        self.channel_id = channel_id
+        self.thread_ts = thread_ts
+        self.stream = stream
+        self.topic = topic
@@ -0,0 +1,447 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from slack_mirror.metrics import Counter
+
+LOGGER = logging.getLogger(__name__)
+
+
+OUTBOX_DROPPED = Counter(
+    'slack_mirror_outbox_dropped_total',
+    'Outbox writes given up on because SQLite refused them, by kind.',
+    ['kind'],
+)
+
+
+# Ids are only unique per mirror, so processes sharing the file never
+# hand out the same one.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox_message (
+    mirror TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    direction TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (mirror, id)
+)
+"""
+
+# Moves rows over from the old table, keyed by id alone.
+MIGRATION = """
+INSERT OR IGNORE INTO outbox_message
+SELECT mirror, id, direction, payload, created FROM outbox
+"""
+
+WATERMARK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS watermark (
+    mirror TEXT NOT NULL,
+    source TEXT NOT NULL,
+    key TEXT NOT NULL,
+    mark TEXT NOT NULL,
+    PRIMARY KEY (mirror, source, key)
+)
+"""
+
+# Messages the mirrors posted, by ``('slack', '<channel> <ts>')`` or
+# ``('zulip', '<id>')``, so catching up never mirrors them back.
+POSTED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS posted (
+    source TEXT NOT NULL,
+    key TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (source, key)
+)
+"""
+
+
+def posted_key(channel_id, ts):
+    return '{} {}'.format(channel_id, ts)
+
+
+class Outbox(object):
+    """ Messages that were received but not yet delivered, in SQLite.
+
+    ``record`` and ``delivered`` only queue work for a writer thread, which
+    commits everything queued during ``flush_interval`` in one transaction,
+    so many messages share one fsync. ``sync`` waits until everything queued
+    so far is on disk; call it before acknowledging received events.
+
+    It also keeps each mirror's high-water marks, the newest message seen
+    per channel, for catching up after a reconnect, and the messages the
+    mirrors posted, which catching up must skip.
+    """
+
+    def __init__(self, path, flush_interval=0.05, max_age=86400,
+                 sync_timeout=5.0, max_retry_delay=30.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.sync_timeout = sync_timeout
+        self.max_retry_delay = max_retry_delay
+        self.max_age = max_age
+        self.pruned = time.time()
+        self.cond = threading.Condition()
+        self.inserts = []
+        self.deletes = []
+        self.watermarks = {}
+        self.posts = []
+        self.next_ids = {}
+        self.queued = 0
+        self.committed = 0
+        self.stopped = False
+        self.thread = None
+
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            with conn:
+                conn.execute(SCHEMA)
+                conn.execute(WATERMARK_SCHEMA)
+                conn.execute(POSTED_SCHEMA)
+                old = conn.execute(
+                    "SELECT 1 FROM sqlite_master "
+                    "WHERE type = 'table' AND name = 'outbox'"
+                ).fetchone()
+                if old:
+                    conn.execute(MIGRATION)
+                    conn.execute('DROP TABLE outbox')
+                self._prune(conn)
+        finally:
+            conn.close()
+
+    def _prune(self, conn):
+        # Anything this old is no longer worth delivering, nor backfilled.
+        oldest = time.time() - self.max_age
+        conn.execute(
+            'DELETE FROM outbox_message WHERE created < ?', (oldest,))
+        conn.execute('DELETE FROM posted WHERE created < ?', (oldest,))
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def register(self, mirror):
+        """ Reads where ``mirror``'s ids carry on from; ``record`` does it
+        on first use otherwise. """
+        with self.cond:
+            if mirror in self.next_ids:
+                return
+        conn = self._connect()
+        try:
+            last = conn.execute(
+                'SELECT MAX(id) FROM outbox_message WHERE mirror = ?',
+                (mirror,),
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        with self.cond:
+            self.next_ids.setdefault(mirror, (last or 0) + 1)
+
+    def record(self, mirror, direction, payload):
+        if mirror not in self.next_ids:
+            self.register(mirror)
+        with self.cond:
+            outbox_id = self.next_ids[mirror]
+            self.next_ids[mirror] += 1
+            self.inserts.append((
+                mirror,
+                outbox_id,
+                direction,
+                json.dumps(payload),
+                time.time(),
+            ))
+            self.queued += 1
+            self.cond.notify_all()
+        return outbox_id
+
+    def delivered(self, mirror, outbox_ids):
+        if not outbox_ids:
+            return
+        with self.cond:
+            self.deletes.extend((mirror, i) for i in outbox_ids)
+            self.queued += 1
+            self.cond.notify_all()
+
+    def set_watermark(self, mirror, source, key, mark):
+        with self.cond:
+            # Only the newest mark per key is written.
+            self.watermarks[(mirror, source, key)] = mark
+            self.queued += 1
+            self.cond.notify_all()
+
+    def add_posted(self, source, key):
+        with self.cond:
+            self.posts.append((source, str(key), time.time()))
+            self.queued += 1
+            self.cond.notify_all()
+
+    def posted(self, source, keys):
+        """ Which of ``keys`` were posted by a mirror. """
+        keys = [str(key) for key in keys]
+        found = set()
+        conn = self._connect()
+        try:
+            # Well below SQLite's limit on query parameters.
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                found.update(key for key, in conn.execute(
+                    'SELECT key FROM posted WHERE source = ? AND key IN ({})'
+                    .format(', '.join('?' * len(chunk))),
+                    [source] + chunk,
+                ))
+        finally:
+            conn.close()
+        with self.cond:
+            # Those not written yet.
+            wanted = set(keys)
+            found.update(
+                key for s, key, _ in self.posts
+                if s == source and key in wanted)
+        return found
+
+    def get_watermarks(self, mirror, source):
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                'SELECT key, mark FROM watermark '
+                'WHERE mirror = ? AND source = ?',
+                (mirror, source),
+            ).fetchall()
+        finally:
+            conn.close()
+        return dict(rows)
+
+    def sync(self, timeout=None):
+        """ Returns False if the writes were not on disk after ``timeout``
+        seconds, ``sync_timeout`` by default. """
+        if timeout is None:
+            timeout = self.sync_timeout
+        deadline = time.time() + timeout
+        with self.cond:
+            target = self.queued
+            while self.committed < target and not self.stopped:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    LOGGER.warning('Outbox not written after %ss', timeout)
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def pending(self, mirror, direction):
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                'SELECT id, payload FROM outbox_message '
+                'WHERE mirror = ? AND direction = ? ORDER BY id',
+                (mirror, direction),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [(i, json.loads(payload)) for i, payload in rows]
+
+    def start(self):
+        self.thread = threading.Thread(name='outbox', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _write(self, conn, inserts, deletes, watermarks, posts):
+        with conn:
+            conn.executemany(
+                'INSERT INTO outbox_message '
+                '(mirror, id, direction, payload, created) '
+                'VALUES (?, ?, ?, ?, ?)',
+                inserts,
+            )
+            conn.executemany(
+                'DELETE FROM outbox_message WHERE mirror = ? AND id = ?',
+                deletes,
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO watermark '
+                '(mirror, source, key, mark) VALUES (?, ?, ?, ?)',
+                watermarks,
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO posted (source, key, created) '
+                'VALUES (?, ?, ?)',
+                posts,
+            )
+
+    def _write_each(self, conn, batch):
+        """ Writes ``batch``'s rows one at a time, dropping those that
+        fail. """
+        kinds = ('insert', 'delete', 'watermark', 'posted')
+        for index, kind in enumerate(kinds):
+            for row in batch[index]:
+                single = [[] for _ in kinds]
+                single[index] = [row]
+                try:
+                    self._write(conn, *single)
+                except sqlite3.Error:
+                    OUTBOX_DROPPED.labels(kind).inc()
+                    LOGGER.exception('Dropping outbox %s %r', kind, row[:2])
+
+    def run(self):
+        conn = self._connect()
+        delay = 0
+        while True:
+            with self.cond:
+                while self.committed == self.queued and not self.stopped:
+                    self.cond.wait()
+                if self.stopped and self.committed == self.queued:
+                    break
+            # Let more writes pile up behind this one.
+            time.sleep(self.flush_interval)
+            with self.cond:
+                inserts, self.inserts = self.inserts, []
+                deletes, self.deletes = self.deletes, []
+                watermarks, self.watermarks = self.watermarks, {}
+                posts = list(self.posts)
+                target = self.queued
+            batch = (
+                inserts, deletes, [k + (v,) for k, v in watermarks.items()],
+                posts)
+            try:
+                self._write(conn, *batch)
+            except sqlite3.OperationalError:
+                # Locked by another process, or out of disk, for a while.
+                if self.stopped:
+                    LOGGER.exception('Failed to write outbox, giving up')
+                    break
+                if not delay:
+                    LOGGER.warning('Failed to write outbox, retrying',
+                                   exc_info=True)
+                delay = min(max(delay * 2, 0.1), self.max_retry_delay)
+                with self.cond:
+                    self.inserts[:0] = inserts
+                    self.deletes[:0] = deletes
+                    watermarks.update(self.watermarks)
+                    self.watermarks = watermarks
+                    self.cond.wait(delay)
+                continue
+            except sqlite3.Error:
+                # Retrying would fail the same way; keep what can be kept.
+                LOGGER.exception('Failed to write outbox batch')
+                self._write_each(conn, batch)
+            if delay:
+                LOGGER.info('Wrote outbox again')
+            delay = 0
+            if time.time() - self.pruned > 3600:
+                self.pruned = time.time()
+                try:
+                    with conn:
+                        self._prune(conn)
+                except sqlite3.Error:
+                    LOGGER.exception('Failed to prune outbox')
+            with self.cond:
+                # Kept until written, so that posted() sees them meanwhile.
+                del self.posts[:len(posts)]
+                self.committed = target
+                self.cond.notify_all()
+        conn.close()
+
+
+class MirrorOutbox(object):
+    """ One mirror's view of the shared ``Outbox``. """
+
+    def __init__(self, outbox, mirror):
+        self.outbox = outbox
+        self.mirror = mirror
+        outbox.register(mirror)
+
+    def record(self, direction, payload):
+        return self.outbox.record(self.mirror, direction, payload)
+
+    def delivered(self, outbox_ids):
+        self.outbox.delivered(
+            self.mirror, [i for i in outbox_ids if i is not None])
+
+    def sync(self, timeout=None):
+        return self.outbox.sync(timeout)
+
+    def pending(self, direction):
+        return self.outbox.pending(self.mirror, direction)
+
+    def set_watermark(self, source, key, mark):
+        self.outbox.set_watermark(self.mirror, source, key, mark)
+
+    def get_watermarks(self, source):
+        return self.outbox.get_watermarks(self.mirror, source)
+
+    def add_posted(self, source, key):
+        self.outbox.add_posted(source, key)
+
+    def posted(self, source, keys):
+        return self.outbox.posted(source, keys)
+
+
+class NullOutbox(object):
+    """ Used when no outbox is configured; nothing survives a crash. """
+
+    def __init__(self):
+        self.watermarks = {}
+
+    def record(self, direction, payload):
+        return None
+
+    def delivered(self, outbox_ids):
+        pass
+
+    def sync(self, timeout=None):
+        return True
+
+    def pending(self, direction):
+        return []
+
+    def set_watermark(self, source, key, mark):
+        self.watermarks.setdefault(source, {})[key] = mark
+
+    def get_watermarks(self, source):
+        return dict(self.watermarks.get(source, {}))
+
+    def add_posted(self, source, key):
+        pass
+
+    def posted(self, source, keys):
+        return set()
+
+
+def outbox_path(settings):
+    path = settings.get('mirror.outbox_path')
+    if path:
+        return path
+    url = settings.get('sqlalchemy.url', '')
+    if url.startswith('sqlite:///'):
+        return url[len('sqlite:///'):] + '.outbox'
+    return None
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def get_outbox(settings, mirror):
+    global _shared
+    path = outbox_path(settings)
+    if path is None:
+        return NullOutbox()
+    with _shared_lock:
+        if _shared is None:
+            _shared = Outbox(
+                path,
+                float(settings.get('mirror.outbox_flush_interval', 0.05)),
+                float(settings.get('mirror.outbox_max_age', 86400)),
+                float(settings.get('mirror.outbox_sync_timeout', 5)),
+            )
+            _shared.start()
+    return MirrorOutbox(_shared, mirror)
@@ -0,0 +1,239 @@
+import collections
+import logging
+import threading
+import time
+
+from slack_mirror.metrics import Counter, Histogram
+from slack_mirror.transport import SEND_QUEUE_DEPTH, SEND_QUEUE_DROPPED
+
+LOGGER = logging.getLogger(__name__)
+
+
+THROTTLE_DELAY = Histogram(
+    'slack_mirror_slack_throttle_seconds',
+    'Time Slack messages waited for their channel rate limit.',
+)
+RATELIMITED = Counter(
+    'slack_mirror_slack_ratelimited_total',
+    'chat.postMessage calls rejected by Slack as ratelimited.',
+)
+COALESCED = Counter(
+    'slack_mirror_slack_coalesced_total',
+    'Slack messages merged into an earlier post to the same channel.',
+)
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super(RateLimited, self).__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        self.blocked_until = 0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        self.blocked_until = now + seconds
+        self.tokens = 0
+        self.updated = self.blocked_until
+
+
+def _options(msg):
+    return sorted((k, v) for k, v in msg.items() if k != 'text')
+
+
+Entry = collections.namedtuple(
+    'Entry',
+    [
+        'queued_at', 'slack', 'msg', 'outbox_ids', 'source_time',
+        'source_ids', 'traces',
+    ],
+)
+
+
+class SlackScheduler(object):
+    """ Paces chat.postMessage calls with a token bucket per channel.
+
+    The scheduler can be shared by every mirror in the process, since
+    Slack's limit applies to the channel no matter who posts. It only
+    decides when a post is due, the posting mirror's ``outbound`` queue
+    makes the call. While a channel is throttled, consecutive messages
+    from the same ``Slack`` connection to it are merged into a single post.
+    """
+
+    def __init__(self, rate=1.0, burst=1, maxsize=1000, max_text=4000,
+                 clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.max_text = max_text
+        self.clock = clock
+        self.pending = collections.OrderedDict()
+        self.buckets = {}
+        self.size = 0
+        self.cond = threading.Condition()
+        self.thread = None
+        self.depth = SEND_QUEUE_DEPTH.labels('slack_post')
+        self.dropped = SEND_QUEUE_DROPPED.labels('slack_post')
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            rate=float(settings.get('slack.post_rate', 1.0)),
+            burst=int(settings.get('slack.post_burst', 1)),
+            maxsize=int(settings.get('mirror.send_queue_size', 1000)),
+        )
+
+    def put(self, slack, msg, outbox_id=None, source_time=None,
+            source_id=None, trace=None):
+        with self.cond:
+            if self.size >= self.maxsize:
+                self.dropped.inc()
+                LOGGER.warning('Slack post queue full, dropping %r', msg)
+                # Replaying it once the queue drains would post it late.
+                slack.outbox.delivered([outbox_id])
+                return
+            entries = self.pending.setdefault(
+                msg['channel'], collections.deque())
+            entries.append(Entry(
+                self.clock(), slack, msg, (outbox_id,), source_time,
+                (source_id,) if source_id is not None else (),
+                (trace,) if trace is not None else ()))
+            self._resize(1)
+            self.cond.notify()
+
+    def _resize(self, amount):
+        self.size += amount
+        self.depth.inc(amount)
+
+    def _bucket(self, channel, now):
+        bucket = self.buckets.get(channel)
+        if bucket is None:
+            bucket = self.buckets[channel] = TokenBucket(
+                self.rate, self.burst, now)
+        return bucket
+
+    def _coalesce(self, entries):
+        first = entries.popleft()
+        texts = [first.msg['text']]
+        outbox_ids = first.outbox_ids
+        source_ids = first.source_ids
+        traces = first.traces
+        length = len(texts[0])
+        while entries:
+            entry = entries[0]
+            if entry.slack is not first.slack:
+                break
+            if _options(entry.msg) != _options(first.msg):
+                break
+            if length + 1 + len(entry.msg['text']) > self.max_text:
+                break
+            entries.popleft()
+            texts.append(entry.msg['text'])
+            outbox_ids += entry.outbox_ids
+            source_ids += entry.source_ids
+            traces += entry.traces
+            length += 1 + len(entry.msg['text'])
+        if len(texts) > 1:
+            COALESCED.inc(len(texts) - 1)
+            msg = dict(first.msg, text='\n'.join(texts))
+            first = first._replace(
+                msg=msg, outbox_ids=outbox_ids, source_ids=source_ids,
+                traces=traces)
+        return first, len(texts)
+
+    def next_batch(self, now):
+        """ Returns ``(entry, count, None)`` for the next post to make, or
+        ``(None, 0, wait)`` with the seconds until one is allowed. """
+        wait = None
+        for channel, entries in self.pending.items():
+            bucket = self._bucket(channel, now)
+            delay = bucket.delay(now)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            bucket.take(now)
+            entry, count = self._coalesce(entries)
+            if not entries:
+                del self.pending[channel]
+            self._resize(-count)
+            return entry, count, None
+        return None, 0, wait
+
+    def requeue(self, entry, count, retry_after):
+        channel = entry.msg['channel']
+        now = self.clock()
+        self._bucket(channel, now).pause(now, retry_after)
+        # Put the channel at the back so other channels get a turn.
+        entries = self.pending.pop(channel, None) or collections.deque()
+        entries.appendleft(entry)
+        self.pending[channel] = entries
+        self._resize(count)
+
+    def start(self):
+        with self.cond:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(
+                name='slack_scheduler',
+                target=self.run,
+            )
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            with self.cond:
+                entry, count, wait = self.next_batch(self.clock())
+                if entry is None:
+                    self.cond.wait(wait)
+                    continue
+
+            THROTTLE_DELAY.observe(self.clock() - entry.queued_at)
+            # The mirror's own worker posts it, so one slow or hung
+            # connection only holds up that mirror.
+            entry.slack.outbound.put(self.post, entry, count)
+
+    def post(self, entry, count):
+        if entry.slack.stopped:
+            # Left in its outbox, the mirror's replacement will replay it.
+            return
+        try:
+            entry.slack._send_message(
+                entry.msg, entry.outbox_ids, entry.source_time,
+                entry.source_ids, entry.traces)
+        except RateLimited as e:
+            RATELIMITED.inc()
+            LOGGER.warning(
+                'Slack ratelimited channel %r for %ss',
+                entry.msg['channel'],
+                e.retry_after,
+            )
+            with self.cond:
+                self.requeue(entry, count, e.retry_after)
+                self.cond.notify()
+        except Exception:
+            LOGGER.exception('Failed to post slack message')
@@ -0,0 +1,102 @@
+import logging
+import random
+import threading
+import time
+
+from slack_mirror.metrics import Counter, Histogram
+
+LOGGER = logging.getLogger(__name__)
+
+
+RECONNECTS = Counter(
+    'slack_mirror_reconnects_total',
+    'Connections re-established after a failure.',
+    ['side'],
+)
+DOWNTIME = Histogram(
+    'slack_mirror_downtime_seconds',
+    'Time from a connection failing until it was re-established.',
+    ['side'],
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
+
+
+class FatalError(Exception):
+    """ A failure that reconnecting cannot fix, like a revoked token. """
+
+
+class Reconnector(object):
+    """ Keeps one side of a mirror connected.
+
+    ``run`` calls ``connect`` again whenever it returns or raises, waiting a
+    random delay of up to ``base * 2 ** attempts`` seconds (capped at
+    ``cap``) in between so a Slack or Zulip outage is not met by every
+    mirror reconnecting in lockstep. The attempt count only starts over
+    once a connection has stayed up for ``stable`` seconds, so a connection
+    that drops right after opening keeps backing off.
+    """
+
+    def __init__(self, side, base=1, cap=300, stable=60,
+                 random=random.random, clock=time.time):
+        self.side = side
+        self.base = base
+        self.cap = cap
+        self.stable = stable
+        self.random = random
+        self.clock = clock
+        self.attempts = 0
+        self.down_since = None
+        self.connected_at = None
+        self.wakeup = threading.Event()
+        self.reconnects = RECONNECTS.labels(side)
+        self.downtime = DOWNTIME.labels(side)
+
+    @classmethod
+    def from_settings(cls, settings, side):
+        return cls(
+            side,
+            base=float(settings.get('mirror.reconnect_base', 1)),
+            cap=float(settings.get('mirror.reconnect_max', 300)),
+        )
+
+    def delay(self):
+        return self.random() * min(self.cap, self.base * 2 ** self.attempts)
+
+    def connected(self):
+        """ Called by ``connect`` once its connection is up. """
+        now = self.clock()
+        if self.connected_at is None:
+            self.connected_at = now
+        if self.down_since is not None:
+            LOGGER.info(
+                '%s reconnected after %.1fs', self.side, now - self.down_since)
+            self.reconnects.inc()
+            self.downtime.observe(now - self.down_since)
+            self.down_since = None
+
+    def run(self, connect, stopped):
+        while True:
+            try:
+                connect()
+            except FatalError:
+                raise
+            except Exception:
+                LOGGER.exception('%s connection failed', self.side)
+            if stopped():
+                return
+            now = self.clock()
+            if (self.connected_at is not None and
+                    now - self.connected_at >= self.stable):
+                self.attempts = 0
+            self.connected_at = None
+            if self.down_since is None:
+                self.down_since = now
+            delay = self.delay()
+            self.attempts += 1
+            LOGGER.warning('Reconnecting %s in %.1fs', self.side, delay)
+            self.wakeup.wait(delay)
+            if stopped():
+                return
+
+    def stop(self):
+        self.wakeup.set()
@@ -0,0 +1,141 @@
+import threading
+
+import requests
+import requests.adapters
+
+try:
+    from cookielib import DefaultCookiePolicy
+except ImportError:
+    from http.cookiejar import DefaultCookiePolicy
+
+
+_lock = threading.Lock()
+_session = None
+_settings = {}
+# Zulip event queue polls hold a connection each for most of their life,
+# so they get a pool of their own, sized for how many there are.
+_long_poll_session = None
+_long_poll_size = 0
+_long_polls = 0
+
+
+def _mount(session, settings, pool_maxsize):
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=int(settings.get('http.pool_connections', 4)),
+        pool_maxsize=pool_maxsize,
+        max_retries=int(settings.get('http.max_retries', 0)),
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
+def _new_session(settings, pool_maxsize):
+    session = requests.Session()
+    _mount(session, settings, pool_maxsize)
+    # Many users share this session, so it must never remember cookies.
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+def configure(settings):
+    """ Builds the process wide session from ``http.*`` settings. """
+    global _session, _settings, _long_poll_session
+    session = _new_session(
+        settings, int(settings.get('http.pool_maxsize', 32)))
+    with _lock:
+        _session = session
+        _settings = settings
+        _long_poll_session = None
+    return session
+
+
+def get_session():
+    with _lock:
+        session = _session
+    if session is None:
+        session = configure({})
+    return session
+
+
+def default_timeout():
+    """ Seconds a request may take unless its caller says otherwise. """
+    return float(_settings.get('http.timeout', 30))
+
+
+def _long_poll_pool_size():
+    size = _settings.get('http.long_poll_pool_maxsize')
+    if size:
+        return int(size)
+    # Rounded up, so a few more mirrors do not build a new pool each.
+    size = 4
+    while size < _long_polls:
+        size *= 2
+    return size
+
+
+def expect_long_polls(count):
+    """ Grows the long poll pool to hold ``count`` polls at once, unless
+    ``http.long_poll_pool_maxsize`` sets its size. """
+    global _long_polls, _long_poll_size
+    with _lock:
+        _long_polls = count
+        size = _long_poll_pool_size()
+        if _long_poll_session is None or size <= _long_poll_size:
+            return
+        # Polls under way finish on the old pool, which is then dropped.
+        _mount(_long_poll_session, _settings, size)
+        _long_poll_size = size
+
+
+def get_long_poll_session():
+    global _long_poll_session, _long_poll_size
+    get_session()
+    with _lock:
+        if _long_poll_session is None:
+            _long_poll_size = _long_poll_pool_size()
+            _long_poll_session = _new_session(_settings, _long_poll_size)
+        return _long_poll_session
+
+
+class TokenSession(object):
+    """ One user's view of the shared session.
+
+    Credentials are added to each request instead of being stored on a
+    ``requests.Session`` per user, so every user reuses the same keep-alive
+    connections to slack.com and the Zulip server. GETs of ``long_polls``
+    URLs go through the long poll session. Requests that pass no
+    ``timeout`` get ``http.timeout``, so a hung connection cannot hold a
+    worker forever.
+    """
+
+    def __init__(self, params=None, auth=None, headers=None, verify=True,
+                 cert=None, long_polls=()):
+        self.params = params or {}
+        self.auth = auth
+        self.headers = headers or {}
+        self.verify = verify
+        self.cert = cert
+        self.long_polls = frozenset(long_polls)
+
+    def request(self, method, url, **kwargs):
+        params = dict(self.params)
+        params.update(kwargs.pop('params', None) or {})
+        headers = dict(self.headers)
+        headers.update(kwargs.pop('headers', None) or {})
+        kwargs.setdefault('auth', self.auth)
+        kwargs.setdefault('verify', self.verify)
+        kwargs.setdefault('cert', self.cert)
+        if 'timeout' not in kwargs:
+            kwargs['timeout'] = default_timeout()
+        if method == 'GET' and url in self.long_polls:
+            session = get_long_poll_session()
+        else:
+            session = get_session()
+        return session.request(
+            method, url, params=params, headers=headers, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
@@ -1,78 +1,203 @@
 import argparse
 import collections
-import json
+import functools
 import logging
+import mimetypes
 import os
 import threading
+import time
+import weakref
+
+try:
+    from urlparse import urljoin
+except ImportError:
+    from urllib.parse import urljoin
 
 import pyramid.paster
+from pyramid.settings import asbool
 import transaction
 import websocket
 import zulip as zulip_client
 
 import slack_mirror
-from slack_mirror.models import User
+from slack_mirror import jsoncodec, markup, sessions, tracing
+from slack_mirror.backfill import Watermarks, run_limited, ts_key
+from slack_mirror.correlation import CorrelationIndex, get_correlation_index
+from slack_mirror.dedup import DedupCache, fingerprint, get_dedup_cache
+from slack_mirror.dispatch import DROPPED, Dispatcher, get_handler_map
+from slack_mirror.files import (
+    UPLOAD_RE,
+    FileTooLarge,
+    FileTransfers,
+    MultipartFile,
+)
+from slack_mirror.metrics import Counter, Histogram, start_exporter
+from slack_mirror.models import User, slack_session
+from slack_mirror.outbox import NullOutbox, get_outbox, posted_key
+from slack_mirror.ratelimit import RateLimited, SlackScheduler
+from slack_mirror.reconnect import FatalError, Reconnector
+from slack_mirror.state import get_team_state
+from slack_mirror.threads import DEFAULT_TOPIC, ThreadStore, get_thread_store
+from slack_mirror.transport import SendQueue
 
 LOGGER = logging.getLogger('slack_mirror.slack_mirror_script')
 
+MIRRORED = Counter(
+    'slack_mirror_messages_mirrored_total',
+    'Messages posted to the other side, by direction.',
+    ['direction'],
+)
+SEND_LATENCY = Histogram(
+    'slack_mirror_send_seconds',
+    'Time taken by the API call posting a mirrored message.',
+    ['side'],
+)
+MIRROR_LATENCY = Histogram(
+    'slack_mirror_mirror_latency_seconds',
+    'Time from a message being sent on one side to it being posted on '
+    'the other.',
+    ['direction'],
+)
+
+
+class PooledZulipClient(zulip_client.Client):
+    def ensure_session(self):
+        if self.session is not None:
+            return
+        super(PooledZulipClient, self).ensure_session()
+        session = self.session
+        self.session = sessions.TokenSession(
+            auth=session.auth,
+            headers=dict(session.headers),
+            verify=session.verify,
+            cert=session.cert,
+            long_polls=[urljoin(self.base_url, 'v1/events')],
+        )
+
+
+# What zulip reports as the client of every message the mirrors post,
+# which they send as JabberMirror/slack.
+MIRROR_CLIENT = 'JabberMirror'
+
 
 class SlackStateMixin(object):
+    # Which sides' messages to catch up on after a reconnect.
+    backfill_sources = ()
+    # Which channels' events to follow on a shared TeamFeed, None for all.
+    # State events are applied by the feed, so none are needed for them.
+    feed_channels = ()
+    # A SendQueue for lookups that must stay off the receive thread.
+    lookups = None
+    # Seconds a lookup of an unknown channel name waits for the team
+    # state's first refresh, which is still running after a cold start.
+    channel_wait = 10
+
     def __init__(self):
-        self.slack_email_domain = None
-        self.slack_users = {}
-        self.slack_channels = {}
+        self.slack_state = get_team_state(None)
+        self.watermarks = Watermarks()
 
     def slack_init(self, users, channels, team):
-        self.slack_email_domain = team['email_domain']
-        self.slack_users = {u['id']: u for u in users}
-        self.slack_channels = {c['id']: c for c in channels}
+        self.slack_state = get_team_state(team.get('id'))
+        self.slack_state.load(users, channels, team)
+
+    def slack_set_state(self, state):
+        self.slack_state = state
+
+    def zulip_narrow(self):
+        """ The messages this translator wants from zulip, both for its
+        event queue and for backfill. """
+        return []
 
     def slack__email_domain_changed(self, msg):
-        self.slack_email_domain = msg['email_domain']
+        self.slack_state.email_domain = msg['email_domain']
 
     def slack__team_join(self, msg):
-        user = msg['user']
-        self.slack_users[user['id']] = user
+        self.slack_state.set_user(msg['user'])
 
     def slack__user_change(self, msg):
-        user = msg['user']
-        self.slack_users[user['id']] = user
+        self.slack_state.set_user(msg['user'])
 
     def slack__channel_created(self, msg):
-        channel = msg['channel']
-        self.slack_channels[channel['id']] = channel
+        self.slack_state.set_channel(msg['channel'])
 
     def slack__channel_rename(self, msg):
-        channel = msg['channel']
-        self.slack_channels[channel['id']] = channel
+        self.slack_state.set_channel(msg['channel'])
 
     def slack__channel_deleted(self, msg):
-        del self.slack_channels[msg['channel']]
+        self.slack_state.delete_channel(msg['channel'])
+
+    def _slack_fetch_user(self, user_id):
+        slack = getattr(self, 'slack', None)
+        if slack is None:
+            raise KeyError(user_id)
+        return slack.fetch_user(user_id)
+
+    def _slack_fetch_channel(self, channel_id):
+        slack = getattr(self, 'slack', None)
+        if slack is None:
+            raise KeyError(channel_id)
+        return slack.fetch_channel(channel_id)
 
     def slack_user_id_to_zulip_user(self, user_id):
-        user = self.slack_users[user_id]
-        if user['profile']['email']:
-            return user['profile']['email']
+        user = self.slack_state.get_user(user_id, self._slack_fetch_user)
+        if user.email:
+            return user.email
         else:
-            return '{}@{}'.format(user['name'], self.slack_email_domain)
+            return '{}@{}'.format(user.name, self.slack_state.email_domain)
 
     def slack_channel_id_to_zulip_stream(self, channel_id):
-        channel = self.slack_channels[channel_id]
-        return '{}/slack'.format(channel['name'])
+        channel = self.slack_state.get_channel(
+            channel_id, self._slack_fetch_channel)
+        return '{}/slack'.format(channel.name)
 
     def zulip_stream_to_slack_channel_id(self, stream):
         assert stream.endswith('/slack')
-        channel_name = stream[:-6]
-        for channel in self.slack_channels.values():
-            if channel['name'] == channel_name:
-                return channel['id']
-        return None
+        name = stream[:-6]
+        channel_id = self.slack_state.channel_ids.get(name)
+        if channel_id is None and not self.slack_state.ready.is_set():
+            LOGGER.debug('Waiting for the team state to look up %r', name)
+            self.slack_state.ready.wait(self.channel_wait)
+            channel_id = self.slack_state.channel_ids.get(name)
+        return channel_id
+
+    def slack_to_zulip_markup(self, text):
+        return markup.slack_to_zulip(
+            text,
+            self.slack_state,
+            self._slack_fetch_user,
+            self._slack_fetch_channel,
+        )
+
+    def zulip_to_slack_markup(self, content):
+        return markup.zulip_to_slack(content, self.slack_state)
+
+
+def _shared_files(msg):
+    # Older events carry a single ``file``.
+    if msg.get('files'):
+        return msg['files']
+    return [msg['file']] if msg.get('file') else []
 
 
 class PublicTranslator(SlackStateMixin):
-    def __init__(self):
+    backfill_sources = ('slack',)
+    feed_channels = None
+
+    def __init__(self, dedup=None, threads=None, correlation=None,
+                 files=None, lookups=None):
         super(PublicTranslator, self).__init__()
-        self.messages_from_zulip = collections.OrderedDict()
+        self.dedup = dedup or DedupCache()
+        self.threads = threads or ThreadStore()
+        # The zulip copies of the slack messages this mirror posted.
+        self.correlation = correlation or CorrelationIndex()
+        self.files = files or FileTransfers()
+        # Recent top level messages, which replies name their topic after.
+        self.parents = markup.LRUCache()
+        # Replies wait there for their thread's topic, in order.
+        self.lookups = lookups or SendQueue('thread_lookup')
+        self.lookups.on_drop = self._lookup_dropped
+        self.looking_up = collections.Counter()
+        self.looking_up_lock = threading.Lock()
 
     def zulip_init(self):
         # Should join all the slack channels here but bots can't join channels :(
@@ -80,40 +205,199 @@ class PublicTranslator(SlackStateMixin):
 
     def zulip__message(self, msg):
         zulip_msg = msg['message']
-        self.messages_from_zulip[(
+        if zulip_msg['client'] == MIRROR_CLIENT:
+            # Something we mirrored from slack. Known from the event alone,
+            # since it can arrive before the post is acknowledged.
+            DROPPED.labels('zulip', 'echo').inc()
+            return
+        if not isinstance(zulip_msg['display_recipient'], basestring):
+            DROPPED.labels('zulip', 'recipient').inc()
+            return
+        # A personal mirror will post this to slack, where we will see it
+        # again. Private mirrors in this process also register it up front,
+        # so the echo is caught whichever side we hear from first.
+        self.dedup.add(fingerprint(
             zulip_msg['sender_email'],
             zulip_msg['display_recipient'],
-            zulip_msg['content'],
-        )] = True
-        while len(self.messages_from_zulip) > 100:
-            self.messages_from_zulip.popitem(last=False)
+            self.zulip_to_slack_markup(zulip_msg['content']),
+        ))
 
     def slack__message__channel_join(self, msg):
         pass  # NOOP join spam
 
+    def slack__message__message_replied(self, msg):
+        pass  # The parent's reply count changed, not its text
+
+    def slack__message__message_changed(self, msg):
+        message = msg['message']
+        previous = msg.get('previous_message', {})
+        if message.get('text') == previous.get('text'):
+            return  # Unfurls and reactions, not an edit
+        zulip_id = self.correlation.zulip_id(msg['channel'], message['ts'])
+        if zulip_id is None:
+            DROPPED.labels('slack', 'uncorrelated').inc()
+            return
+        self.zulip.update_message({
+            'message_id': zulip_id,
+            'content': self._zulip_content(
+                self.slack_to_zulip_markup(message['text']), message),
+        })
+
+    def slack__message__message_deleted(self, msg):
+        zulip_id = self.correlation.zulip_id(msg['channel'], msg['deleted_ts'])
+        if zulip_id is None:
+            DROPPED.labels('slack', 'uncorrelated').inc()
+            return
+        self.correlation.forget(zulip_id)
+        self.zulip.delete_message(zulip_id)
+
+    def _zulip_sent(self, channel_id, ts, ret):
+        self.correlation.add(channel_id, ts, ret['id'])
+
     def slack__message(self, msg):
+        zulip_message = self._zulip_message(msg)
+        if zulip_message is not None:
+            self._send_to_zulip(msg, zulip_message)
+
+    def slack__message__file_share(self, msg):
+        zulip_message = self._zulip_message(msg)
+        if zulip_message is None:
+            return
+        # The message waits for its files, off the receive thread, unless
+        # there is no room to; then it links to them where they are.
+        if not self.files.put(self._copy_files, msg, zulip_message):
+            self._send_to_zulip(msg, zulip_message)
+
+    def _copy_files(self, msg, zulip_message):
+        uris = dict(
+            (slack_file['id'], self._copy_file(slack_file))
+            for slack_file in _shared_files(msg)
+        )
+        zulip_message['content'] = self._zulip_content(
+            self.slack_to_zulip_markup(msg['text']), msg, uris)
+        self._send_to_zulip(msg, zulip_message)
+
+    def _copy_file(self, slack_file):
+        name = slack_file.get('name') or slack_file['id']
+        try:
+            uri, cached = self.files.copy(
+                'slack_to_zulip',
+                'zulip',
+                slack_file['id'],
+                lambda: self.slack.download_file(slack_file),
+                lambda fileobj, size: self.zulip.upload_file(
+                    fileobj, size, name, slack_file.get('mimetype')),
+                slack_file.get('size'),
+            )
+        except FileTooLarge as e:
+            LOGGER.info('Not copying %r, %d bytes is too large', name, e.size)
+            uri = None
+        except Exception:
+            LOGGER.exception('Failed to copy slack file %r', slack_file['id'])
+            uri = None
+        return uri
+
+    def _zulip_content(self, content, message, uris=None):
+        """ ``content``, ``message``'s text as zulip markup, followed by a
+        link to each of its files.
+
+        A file links to its ``uris`` entry, or else to where it was copied
+        before, or else to its permalink.
+        """
+        lines = [content] if content else []
+        for slack_file in _shared_files(message):
+            name = slack_file.get('name') or slack_file['id']
+            uri = (
+                (uris or {}).get(slack_file['id']) or
+                self.files.copied('zulip', slack_file['id']) or
+                slack_file.get('permalink')
+            )
+            lines.append(u'[{}]({})'.format(name, uri) if uri else name)
+        return u'\n'.join(lines)
+
+    def _zulip_message(self, msg):
+        """ The zulip message mirroring ``msg``, or None for an echo. """
         sender = self.slack_user_id_to_zulip_user(msg['user'])
         recipient = self.slack_channel_id_to_zulip_stream(msg['channel'])
-        key = (sender, recipient, msg['text'])
-
-        # This is a sad way to drop messages sent by personal mirrors. This
-        # will not work if the message body changes or we see the message from
-        # slack before zulip. Using already_sent_mirrored_message_id with a 10
-        # sec window on the server size will fix the zulip/slack race but we
-        # still have content changes.
-        if key in self.messages_from_zulip:
-            del self.messages_from_zulip[key]
-            return
+        self.watermarks.advance('slack', msg['channel'], msg['ts'])
+
+        # Check both keys so neither is left behind to eat a later message.
+        posted_by_mirror = self.dedup.check(
+            ('slack', msg['channel'], msg['ts']))
+        seen_on_zulip = self.dedup.check(
+            fingerprint(sender, recipient, msg['text']))
+        if posted_by_mirror or seen_on_zulip:
+            return None
 
-        zulip_message = dict(
+        content = self.slack_to_zulip_markup(msg['text'])
+        thread_ts = msg.get('thread_ts')
+        if thread_ts is None or thread_ts == msg['ts']:
+            self.parents.put((msg['channel'], msg['ts']), content)
+            subject = DEFAULT_TOPIC
+        else:
+            # None until the thread's topic is looked up, see _send_to_zulip.
+            subject = self._cached_topic(msg['channel'], thread_ts)
+        return dict(
             forged="yes",
             sender=sender,
             type="stream",
-            subject='(no topic)',
+            subject=subject,
             to=recipient,
-            content=msg['text'],
+            content=self._zulip_content(content, msg),
         )
-        self.zulip.send_message(zulip_message)
+
+    def _send_to_zulip(self, msg, zulip_message):
+        if zulip_message['subject'] is None:
+            # Finding the topic can take a slack API call and a database
+            # insert, which are left to the lookup worker.
+            with self.looking_up_lock:
+                self.looking_up[(msg['channel'], msg['thread_ts'])] += 1
+            self.lookups.put(self._send_reply, msg, zulip_message)
+            return
+        self.zulip.send_message(
+            zulip_message,
+            functools.partial(self._zulip_sent, msg['channel'], msg['ts']),
+            float(msg['ts']),
+        )
+
+    def _cached_topic(self, channel_id, thread_ts):
+        with self.looking_up_lock:
+            if (channel_id, thread_ts) in self.looking_up:
+                # Later replies queue up behind the earlier ones.
+                return None
+        return self.threads.cached_topic(channel_id, thread_ts)
+
+    def _send_reply(self, msg, zulip_message, topic=None):
+        try:
+            zulip_message['subject'] = topic or self._thread_topic(
+                msg['channel'], msg['thread_ts'], zulip_message['to']
+            ) or DEFAULT_TOPIC
+            self._send_to_zulip(msg, zulip_message)
+        finally:
+            key = (msg['channel'], msg['thread_ts'])
+            with self.looking_up_lock:
+                self.looking_up[key] -= 1
+                if not self.looking_up[key]:
+                    del self.looking_up[key]
+
+    def _lookup_dropped(self, func, args):
+        # Better in the wrong topic than not at all.
+        msg, zulip_message = args
+        self._send_reply(msg, zulip_message, DEFAULT_TOPIC)
+
+    def _thread_topic(self, channel_id, thread_ts, stream):
+        try:
+            topic = self.threads.topic(channel_id, thread_ts)
+            if topic is not None:
+                return topic
+            parent = self.parents.get((channel_id, thread_ts))
+            if parent is None:
+                parent = self.slack_to_zulip_markup(
+                    self.slack.fetch_message(channel_id, thread_ts)['text'])
+            return self.threads.assign(channel_id, thread_ts, stream, parent)
+        except Exception:
+            LOGGER.exception('Failed to find a topic for thread %r', thread_ts)
+            return DEFAULT_TOPIC
 
     def zulip__stream(self, msg):
         if msg['op'] != 'create':
@@ -134,9 +418,17 @@ class PublicTranslator(SlackStateMixin):
 
 
 class PrivateTranslator(SlackStateMixin):
-    def __init__(self, email):
+    backfill_sources = ('zulip',)
+
+    def __init__(self, email, dedup=None, threads=None, correlation=None,
+                 files=None):
         super(PrivateTranslator, self).__init__()
         self.email = email
+        self.dedup = dedup or DedupCache()
+        self.threads = threads or ThreadStore()
+        # The slack copies of the zulip messages this mirror posted.
+        self.correlation = correlation or CorrelationIndex(email)
+        self.files = files or FileTransfers()
 
     def zulip_init(self):
         for subscription in self.zulip.list_subscriptions():
@@ -147,22 +439,141 @@ class PrivateTranslator(SlackStateMixin):
 
     def zulip__message(self, msg):
         zulip_msg = msg['message']
+        # The queue narrow leaves only our own messages; these checks are
+        # for servers that ignore it.
         if zulip_msg['sender_email'] != self.email:
+            DROPPED.labels('zulip', 'sender').inc()
             return
+        self.watermarks.advance('zulip', 'messages', zulip_msg['id'])
         # This is how we prevent loops :(
-        if zulip_msg['client'] == 'JabberMirror':
+        if zulip_msg['client'] == MIRROR_CLIENT:
+            DROPPED.labels('zulip', 'client').inc()
             return
+        # A narrow can only name one stream, so /slack is checked here.
         if not isinstance(zulip_msg['display_recipient'], basestring):
+            DROPPED.labels('zulip', 'recipient').inc()
             return
         if not zulip_msg['display_recipient'].endswith('/slack'):
+            DROPPED.labels('zulip', 'recipient').inc()
+            return
+
+        channel_id = self.zulip_stream_to_slack_channel_id(
+            zulip_msg['display_recipient'])
+        if channel_id is None:
+            LOGGER.warning(
+                'No slack channel for %r', zulip_msg['display_recipient'])
+            DROPPED.labels('zulip', 'channel').inc()
             return
 
+        uploads = UPLOAD_RE.findall(zulip_msg['content'])
+        text = self._slack_text(zulip_msg['content'])
+        # Fingerprint what will come back from slack, not what was sent.
+        self.dedup.add(fingerprint(
+            self.email,
+            zulip_msg['display_recipient'],
+            text,
+        ))
         slack_message = {
-            'text': zulip_msg['content'],
-            'channel': self.zulip_stream_to_slack_channel_id(zulip_msg['display_recipient']),
+            'text': text,
+            'channel': channel_id,
             'as_user': True,
         }
-        self.slack.send_message(slack_message)
+        thread = self._thread(
+            zulip_msg['display_recipient'], zulip_msg.get('subject'))
+        if thread is not None and thread[0] == slack_message['channel']:
+            slack_message['thread_ts'] = thread[1]
+        self.slack.send_message(
+            slack_message, zulip_msg.get('timestamp'), zulip_msg['id'],
+            zulip_msg['display_recipient'])
+        if uploads:
+            self.files.put(
+                self._copy_uploads,
+                slack_message,
+                zulip_msg['display_recipient'],
+                uploads,
+            )
+
+    def _slack_text(self, content):
+        """ ``content`` as slack markup, linking to its uploads in full;
+        those links still work for anyone logged in to zulip, should
+        copying the files fail. """
+        content = UPLOAD_RE.sub(
+            lambda m: u'[{}]({})'.format(
+                m.group(1), self.zulip.upload_url(m.group(2))),
+            content,
+        )
+        return self.zulip_to_slack_markup(content)
+
+    def _copy_uploads(self, slack_message, stream, uploads):
+        for label, path in uploads:
+            try:
+                self._copy_upload(slack_message, stream, label, path)
+            except FileTooLarge as e:
+                LOGGER.info('Not copying %r, %d bytes is too large',
+                            path, e.size)
+            except Exception:
+                LOGGER.exception('Failed to copy zulip upload %r', path)
+
+    def _copy_upload(self, slack_message, stream, label, path):
+        name = label or path.rsplit('/', 1)[-1]
+
+        def upload(fileobj, size):
+            # Shared without a comment, it comes back with empty text.
+            self.dedup.add(fingerprint(self.email, stream, u''))
+            return self.slack.upload_file(
+                fileobj,
+                size,
+                name,
+                mimetypes.guess_type(name)[0],
+                slack_message['channel'],
+                slack_message.get('thread_ts'),
+            )
+
+        permalink, cached = self.files.copy(
+            'zulip_to_slack',
+            ('slack', self.slack_state.team_id),
+            path,
+            lambda: self.zulip.download_file(path),
+            upload,
+        )
+        if cached:
+            # Already on slack, where linking to it shows it again.
+            self.dedup.add(fingerprint(self.email, stream, permalink))
+            self.slack.send_message(
+                dict(slack_message, text=permalink), stream=stream)
+
+    def zulip__update_message(self, msg):
+        if 'content' not in msg:
+            return  # Only the topic was changed
+        slack = self.correlation.slack(msg['message_id'])
+        if slack is None:
+            DROPPED.labels('zulip', 'uncorrelated').inc()
+            return
+        channel_id, ts = slack
+        self.slack.update_message(
+            channel_id, ts, self._slack_text(msg['content']))
+
+    def zulip__delete_message(self, msg):
+        # Newer servers batch deletes into ``message_ids``.
+        for zulip_id in msg.get('message_ids') or [msg['message_id']]:
+            slack = self.correlation.slack(zulip_id)
+            if slack is None:
+                DROPPED.labels('zulip', 'uncorrelated').inc()
+                continue
+            self.correlation.forget(zulip_id)
+            self.slack.delete_message(*slack)
+
+    def _thread(self, stream, topic):
+        if not topic or topic == DEFAULT_TOPIC:
+            return None
+        try:
+            return self.threads.thread(stream, topic)
+        except Exception:
+            LOGGER.exception('Failed to look up topic %r', topic)
+            return None
+
+    def zulip_narrow(self):
+        return [['sender', self.email]]
 
     def zulip__subscription(self, msg):
         if msg['op'] == 'add':
@@ -177,39 +588,262 @@ class PrivateTranslator(SlackStateMixin):
                 if not name.endswith('/slack'):
                     continue
                 channel_id = self.zulip_stream_to_slack_channel_id(name)
-                self.slack.leave_channel(channel_id)
+                if channel_id is not None:
+                    self.slack.leave_channel(channel_id)
+
+
+def _zulip_transient(ret):
+    """ Whether a failed zulip call may work if made again. """
+    if ret.get('result') in ('connection-error', 'unexpected-error'):
+        return True
+    return (
+        ret.get('result') == 'http-error' and
+        str(ret.get('status_code')).startswith('5')
+    )
+
+
+# Errors that no amount of reconnecting will fix.
+FATAL_ZULIP_ERRORS = frozenset([
+    'INVALID_API_KEY',
+    'UNAUTHORIZED',
+    'USER_DEACTIVATED',
+    'REALM_DEACTIVATED',
+])
+FATAL_SLACK_ERRORS = frozenset([
+    'account_inactive',
+    'invalid_auth',
+    'not_authed',
+    'token_revoked',
+])
 
 
 class Zulip(object):
-    def __init__(self, translator, zulip_client):
+    def __init__(self, translator, zulip_client, on_failure=None,
+                 outbound=None, outbox=None, backfill_limit=1000,
+                 reconnector=None):
         self.translator = translator
         self.zulip_client = zulip_client
+        self.on_failure = on_failure
+        self.stopped = False
+        self.outbound = outbound or SendQueue('zulip')
+        self.outbound.on_drop = self._dropped
+        self.outbox = outbox or NullOutbox()
+        self.dispatcher = Dispatcher(translator, 'zulip', subtype_key=None)
+        self.dispatch_lock = threading.Lock()
+        self.backfill_limit = backfill_limit
+        self.reconnector = reconnector or Reconnector('zulip')
+        self.initialized = False
+        self.queue_id = None
+        self.last_event_id = None
+
+    def _fail(self):
+        if self.on_failure is None:
+            os._exit(1)
+        self.on_failure()
 
     def process_event(self, event):
-        callback_name = 'zulip__' + event['type']
-        LOGGER.debug('zulip dispatch: %r', callback_name)
-        callback = getattr(self.translator, callback_name, None)
-        LOGGER.debug('zulip callback: %r', callback)
-        if callback:
-            callback(event)
+        with self.dispatch_lock:
+            self.dispatcher.dispatch(event)
+
+    def _register(self):
+        # Only ask for the events we have handlers for, and only the
+        # messages the translator wants, so the rest never reach us.
+        ret = self.zulip_client.register(
+            event_types=sorted(self.dispatcher.types),
+            narrow=self.translator.zulip_narrow(),
+        )
+        if ret.get('code') in FATAL_ZULIP_ERRORS:
+            raise FatalError('Failed to register zulip queue: %r' % ret)
+        if ret.get('result') != 'success':
+            raise Exception('Failed to register zulip queue: %r' % ret)
+        if ('zulip' in self.translator.backfill_sources and
+                ret.get('max_message_id') is not None):
+            thread = threading.Thread(
+                name='zulip_backfill',
+                target=self.backfill,
+                args=(ret['max_message_id'],),
+            )
+            thread.daemon = True
+            thread.start()
+        return ret['queue_id'], ret['last_event_id']
+
+    def backfill(self, until_id):
+        """ Replays messages between our high-water mark and ``until_id``,
+        the newest message before the new event queue was registered. """
+        anchor = self.translator.watermarks.get('zulip').get('messages')
+        if anchor is None:
+            return
+        anchor = int(anchor)
+        count = 0
+        while anchor < until_id and count < self.backfill_limit:
+            ret = self.zulip_client.get_messages({
+                'anchor': anchor,
+                'num_before': 0,
+                'num_after': 100,
+                'narrow': self.translator.zulip_narrow(),
+                'apply_markdown': False,
+            })
+            if ret.get('result') != 'success':
+                LOGGER.error('Failed to fetch zulip backfill: %r', ret)
+                return
+            messages = [
+                m for m in ret['messages'] if anchor < m['id'] <= until_id
+            ]
+            if not messages:
+                return
+            LOGGER.info('Backfilling %d zulip messages', len(messages))
+            # The dedup cache has long forgotten what mirrors posted then.
+            posted = self.outbox.posted('zulip', [m['id'] for m in messages])
+            for message in messages:
+                if self.stopped:
+                    return
+                if str(message['id']) in posted:
+                    DROPPED.labels('zulip', 'echo').inc()
+                    continue
+                try:
+                    self.process_event({'type': 'message', 'message': message})
+                except Exception:
+                    LOGGER.exception(
+                        'Failed to backfill zulip message %r', message['id'])
+            anchor = messages[-1]['id']
+            count += len(messages)
+
+    def _event_loop(self):
+        # call_on_each_event never returns, so poll the queue ourselves to be
+        # able to stop a single mirror inside a shared process. The queue
+        # outlives a dropped connection, so keep polling it after one.
+        if not self.initialized:
+            self.translator.zulip_init()
+            self.initialized = True
+        while not self.stopped:
+            if self.queue_id is None:
+                self.queue_id, self.last_event_id = self._register()
+            ret = self.zulip_client.get_events(
+                queue_id=self.queue_id,
+                last_event_id=self.last_event_id,
+            )
+            received = time.time()
+            if ret.get('result') != 'success':
+                if ret.get('code') == 'BAD_EVENT_QUEUE_ID':
+                    LOGGER.info('zulip queue %r expired', self.queue_id)
+                    self.queue_id = None
+                    continue
+                raise Exception('Failed to get zulip events: %r' % ret)
+            self.reconnector.connected()
+            for event in ret['events']:
+                self.last_event_id = max(self.last_event_id, int(event['id']))
+                if self.stopped:
+                    return
+                # Timed from the batch's arrival, which the client decoded.
+                trace = tracing.begin('zulip_to_slack', received)
+                try:
+                    self.process_event(event)
+                finally:
+                    tracing.end(trace)
+            # The next get_events acknowledges these events, so whatever they
+            # queued for slack has to be in the outbox first.
+            self.outbox.sync()
 
     def run_forever(self):
-        self.translator.zulip_init()
         try:
-            self.zulip_client.call_on_each_event(self.process_event)
-        except:
-            LOGGER.exception('zulip run_forever failed')
-            os._exit(1)
-        LOGGER.error('zulip run_forever stopped')
-        os._exit(1)
+            self.reconnector.run(self._event_loop, lambda: self.stopped)
+        except FatalError:
+            LOGGER.exception('zulip connection failed for good')
+            self._fail()
+
+    def stop(self):
+        self.stopped = True
+        self.reconnector.stop()
+        self.outbound.stop()
+
+    def send_message(self, msg, callback=None, source_time=None):
+        outbox_id = self.outbox.record('zulip', msg)
+        trace = tracing.current()
+        if trace is not None:
+            trace.mark('translate')
+        self.outbound.put(
+            self._send_message, msg, callback, outbox_id, source_time, trace)
+
+    def replay(self):
+        for outbox_id, msg in self.outbox.pending('zulip'):
+            LOGGER.info('Replaying zulip message %r', outbox_id)
+            self.outbound.put(self._send_message, msg, None, outbox_id)
+
+    def _dropped(self, func, args):
+        # Replaying it once the queue drains would post it late.
+        if func == self._send_message:
+            self.outbox.delivered([args[2]])
+
+    def join_stream(self, stream_name):
+        self.outbound.put(self._join_stream, stream_name)
+
+    def upload_url(self, path):
+        return urljoin(self.zulip_client.base_url, path)
+
+    def download_file(self, path):
+        """ A streamed response for an uploaded file. """
+        self.zulip_client.ensure_session()
+        return self.zulip_client.session.get(
+            self.upload_url(path), stream=True)
+
+    def upload_file(self, fileobj, size, name, content_type=None):
+        """ Uploads ``size`` bytes of ``fileobj``; returns their path. """
+        LOGGER.debug('Uploading %r to zulip', name)
+        self.zulip_client.ensure_session()
+        body = MultipartFile(fileobj, size, name, content_type=content_type)
+        ret = self.zulip_client.session.post(
+            urljoin(self.zulip_client.base_url, 'v1/user_uploads'),
+            data=body,
+            headers={'Content-Type': body.content_type},
+        ).json()
+        if ret.get("result") != "success":
+            raise Exception('Failed to upload zulip file: %r' % ret)
+        return ret['uri']
+
+    def update_message(self, msg):
+        self.outbound.put(self._update_message, msg)
+
+    def delete_message(self, message_id):
+        self.outbound.put(self._delete_message, message_id)
 
-    def send_message(self, msg):
+    def _send_message(self, msg, callback=None, outbox_id=None,
+                      source_time=None, trace=None):
         LOGGER.debug('Sending message to zulip: %r', msg)
+        if trace is not None:
+            trace.mark('queue')
+        started = time.time()
         ret = self.zulip_client.send_message(msg)
+        now = time.time()
+        SEND_LATENCY.labels('zulip').observe(now - started)
+        if trace is not None:
+            trace.mark('send')
         if ret.get("result") != "success":
             LOGGER.error('Failed to send zulip message %r', ret)
+            if not _zulip_transient(ret):
+                # Replaying it would only fail the same way.
+                self.outbox.delivered([outbox_id])
+            return
+        self.outbox.delivered([outbox_id])
+        self.outbox.add_posted('zulip', ret['id'])
+        MIRRORED.labels('slack_to_zulip').inc()
+        if source_time is not None:
+            MIRROR_LATENCY.labels('slack_to_zulip').observe(now - source_time)
+        if callback is not None:
+            callback(ret)
 
-    def join_stream(self, stream_name):
+    def _update_message(self, msg):
+        LOGGER.debug('Updating zulip message %r', msg)
+        ret = self.zulip_client.update_message(msg)
+        if ret.get("result") != "success":
+            LOGGER.error('Failed to update zulip message %r', ret)
+
+    def _delete_message(self, message_id):
+        LOGGER.debug('Deleting zulip message %r', message_id)
+        ret = self.zulip_client.delete_message(message_id)
+        if ret.get("result") != "success":
+            LOGGER.error('Failed to delete zulip message %r', ret)
+
+    def _join_stream(self, stream_name):
         LOGGER.debug('Joining zulip stream %r', stream_name)
         ret = self.zulip_client.add_subscriptions([{'name': stream_name}])
         if ret.get("result") != "success":
@@ -224,66 +858,364 @@ class Zulip(object):
 
 
 class Slack(object):
-    def __init__(self, translator, slack_api):
+    def __init__(self, translator, slack_api, on_failure=None, outbound=None,
+                 scheduler=None, outbox=None, bootstrap='connect',
+                 state_cache_dir=None, state_max_age=3600, page_size=200,
+                 backfill_concurrency=4, backfill_limit=1000,
+                 reconnector=None, shared=False):
         self.translator = translator
         self.slack_api = slack_api
+        self.on_failure = on_failure
+        self.stopped = False
+        self.ws = None
+        self.outbound = outbound or SendQueue('slack')
+        self.outbound.on_drop = self._dropped
+        self.scheduler = scheduler or SlackScheduler()
+        self.outbox = outbox or NullOutbox()
+        self.bootstrap = bootstrap
+        self.state_cache_dir = state_cache_dir
+        self.state_max_age = state_max_age
+        self.page_size = page_size
+        self.dispatcher = Dispatcher(translator, 'slack')
+        self.dispatch_lock = threading.Lock()
+        self.backfill_concurrency = backfill_concurrency
+        self.backfill_limit = backfill_limit
+        self.reconnector = reconnector or Reconnector('slack')
+        self.connected_once = False
+        self.shared = shared
+        self.team_id = None
+        self.prefiltered = DROPPED.labels('slack', 'prefilter')
+        self.done = threading.Event()
 
-    def _noop(self, msg):
-        pass
-
-    def _dispatch(self, callback_name, msg):
-        callback_name = '__'.join(callback_name)
-        LOGGER.debug('slack dispatch: %r', callback_name)
-        callback = getattr(self.translator, callback_name, None)
-        LOGGER.debug('slack callback: %r', callback)
-        if callback:
-            try:
-                callback(msg)
-            except:
-                LOGGER.exception('Failed to call %r', callback_name)
-                raise
-            return True
-        else:
-            return False
+    def _fail(self):
+        if self.on_failure is None:
+            os._exit(1)
+        self.on_failure()
 
     def on_message(self, ws, raw_msg):
-        msg = json.loads(raw_msg)
+        if jsoncodec.prefilter and not self.dispatcher.wants(raw_msg):
+            self.prefiltered.inc()
+            return
+        trace = tracing.begin('slack_to_zulip')
+        msg = jsoncodec.loads(raw_msg)
+        if trace is not None:
+            trace.mark('decode')
+        try:
+            self.receive(msg)
+        finally:
+            tracing.end(trace)
+
+    def receive(self, msg):
+        with self.dispatch_lock:
+            self.dispatcher.dispatch(msg)
 
-        callback_name = ['slack']
-        callback_name.append(msg['type'])
-        subtype = msg.get('subtype')
-        if subtype:
-            callback_name.append(subtype)
+    def on_open(self, ws):
+        self.reconnector.connected()
+        if 'slack' not in self.translator.backfill_sources:
+            return
+        # Everything after this is delivered on the new socket.
+        thread = threading.Thread(
+            name='slack_backfill',
+            target=self.backfill,
+            args=('%.6f' % time.time(),),
+        )
+        thread.daemon = True
+        thread.start()
+
+    def backfill(self, until_ts):
+        marks = self.translator.watermarks.get('slack')
+        run_limited(
+            lambda item: self._backfill_channel(item[0], item[1], until_ts),
+            list(marks.items()),
+            self.backfill_concurrency,
+        )
 
-        success = self._dispatch(callback_name, msg)
-        if not success and subtype:
-            callback_name.pop()
-            self._dispatch(callback_name, msg)
+    def _backfill_channel(self, channel_id, oldest, latest):
+        messages = []
+        while len(messages) < self.backfill_limit:
+            ret = self._call(
+                'channels.history',
+                channel=channel_id,
+                oldest=oldest,
+                latest=latest,
+                count=self.page_size,
+            )
+            messages.extend(ret['messages'])
+            if not ret.get('has_more') or not ret['messages']:
+                break
+            # Pages come newest first.
+            latest = ret['messages'][-1]['ts']
+        if not messages:
+            return
+        LOGGER.info(
+            'Backfilling %d slack messages in %r', len(messages), channel_id)
+        messages.sort(key=lambda m: ts_key(m['ts']))
+        # The dedup cache has long forgotten what mirrors posted then.
+        posted = self.outbox.posted(
+            'slack', [posted_key(channel_id, m['ts']) for m in messages])
+        for msg in messages:
+            if self.stopped:
+                return
+            if posted_key(channel_id, msg['ts']) in posted:
+                DROPPED.labels('slack', 'echo').inc()
+                continue
+            msg.setdefault('type', 'message')
+            msg.setdefault('channel', channel_id)
+            try:
+                with self.dispatch_lock:
+                    self.dispatcher.dispatch(msg)
+            except Exception:
+                LOGGER.exception(
+                    'Failed to backfill slack message %r in %r',
+                    msg['ts'], channel_id)
 
     def on_error(self, ws, error):
+        if self.stopped:
+            return
         LOGGER.error('Websocket error: %r', error)
-        os._exit(1)
 
     def on_close(self, ws):
+        if self.stopped:
+            return
         LOGGER.error('Websocket closed')
-        os._exit(1)
 
-    def run_forever(self):
-        rtm = self.slack_api.get('https://slack.com/api/rtm.start').json()
+    def _check_rtm(self, rtm):
+        if rtm.get('error') in FATAL_SLACK_ERRORS:
+            raise FatalError('Failed to get RTM data: %r' % rtm)
         if not rtm['ok']:
             raise Exception('Failed to get RTM data: %r' % rtm)
+
+    def _rtm_start(self):
+        rtm = self.slack_api.get('https://slack.com/api/rtm.start').json()
+        self._check_rtm(rtm)
         self.translator.slack_init(rtm['users'], rtm['channels'], rtm['team'])
-        ws = websocket.WebSocketApp(
+        return rtm
+
+    def _rtm_connect(self):
+        # rtm.connect only returns the websocket url, so the team state comes
+        # from the on-disk cache and is refreshed after the socket is open.
+        rtm = self.slack_api.get('https://slack.com/api/rtm.connect').json()
+        self._check_rtm(rtm)
+        state = get_team_state(rtm['team']['id'])
+        if self.state_cache_dir:
+            state.load_cache(self._state_cache_path(state))
+        if state.email_domain is None:
+            team = self._call('team.info')['team']
+            state.email_domain = team['email_domain']
+        self.translator.slack_set_state(state)
+
+        thread = threading.Thread(
+            name='slack_refresh',
+            target=self.refresh_team_state,
+            args=(state,),
+        )
+        thread.daemon = True
+        thread.start()
+        return rtm
+
+    def _state_cache_path(self, state):
+        return os.path.join(
+            self.state_cache_dir, '{}.json'.format(state.team_id))
+
+    def _call(self, method, **params):
+        ret = self.slack_api.get(
+            'https://slack.com/api/' + method,
+            params=params,
+        ).json()
+        if not ret['ok']:
+            raise Exception('Failed to call %s: %r' % (method, ret))
+        return ret
+
+    def _paginate(self, method, key, **params):
+        params['limit'] = self.page_size
+        while True:
+            ret = self._call(method, **params)
+            yield ret[key]
+            cursor = ret.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return
+            params['cursor'] = cursor
+
+    def refresh_team_state(self, state):
+        """ Reloads users and channels page by page into ``state``.
+
+        Only one mirror per team refreshes at a time, and not at all while
+        the state is younger than ``state_max_age``.
+        """
+        if not state.refresh_lock.acquire(False):
+            return
+        try:
+            if state.fresh(self.state_max_age):
+                return
+            LOGGER.info('Refreshing slack team state for %r', state.team_id)
+            team = self._call('team.info')['team']
+            state.email_domain = team['email_domain']
+            user_ids = []
+            for users in self._paginate('users.list', 'members'):
+                for user in users:
+                    user_ids.append(state.set_user(user).id)
+            channel_ids = []
+            for channels in self._paginate(
+                    'channels.list', 'channels', exclude_members='true'):
+                for channel in channels:
+                    channel_ids.append(state.set_channel(channel).id)
+            state.prune(user_ids, channel_ids)
+            if self.state_cache_dir:
+                state.save(self._state_cache_path(state))
+        except Exception:
+            LOGGER.exception('Failed to refresh slack team state')
+        finally:
+            state.ready.set()
+            state.refresh_lock.release()
+
+    def _connect(self):
+        # The team state from the first connection is still in memory, so
+        # reconnects only need the websocket url.
+        if self.bootstrap == 'start' and not self.connected_once:
+            rtm = self._rtm_start()
+        else:
+            rtm = self._rtm_connect()
+        self.connected_once = True
+        self.ws = websocket.WebSocketApp(
             rtm['url'],
+            on_open=self.on_open,
             on_message=self.on_message,
             on_error=self.on_error,
             on_close=self.on_close,
         )
-        ws.run_forever(ping_interval=5, ping_timeout=5)
-        LOGGER.error('slack run_forever stopped')
-        os._exit(1)
+        self.ws.run_forever(ping_interval=5, ping_timeout=4)
+
+    def _share(self):
+        """ Follows the team's ``TeamFeed`` instead of opening a socket. """
+        if self.team_id is None:
+            ret = self.slack_api.get('https://slack.com/api/auth.test').json()
+            self._check_rtm(ret)
+            self.team_id = ret['team_id']
+        feed = get_team_feed(self)
+        feed.subscribe(self, self.translator.feed_channels)
+        try:
+            self.done.wait()
+        finally:
+            feed.unsubscribe(self)
+
+    def run_forever(self):
+        connect = self._share if self.shared else self._connect
+        try:
+            self.reconnector.run(connect, lambda: self.stopped)
+        except FatalError:
+            LOGGER.exception('slack connection failed for good')
+            self._fail()
+
+    def stop(self):
+        self.stopped = True
+        self.done.set()
+        self.reconnector.stop()
+        self.outbound.stop()
+        if self.ws is not None:
+            self.ws.close()
 
     def join_channel(self, name):
+        self.outbound.put(self._join_channel, name)
+
+    def leave_channel(self, channel_id):
+        self.outbound.put(self._leave_channel, channel_id)
+
+    def send_message(self, msg, source_time=None, source_id=None,
+                     stream=None):
+        """ Posts ``msg``, mirrored from the zulip ``stream``, whose echo
+        the translator has fingerprinted. """
+        outbox_id = self.outbox.record(
+            'slack', {'msg': msg, 'stream': stream})
+        trace = tracing.current()
+        if trace is not None:
+            trace.mark('translate')
+        self.scheduler.put(
+            self, msg, outbox_id, source_time, source_id, trace)
+
+    def update_message(self, channel_id, ts, text):
+        self.outbound.put(self._update_message, channel_id, ts, text)
+
+    def delete_message(self, channel_id, ts):
+        self.outbound.put(self._delete_message, channel_id, ts)
+
+    def replay(self):
+        for outbox_id, payload in self.outbox.pending('slack'):
+            LOGGER.info('Replaying slack message %r', outbox_id)
+            msg = payload['msg']
+            if payload['stream'] is not None:
+                # The echo's fingerprint went with the process that sent it.
+                self.translator.dedup.add(fingerprint(
+                    self.translator.email, payload['stream'], msg['text']))
+            self.scheduler.put(self, msg, outbox_id)
+
+    def _dropped(self, func, args):
+        # Replaying it once the queue drains would post it late.
+        if func == self.scheduler.post:
+            self.outbox.delivered(args[0].outbox_ids)
+
+    def fetch_channel(self, channel_id):
+        LOGGER.debug('Fetching slack channel %r', channel_id)
+        ret = self.slack_api.get(
+            'https://slack.com/api/channels.info',
+            params={'channel': channel_id},
+        ).json()
+        if not ret['ok']:
+            raise KeyError(channel_id)
+        return ret['channel']
+
+    def fetch_message(self, channel_id, ts):
+        LOGGER.debug('Fetching slack message %r in %r', ts, channel_id)
+        return self._call(
+            'channels.history',
+            channel=channel_id,
+            latest=ts,
+            inclusive='true',
+            count=1,
+        )['messages'][0]
+
+    def download_file(self, slack_file):
+        """ A streamed response for a shared file. """
+        url = slack_file.get('url_private_download') or \
+            slack_file['url_private']
+        return self.slack_api.get(
+            url,
+            headers={
+                'Authorization': 'Bearer {}'.format(
+                    self.slack_api.params['token']),
+            },
+            stream=True,
+        )
+
+    def upload_file(self, fileobj, size, name, content_type, channel_id,
+                    thread_ts=None):
+        """ Shares ``size`` bytes of ``fileobj`` to a channel; returns the
+        file's permalink. """
+        LOGGER.debug('Uploading %r to slack channel %r', name, channel_id)
+        fields = [('channels', channel_id), ('filename', name)]
+        if thread_ts is not None:
+            fields.append(('thread_ts', thread_ts))
+        body = MultipartFile(
+            fileobj, size, name, fields, content_type=content_type)
+        ret = self.slack_api.post(
+            'https://slack.com/api/files.upload',
+            data=body,
+            headers={'Content-Type': body.content_type},
+        ).json()
+        if not ret['ok']:
+            raise Exception('Failed to upload file: %r' % ret)
+        return ret['file']['permalink']
+
+    def fetch_user(self, user_id):
+        LOGGER.debug('Fetching slack user %r', user_id)
+        ret = self.slack_api.get(
+            'https://slack.com/api/users.info',
+            params={'user': user_id},
+        ).json()
+        if not ret['ok']:
+            raise KeyError(user_id)
+        return ret['user']
+
+    def _join_channel(self, name):
         LOGGER.debug('Joining slack channel %r', name)
         ret = self.slack_api.post(
             'https://slack.com/api/channels.join',
@@ -292,7 +1224,7 @@ class Slack(object):
         if not ret['ok']:
             raise Exception('Failed to join channe: %r' % ret)
 
-    def leave_channel(self, channel_id):
+    def _leave_channel(self, channel_id):
         LOGGER.debug('Leaving slack channel %r', channel_id)
         ret = self.slack_api.post(
             'https://slack.com/api/channels.leave',
@@ -301,59 +1233,401 @@ class Slack(object):
         if not ret['ok']:
             raise Exception('Failed to join channe: %r' % ret)
 
-    def send_message(self, msg):
-        LOGGER.debug('Sending slack message %r', msg)
+    def _update_message(self, channel_id, ts, text):
+        LOGGER.debug('Updating slack message %r in %r', ts, channel_id)
+        ret = self.slack_api.post(
+            'https://slack.com/api/chat.update',
+            data={'channel': channel_id, 'ts': ts, 'text': text,
+                  'as_user': True},
+        ).json()
+        if not ret['ok']:
+            raise Exception('Failed to update message: %r' % ret)
+
+    def _delete_message(self, channel_id, ts):
+        LOGGER.debug('Deleting slack message %r in %r', ts, channel_id)
         ret = self.slack_api.post(
+            'https://slack.com/api/chat.delete',
+            data={'channel': channel_id, 'ts': ts, 'as_user': True},
+        ).json()
+        if not ret['ok']:
+            raise Exception('Failed to delete message: %r' % ret)
+
+    def _send_message(self, msg, outbox_ids=(), source_time=None,
+                      source_ids=(), traces=()):
+        LOGGER.debug('Sending slack message %r', msg)
+        for trace in traces:
+            trace.mark('queue')
+        if len(outbox_ids) > 1:
+            # A merged post echoes back with text none of its messages had.
+            self.translator.dedup.add(fingerprint(
+                self.translator.email,
+                self.translator.slack_channel_id_to_zulip_stream(
+                    msg['channel']),
+                msg['text'],
+            ))
+        started = time.time()
+        response = self.slack_api.post(
             'https://slack.com/api/chat.postMessage',
             data=msg
-        ).json()
+        )
+        now = time.time()
+        SEND_LATENCY.labels('slack').observe(now - started)
+        for trace in traces:
+            trace.mark('send')
+        ret = response.json()
+        if ret.get('error') == 'ratelimited':
+            raise RateLimited(float(response.headers.get('Retry-After', 1)))
+        self.outbox.delivered(outbox_ids)
         if not ret['ok']:
-            raise Exception('Failed to send message: %r', ret)
+            raise Exception('Failed to send message: %r' % ret)
+        self.translator.dedup.add(('slack', ret['channel'], ret['ts']))
+        self.outbox.add_posted('slack', posted_key(ret['channel'], ret['ts']))
+        if len(source_ids) == 1:
+            # A merged post has no single message to edit or delete.
+            self.translator.correlation.add(
+                ret['channel'], ret['ts'], source_ids[0])
+        # Coalesced posts carry one outbox id per original message.
+        MIRRORED.labels('zulip_to_slack').inc(len(outbox_ids) or 1)
+        if source_time is not None:
+            MIRROR_LATENCY.labels('zulip_to_slack').observe(now - source_time)
 
 
-def main(config_uri, email, public):
-    pyramid.paster.setup_logging(config_uri)
-    settings = pyramid.paster.get_appsettings(config_uri)
-    sessionmaker = slack_mirror.get_sessionmaker(settings)
-    db = sessionmaker()
+# Events that only update the team state, which a feed applies once.
+STATE_EVENTS = get_handler_map(SlackStateMixin, 'slack').types
 
-    with transaction.manager:
-        user = db.query(User).filter(User.email == email).one()
-        if public:
-            translator = PublicTranslator()
+
+class TeamFeed(SlackStateMixin):
+    """ One RTM connection shared by every public mirror of a Slack team.
+
+    Each frame is decoded once and team state events are applied once;
+    everything else is handed to the subscribed ``Slack`` objects, all of
+    them for events without a channel and otherwise those following that
+    channel. Subscribers must treat the event dicts as read only, since
+    they are shared.
+
+    A user token's stream only carries that user's channels, so the
+    connection uses the token of the oldest subscriber that follows every
+    channel, and only falls back to a private mirror's token while there
+    is none. If that token stops working, the next subscriber takes over.
+    """
+
+    def __init__(self, team_id, connection_factory):
+        super(TeamFeed, self).__init__()
+        self.team_id = team_id
+        self.slack_state = get_team_state(team_id)
+        self.connection_factory = connection_factory
+        self.connection = None
+        self.owner = None
+        self.owner_sees_all = False
+        self.subscribers = ()
+        self.everything = ()
+        self.by_channel = {}
+        self.dispatchers = ()
+        self.open = False
+        self.running = False
+        self.lock = threading.Lock()
+
+    def subscribe(self, slack, channels=None):
+        """ Starts feeding ``slack``, with every channel or only those in
+        ``channels``. """
+        slack.translator.slack_set_state(self.slack_state)
+        with self.lock:
+            self._update(self.subscribers + ((slack, channels),))
+            if not self.running:
+                self.running = True
+                thread = threading.Thread(
+                    name='slack_team:{}'.format(self.team_id),
+                    target=self.run,
+                )
+                thread.daemon = True
+                thread.start()
+            is_open = self.open
+        if is_open:
+            slack.on_open(None)
+
+    def unsubscribe(self, slack):
+        with self.lock:
+            self._update(tuple(
+                (s, channels) for s, channels in self.subscribers
+                if s is not slack
+            ))
+            if not self.subscribers and self.connection is not None:
+                self.connection.reconnector.wakeup.set()
+                if self.connection.ws is not None:
+                    self.connection.ws.close()
+
+    def _update(self, subscribers):
+        # Readers on the socket thread never lock, so these are replaced
+        # rather than changed in place.
+        everything = []
+        by_channel = {}
+        dispatchers = {}
+        for slack, channels in subscribers:
+            dispatchers.setdefault(type(slack.translator), slack.dispatcher)
+            if channels is None:
+                everything.append(slack)
+            else:
+                for channel in channels:
+                    by_channel.setdefault(channel, []).append(slack)
+        self.subscribers = subscribers
+        self.everything = tuple(everything)
+        self.by_channel = by_channel
+        self.dispatchers = tuple(dispatchers.values())
+        self._pick_owner()
+
+    def _pick_owner(self):
+        # Called with the lock held.
+        candidates = self.everything or [s for s, _ in self.subscribers]
+        if self.owner not in candidates:
+            self.owner = candidates[0] if candidates else None
+        sees_all = bool(self.everything)
+        upgraded = sees_all and not self.owner_sees_all
+        self.owner_sees_all = sees_all
+        if self.owner is None or self.connection is None:
+            return
+        self.connection.slack_api = self.owner.slack_api
+        if upgraded and self.connection.ws is not None:
+            # Reconnect with a token that streams every channel.
+            self.connection.ws.close()
+
+    def wants(self, raw_msg):
+        return (
+            self.connection.dispatcher.wants(raw_msg) or
+            any(d.wants(raw_msg) for d in self.dispatchers)
+        )
+
+    def publish(self, msg):
+        if msg.get('type') in STATE_EVENTS:
+            with self.connection.dispatch_lock:
+                self.connection.dispatcher.dispatch(msg)
+            return
+        channel = msg.get('channel')
+        if channel is None:
+            targets = [slack for slack, _ in self.subscribers]
         else:
-            translator = PrivateTranslator(user.email)
+            targets = self.everything + tuple(self.by_channel.get(channel, ()))
+        for slack in targets:
+            try:
+                slack.receive(msg)
+            except Exception:
+                pass  # Logged by the dispatcher; the others still get it.
+
+    def opened(self):
+        with self.lock:
+            self.open = True
+            subscribers = self.subscribers
+            if not subscribers:
+                # Everyone left while the socket was connecting.
+                self.connection.ws.close()
+        for slack, _ in subscribers:
+            slack.on_open(None)
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.subscribers:
+                    self.running = False
+                    return
+                if self.connection is None:
+                    self.connection = self.connection_factory(
+                        self, self.owner)
+                self.connection.slack_api = self.owner.slack_api
+                self.connection.reconnector.wakeup.clear()
+            try:
+                self.connection.reconnector.run(
+                    self.connection._connect, lambda: not self.subscribers)
+            except FatalError:
+                owner = self.owner
+                LOGGER.exception(
+                    'Shared slack connection failed for %r', owner.team_id)
+                self.unsubscribe(owner)
+                owner._fail()
+            finally:
+                with self.lock:
+                    self.open = False
+
+
+class TeamSlack(Slack):
+    """ The socket of a ``TeamFeed``. """
+
+    def on_message(self, ws, raw_msg):
+        if jsoncodec.prefilter and not self.translator.wants(raw_msg):
+            self.prefiltered.inc()
+            return
+        trace = tracing.begin('slack_to_zulip')
+        msg = jsoncodec.loads(raw_msg)
+        if trace is not None:
+            trace.mark('decode')
+        try:
+            self.translator.publish(msg)
+        finally:
+            tracing.end(trace)
+
+    def on_open(self, ws):
+        self.reconnector.connected()
+        self.translator.opened()
+
+
+def _team_connection(feed, slack):
+    return TeamSlack(
+        feed,
+        slack.slack_api,
+        bootstrap=slack.bootstrap,
+        state_cache_dir=slack.state_cache_dir,
+        state_max_age=slack.state_max_age,
+        page_size=slack.page_size,
+        reconnector=Reconnector(
+            'slack_team',
+            base=slack.reconnector.base,
+            cap=slack.reconnector.cap,
+        ),
+    )
+
+
+_feeds = weakref.WeakValueDictionary()
+_feeds_lock = threading.Lock()
+
+
+def get_team_feed(slack):
+    with _feeds_lock:
+        feed = _feeds.get(slack.team_id)
+        if feed is None:
+            feed = _feeds[slack.team_id] = TeamFeed(
+                slack.team_id, _team_connection)
+        return feed
+
+
+class Mirror(object):
+    """ One user's translator with its Slack and Zulip connections. """
+
+    def __init__(self, email, translator, slack, zulip):
+        self.email = email
+        self.translator = translator
+        self.slack = slack
+        self.zulip = zulip
+        self.threads = []
+        self.failed = False
+
+    def fail(self):
+        LOGGER.error('Mirror for %r failed', self.email)
+        self.failed = True
+        self.stop()
+
+    def start(self):
+        self.slack.outbound.start('slack_send:' + self.email)
+        self.slack.scheduler.start()
+        self.slack.replay()
+        self.zulip.replay()
+        self.zulip.outbound.start('zulip_send:' + self.email)
+        if self.translator.lookups is not None:
+            self.translator.lookups.start('thread_lookup:' + self.email)
+        for name, target in [
+            ('slack', self.slack.run_forever),
+            ('zulip', self.zulip.run_forever),
+        ]:
+            thread = threading.Thread(
+                name='{}:{}'.format(name, self.email),
+                target=target,
+            )
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        LOGGER.info('Started mirror for %r', self.email)
 
-        slack_api = user.slack_api
-        zulip_api = zulip_client.Client(
-            email=user.email,
-            api_key=user.zulip_key,
+    def stop(self):
+        self.slack.stop()
+        self.zulip.stop()
+        self.translator.files.stop()
+        if self.translator.lookups is not None:
+            self.translator.lookups.stop()
+
+    @property
+    def alive(self):
+        return not self.failed and all(t.is_alive() for t in self.threads)
+
+    def join(self):
+        threads = list(self.threads)
+        while threads:
+            thread = threads[-1]
+            if thread.is_alive():
+                thread.join(1)
+            else:
+                threads.pop()
+
+
+def build_mirror(settings, email, access_token, zulip_key, public,
+                 contained=False, slack_scheduler=None, slack_api=None,
+                 zulip_api=None):
+    dedup = get_dedup_cache(settings)
+    threads = get_thread_store(settings)
+    outbox = get_outbox(settings, email)
+    correlation = get_correlation_index(settings, email)
+    files = FileTransfers.from_settings(settings, 'files:' + email)
+    if public:
+        translator = PublicTranslator(
+            dedup, threads, correlation, files,
+            SendQueue.from_settings(settings, 'thread_lookup'))
+    else:
+        translator = PrivateTranslator(
+            email, dedup, threads, correlation, files)
+    translator.watermarks = Watermarks(outbox)
+    translator.channel_wait = float(settings.get('slack.channel_wait', 10))
+    backfill_limit = int(settings.get('mirror.backfill_limit', 1000))
+
+    if zulip_api is None:
+        zulip_api = PooledZulipClient(
+            email=email,
+            api_key=zulip_key,
             client='JabberMirror/slack',
         )
 
-    slack = translator.slack = Slack(translator, slack_api)
-    zulip = translator.zulip = Zulip(translator, zulip_api)
-
-    threads = []
+    slack = translator.slack = Slack(
+        translator,
+        slack_api or slack_session(access_token),
+        outbound=SendQueue.from_settings(settings, 'slack'),
+        scheduler=slack_scheduler or SlackScheduler.from_settings(settings),
+        outbox=outbox,
+        bootstrap=settings.get('slack.bootstrap', 'connect'),
+        state_cache_dir=settings.get('slack.state_cache_dir'),
+        state_max_age=float(settings.get('slack.state_max_age', 3600)),
+        backfill_concurrency=int(
+            settings.get('mirror.backfill_concurrency', 4)),
+        backfill_limit=backfill_limit,
+        reconnector=Reconnector.from_settings(settings, 'slack'),
+        shared=asbool(settings.get('slack.shared_rtm', False)),
+    )
+    zulip = translator.zulip = Zulip(
+        translator,
+        zulip_api,
+        outbound=SendQueue.from_settings(settings, 'zulip'),
+        outbox=outbox,
+        backfill_limit=backfill_limit,
+        reconnector=Reconnector.from_settings(settings, 'zulip'),
+    )
+    mirror = Mirror(email, translator, slack, zulip)
+    if contained:
+        # A fatal error only takes this mirror down, not the whole process.
+        slack.on_failure = zulip.on_failure = mirror.fail
+    return mirror
 
-    slack_thread = threading.Thread(name='slack_thread', target=slack.run_forever)
-    slack_thread.daemon = True
-    slack_thread.start()
-    threads.append(slack_thread)
 
-    zulip_thread = threading.Thread(name='zulip_thread', target=zulip.run_forever)
-    zulip_thread.daemon = True
-    zulip_thread.start()
-    threads.append(zulip_thread)
+def main(config_uri, email, public):
+    pyramid.paster.setup_logging(config_uri)
+    settings = pyramid.paster.get_appsettings(config_uri)
+    sessions.configure(settings)
+    jsoncodec.configure(settings)
+    tracing.configure(settings)
+    start_exporter(settings)
+    sessionmaker = slack_mirror.get_sessionmaker(settings)
+    db = sessionmaker()
 
-    LOGGER.info('Started mirror for %r', email)
+    with transaction.manager:
+        user = db.query(User).filter(User.email == email).one()
+        mirror = build_mirror(
+            settings, user.email, user.access_token, user.zulip_key, public)
 
-    while threads:
-        thread = threads[-1]
-        if thread.is_alive():
-            thread.join(1)
-        else:
-            threads.pop()
+    mirror.start()
+    mirror.join()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,236 @@
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
+from slack_mirror.markup import LRUCache
+
+try:
+    intern
+except NameError:
+    from sys import intern
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _intern(value):
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        # Python 2 unicode can't be interned, but ids and names are ascii.
+        try:
+            value = str(value)
+        except UnicodeEncodeError:
+            return value
+    return intern(value)
+
+
+class SlackUser(object):
+    __slots__ = ('id', 'name', 'email')
+
+    def __init__(self, id, name, email):
+        self.id = id
+        self.name = name
+        self.email = email
+
+    @classmethod
+    def from_api(cls, user):
+        return cls(
+            _intern(user['id']),
+            _intern(user['name']),
+            user.get('profile', {}).get('email') or None,
+        )
+
+
+class SlackChannel(object):
+    __slots__ = ('id', 'name')
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+    @classmethod
+    def from_api(cls, channel):
+        return cls(_intern(channel['id']), _intern(channel['name']))
+
+
+class TeamState(object):
+    """ The parts of a Slack team the translators need.
+
+    Only ids, names and emails are kept, as ``__slots__`` records with
+    interned strings, instead of the full ``rtm.start`` payload. One
+    instance is shared by every mirror of the same team, see
+    ``get_team_state``.
+
+    ``mentions`` caches what user and channel mentions translate to for
+    ``slack_mirror.markup``; entries go whenever the user or channel
+    behind them changes.
+    """
+
+    def __init__(self, team_id=None):
+        self.team_id = team_id
+        self.email_domain = None
+        self.users = {}
+        self.user_ids = {}
+        self.channels = {}
+        self.channel_ids = {}
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.refreshed_at = None
+        # Set once rtm.start or a refresh has had a go at filling it; a
+        # cached copy may lack channels created since it was saved.
+        self.ready = threading.Event()
+        self.mentions = LRUCache()
+
+    def load(self, users, channels, team):
+        users = [SlackUser.from_api(u) for u in users]
+        channels = [SlackChannel.from_api(c) for c in channels]
+        self._replace(team['email_domain'], users, channels, time.time())
+        self.ready.set()
+
+    def _replace(self, email_domain, users, channels, refreshed_at):
+        with self.lock:
+            self.email_domain = email_domain
+            self.users = {u.id: u for u in users}
+            self.user_ids = {u.name: u.id for u in users}
+            self.channels = {c.id: c for c in channels}
+            self.channel_ids = {c.name: c.id for c in channels}
+            self.refreshed_at = refreshed_at
+        self.mentions.clear()
+
+    def fresh(self, max_age):
+        return (
+            self.refreshed_at is not None and
+            time.time() - self.refreshed_at < max_age
+        )
+
+    def prune(self, user_ids, channel_ids):
+        """ Drops users and channels that a full refresh did not return. """
+        with self.lock:
+            for user_id in set(self.users) - set(user_ids):
+                self._unindex_user(self.users.pop(user_id))
+            for channel_id in set(self.channels) - set(channel_ids):
+                self._unindex_channel(self.channels.pop(channel_id))
+            self.refreshed_at = time.time()
+        self.mentions.clear()
+
+    def save(self, path):
+        with self.lock:
+            data = {
+                'team_id': self.team_id,
+                'email_domain': self.email_domain,
+                'refreshed_at': self.refreshed_at,
+                'users': [
+                    [u.id, u.name, u.email] for u in self.users.values()
+                ],
+                'channels': [
+                    [c.id, c.name] for c in self.channels.values()
+                ],
+            }
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, path)
+
+    def load_cache(self, path):
+        """ Fills an empty state from a file written by ``save``. """
+        if self.refreshed_at is not None or not os.path.exists(path):
+            return False
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            LOGGER.exception('Ignoring bad team state cache %r', path)
+            return False
+        users = [
+            SlackUser(_intern(id), _intern(name), email)
+            for id, name, email in data['users']
+        ]
+        channels = [
+            SlackChannel(_intern(id), _intern(name))
+            for id, name in data['channels']
+        ]
+        self._replace(
+            data['email_domain'], users, channels, data['refreshed_at'])
+        return True
+
+    def set_user(self, user):
+        user = SlackUser.from_api(user)
+        with self.lock:
+            old = self.users.get(user.id)
+            if old is not None:
+                self._unindex_user(old)
+            self.users[user.id] = user
+            self.user_ids[user.name] = user.id
+        self.mentions.pop(('@', user.id))
+        self.mentions.pop(('@name', user.name))
+        return user
+
+    def _unindex_user(self, user):
+        if self.user_ids.get(user.name) == user.id:
+            del self.user_ids[user.name]
+        self.mentions.pop(('@', user.id))
+        self.mentions.pop(('@name', user.name))
+
+    def get_user(self, user_id, fetch=None):
+        """ Returns the user, asking ``fetch(user_id)`` for the raw API
+        record of users we have not seen yet. """
+        user = self.users.get(user_id)
+        if user is None:
+            if fetch is None:
+                raise KeyError(user_id)
+            LOGGER.debug('Fetching unknown slack user %r', user_id)
+            user = self.set_user(fetch(user_id))
+        return user
+
+    def get_channel(self, channel_id, fetch=None):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            if fetch is None:
+                raise KeyError(channel_id)
+            LOGGER.debug('Fetching unknown slack channel %r', channel_id)
+            channel = self.set_channel(fetch(channel_id))
+        return channel
+
+    def set_channel(self, channel):
+        channel = SlackChannel.from_api(channel)
+        with self.lock:
+            old = self.channels.get(channel.id)
+            if old is not None:
+                self._unindex_channel(old)
+            self.channels[channel.id] = channel
+            self.channel_ids[channel.name] = channel.id
+        self.mentions.pop(('#', channel.id))
+        self.mentions.pop(('#name', channel.name + '/slack'))
+        return channel
+
+    def delete_channel(self, channel_id):
+        with self.lock:
+            channel = self.channels.pop(channel_id, None)
+            if channel is not None:
+                self._unindex_channel(channel)
+
+    def _unindex_channel(self, channel):
+        if self.channel_ids.get(channel.name) == channel.id:
+            del self.channel_ids[channel.name]
+        self.mentions.pop(('#', channel.id))
+        self.mentions.pop(('#name', channel.name + '/slack'))
+
+
+_teams = weakref.WeakValueDictionary()
+_teams_lock = threading.Lock()
+
+
+def get_team_state(team_id):
+    if team_id is None:
+        return TeamState()
+    with _teams_lock:
+        state = _teams.get(team_id)
+        if state is None:
+            state = _teams[team_id] = TeamState(team_id)
+        return state
@@ -5,6 +5,50 @@ from pyramid.i18n import TranslationStringFactory
 _ = TranslationStringFactory('slack_mirror')
 
 
+USERS = [{'id': 'U1', 'name': 'bob', 'profile': {'email': 'a@b.com'}}]
+CHANNELS = [{'id': 'C1', 'name': 'general'}, {'id': 'C2', 'name': 'random'}]
+TEAM = {'id': 'T1', 'email_domain': 'example.com'}
+
+
+def make_team_state():
+    from slack_mirror.state import TeamState
+    state = TeamState('T1')
+    state.load(USERS, CHANNELS, TEAM)
+    return state
+
+
+class Recorder(object):
+    """ Stands in for either side's connection, recording every call. """
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.calls.append((name,) + args)
+
+    @property
+    def sent(self):
+        return [call[1] for call in self.calls if call[0] == 'send_message']
+
+
+def make_translators():
+    """ A public and a private translator sharing a dedup cache, talking
+    to ``Recorder``s. """
+    from slack_mirror.dedup import DedupCache
+    from slack_mirror.slack_mirror_script import (
+        PrivateTranslator,
+        PublicTranslator,
+    )
+    dedup = DedupCache()
+    public = PublicTranslator(dedup)
+    private = PrivateTranslator('a@b.com', dedup)
+    for translator in (public, private):
+        translator.slack_init(USERS, CHANNELS, TEAM)
+        translator.slack = Recorder()
+        translator.zulip = Recorder()
+    return public, private
+
+
 class ViewTests(unittest.TestCase):
 
     def setUp(self):
@@ -19,3 +63,1635 @@ class ViewTests(unittest.TestCase):
         response = my_view(request)
         self.assertEqual(response['project'], 'slack_mirror')
 
+
+class MirrorDaemonTests(unittest.TestCase):
+
+    def _make_daemon(self, configs):
+        from slack_mirror.daemon import MirrorDaemon
+
+        class FakeMirror(object):
+            alive = True
+
+            def stop(self):
+                self.alive = False
+
+        class TestDaemon(MirrorDaemon):
+            def load_configs(self):
+                return dict(configs)
+
+            def add_mirror(self, config):
+                self.mirrors[config.email] = FakeMirror()
+                self.configs[config.email] = config
+
+        return TestDaemon({'mirror.start_rate': '1000'}, None)
+
+    def test_reconcile_adds_and_removes(self):
+        from slack_mirror.daemon import MirrorConfig
+        configs = {
+            'a@example.com': MirrorConfig('a@example.com', 't', 'k', False),
+            'b@example.com': MirrorConfig('b@example.com', 't', 'k', False),
+        }
+        daemon = self._make_daemon(configs)
+        daemon.reconcile()
+        self.assertEqual(set(daemon.mirrors), set(configs))
+
+        removed = daemon.mirrors['b@example.com']
+        del configs['b@example.com']
+        daemon.reconcile()
+        self.assertEqual(list(daemon.mirrors), ['a@example.com'])
+        self.assertFalse(removed.alive)
+
+    def test_reconcile_restarts_changed_and_dead(self):
+        from slack_mirror.daemon import MirrorConfig
+        configs = {
+            'a@example.com': MirrorConfig('a@example.com', 't', 'k', False),
+            'b@example.com': MirrorConfig('b@example.com', 't', 'k', False),
+        }
+        daemon = self._make_daemon(configs)
+        daemon.reconcile()
+        old_a = daemon.mirrors['a@example.com']
+        old_b = daemon.mirrors['b@example.com']
+
+        configs['a@example.com'] = configs['a@example.com']._replace(
+            zulip_key='new')
+        old_b.alive = False
+        daemon.reconcile()
+        self.assertIsNot(daemon.mirrors['a@example.com'], old_a)
+        self.assertIsNot(daemon.mirrors['b@example.com'], old_b)
+
+
+class SendQueueTests(unittest.TestCase):
+
+    def _fill(self, overflow, on_drop=None):
+        from slack_mirror.transport import SendQueue
+        send_queue = SendQueue('test_' + overflow, 2, overflow, on_drop)
+        for i in range(4):
+            send_queue.put(len, i)
+        return send_queue
+
+    def _queued(self, send_queue):
+        return [args for _, _, args in list(send_queue.queue.queue)]
+
+    def test_drop_newest(self):
+        send_queue = self._fill('drop_newest')
+        self.assertEqual(send_queue.dropped.value, 2)
+        self.assertEqual(send_queue.depth.value, 2)
+        self.assertEqual(self._queued(send_queue), [(0,), (1,)])
+
+    def test_drop_oldest(self):
+        send_queue = self._fill('drop_oldest')
+        self.assertEqual(send_queue.dropped.value, 2)
+        self.assertEqual(send_queue.depth.value, 2)
+        self.assertEqual(self._queued(send_queue), [(2,), (3,)])
+
+    def test_on_drop(self):
+        dropped = []
+        self._fill('drop_oldest', lambda func, args: dropped.append(args))
+        self.assertEqual(dropped, [(0,), (1,)])
+
+    def test_run_sends_in_order(self):
+        from slack_mirror.transport import SendQueue
+        sent = []
+        send_queue = SendQueue('test_run')
+        for i in range(3):
+            send_queue.put(sent.append, i)
+        send_queue.queue.put((None, SendQueue._STOP, None))
+        send_queue.run()
+        self.assertEqual(sent, [0, 1, 2])
+        self.assertEqual(send_queue.depth.value, 0)
+
+    def test_unknown_policy(self):
+        from slack_mirror.transport import SendQueue
+        self.assertRaises(ValueError, SendQueue, 'test_bad', 2, 'spill')
+
+
+class SlackSchedulerTests(unittest.TestCase):
+
+    def _make_scheduler(self):
+        from slack_mirror.ratelimit import SlackScheduler
+        return SlackScheduler(rate=1.0, burst=1, clock=lambda: 0)
+
+    def _msg(self, channel, text):
+        return {'channel': channel, 'text': text, 'as_user': True}
+
+    def test_limits_each_channel(self):
+        scheduler = self._make_scheduler()
+        scheduler.put('alice', self._msg('C1', 'one'))
+        scheduler.put('bob', self._msg('C1', 'two'))
+        scheduler.put('alice', self._msg('C2', 'three'))
+
+        entry, count, wait = scheduler.next_batch(0)
+        self.assertEqual(entry.msg['text'], 'one')
+        entry, count, wait = scheduler.next_batch(0)
+        self.assertEqual(entry.msg['text'], 'three')
+        entry, count, wait = scheduler.next_batch(0)
+        self.assertEqual(entry, None)
+        self.assertEqual(wait, 1.0)
+        entry, count, wait = scheduler.next_batch(1.0)
+        self.assertEqual(entry.msg['text'], 'two')
+
+    def test_coalesces_same_sender(self):
+        scheduler = self._make_scheduler()
+        for text in ['a', 'b', 'c']:
+            scheduler.put('alice', self._msg('C1', text))
+        scheduler.put('bob', self._msg('C1', 'd'))
+
+        entry, count, wait = scheduler.next_batch(0)
+        self.assertEqual(entry.msg['text'], 'a\nb\nc')
+        self.assertEqual(count, 3)
+        self.assertEqual(scheduler.size, 1)
+
+    def test_requeue_honours_retry_after(self):
+        scheduler = self._make_scheduler()
+        scheduler.put('alice', self._msg('C1', 'a'))
+        entry, count, wait = scheduler.next_batch(0)
+        scheduler.requeue(entry, count, 30)
+
+        entry, count, wait = scheduler.next_batch(10)
+        self.assertEqual(entry, None)
+        self.assertEqual(wait, 20)
+        entry, count, wait = scheduler.next_batch(31)
+        self.assertEqual(entry.msg['text'], 'a')
+
+    def test_dropped_posts_are_not_replayed(self):
+        from slack_mirror.ratelimit import SlackScheduler
+
+        class Outbox(object):
+            def __init__(self):
+                self.delivered_ids = []
+
+            def delivered(self, outbox_ids):
+                self.delivered_ids.extend(outbox_ids)
+
+        class Slack(object):
+            outbox = Outbox()
+
+        slack = Slack()
+        scheduler = SlackScheduler(maxsize=1, clock=lambda: 0)
+        scheduler.put(slack, self._msg('C1', 'a'), outbox_id=1)
+        scheduler.put(slack, self._msg('C1', 'b'), outbox_id=2)
+        self.assertEqual(slack.outbox.delivered_ids, [2])
+
+    def test_posts_on_the_mirrors_queue(self):
+        import threading
+        from slack_mirror.ratelimit import RateLimited, SlackScheduler
+
+        class Outbound(object):
+            def __init__(self):
+                self.calls = []
+                self.queued = threading.Event()
+
+            def put(self, func, *args):
+                self.calls.append((func, args))
+                self.queued.set()
+
+        class Slack(object):
+            stopped = False
+            outbound = Outbound()
+            replies = [RateLimited(30)]
+
+            def _send_message(self, *args):
+                raise self.replies.pop(0)
+
+        slack = Slack()
+        scheduler = SlackScheduler(clock=lambda: 0)
+        scheduler.start()
+        scheduler.put(slack, self._msg('C1', 'a'), outbox_id=1)
+        self.assertTrue(slack.outbound.queued.wait(5))
+        func, args = slack.outbound.calls[0]
+        self.assertEqual(func, scheduler.post)
+
+        # Ratelimited on the mirror's worker, so it goes back to wait.
+        func(*args)
+        self.assertEqual(scheduler.size, 1)
+        self.assertEqual(len(slack.outbound.calls), 1)
+
+
+class TokenSessionTests(unittest.TestCase):
+
+    def setUp(self):
+        from slack_mirror import sessions
+        self.calls = []
+        calls = self.calls
+
+        class FakeSession(object):
+            def request(self, method, url, **kwargs):
+                calls.append((method, url, kwargs))
+
+        self.old_session = sessions._session
+        sessions._session = FakeSession()
+
+    def tearDown(self):
+        from slack_mirror import sessions
+        sessions._session = self.old_session
+
+    def test_injects_token_per_request(self):
+        from slack_mirror.sessions import TokenSession
+        alice = TokenSession(params={'token': 'alice'})
+        bob = TokenSession(params={'token': 'bob'})
+        alice.get('https://slack.com/api/rtm.start', params={'a': 1})
+        bob.post('https://slack.com/api/chat.postMessage', data={'b': 2})
+
+        method, url, kwargs = self.calls[0]
+        self.assertEqual(method, 'GET')
+        self.assertEqual(kwargs['params'], {'token': 'alice', 'a': 1})
+        method, url, kwargs = self.calls[1]
+        self.assertEqual(method, 'POST')
+        self.assertEqual(kwargs['params'], {'token': 'bob'})
+        self.assertEqual(kwargs['data'], {'b': 2})
+        self.assertEqual(alice.params, {'token': 'alice'})
+
+    def test_default_timeout(self):
+        from slack_mirror import sessions
+        self.addCleanup(setattr, sessions, '_settings', sessions._settings)
+        sessions._settings = {'http.timeout': '5'}
+        slack = sessions.TokenSession(params={'token': 'alice'})
+        slack.post('https://slack.com/api/chat.postMessage')
+        slack.get('https://z/api/v1/events', timeout=None)
+        self.assertEqual(self.calls[0][2]['timeout'], 5.0)
+        self.assertEqual(self.calls[1][2]['timeout'], None)
+
+    def test_long_polls_have_their_own_pool(self):
+        from slack_mirror import sessions
+        for name in ('_session', '_long_poll_session', '_long_polls'):
+            self.addCleanup(setattr, sessions, name, getattr(sessions, name))
+        shared = sessions.configure({})
+        poll = sessions.get_long_poll_session()
+
+        def pool_size():
+            return poll.get_adapter('https://z')._pool_maxsize
+
+        self.assertEqual(pool_size(), 4)
+        sessions.expect_long_polls(300)
+        self.assertEqual(pool_size(), 512)
+        sessions.expect_long_polls(10)
+        self.assertEqual(pool_size(), 512)
+
+        calls = self.calls
+        shared.request = lambda method, url, **kw: calls.append('shared')
+        poll.request = lambda method, url, **kw: calls.append('poll')
+        zulip = sessions.TokenSession(long_polls=['https://z/api/v1/events'])
+        zulip.get('https://z/api/v1/events')
+        zulip.post('https://z/api/v1/events')
+        zulip.get('https://z/api/v1/messages')
+        self.assertEqual(calls, ['poll', 'shared', 'shared'])
+
+
+class SlackStateMixinTests(unittest.TestCase):
+
+    def _make_state(self):
+        from slack_mirror.slack_mirror_script import SlackStateMixin
+        state = SlackStateMixin()
+        state.slack_init(USERS, CHANNELS, TEAM)
+        return state
+
+    def test_lookup(self):
+        state = self._make_state()
+        self.assertEqual(
+            state.zulip_stream_to_slack_channel_id('general/slack'), 'C1')
+        self.assertEqual(
+            state.zulip_stream_to_slack_channel_id('missing/slack'), None)
+
+    def test_created(self):
+        state = self._make_state()
+        state.slack__channel_created({'channel': {'id': 'C3', 'name': 'new'}})
+        self.assertEqual(
+            state.zulip_stream_to_slack_channel_id('new/slack'), 'C3')
+
+    def test_rename(self):
+        state = self._make_state()
+        state.slack__channel_rename({'channel': {'id': 'C1', 'name': 'main'}})
+        self.assertEqual(
+            state.zulip_stream_to_slack_channel_id('main/slack'), 'C1')
+        self.assertEqual(
+            state.zulip_stream_to_slack_channel_id('general/slack'), None)
+
+    def test_deleted(self):
+        state = self._make_state()
+        state.slack__channel_deleted({'channel': 'C2'})
+        self.assertEqual(
+            state.zulip_stream_to_slack_channel_id('random/slack'), None)
+
+    def test_users(self):
+        state = self._make_state()
+        state.slack__team_join({'user': {
+            'id': 'U1', 'name': 'alice', 'profile': {'email': 'a@b.com'},
+        }})
+        state.slack__team_join({'user': {
+            'id': 'U2', 'name': 'bot', 'profile': {},
+        }})
+        self.assertEqual(state.slack_user_id_to_zulip_user('U1'), 'a@b.com')
+        self.assertEqual(
+            state.slack_user_id_to_zulip_user('U2'), 'bot@example.com')
+
+    def test_unknown_user_is_fetched(self):
+        state = self._make_state()
+        fetched = []
+
+        class FakeSlack(object):
+            def fetch_user(self, user_id):
+                fetched.append(user_id)
+                return {'id': user_id, 'name': 'carol', 'profile': {}}
+
+        state.slack = FakeSlack()
+        self.assertEqual(
+            state.slack_user_id_to_zulip_user('U9'), 'carol@example.com')
+        self.assertEqual(
+            state.slack_user_id_to_zulip_user('U9'), 'carol@example.com')
+        self.assertEqual(fetched, ['U9'])
+
+    def test_shared_between_mirrors(self):
+        from slack_mirror.slack_mirror_script import SlackStateMixin
+        state = self._make_state()
+        other = SlackStateMixin()
+        other.slack_init([], [], {'id': 'T1', 'email_domain': 'example.com'})
+        self.assertIs(state.slack_state, other.slack_state)
+
+
+class TeamStateTests(unittest.TestCase):
+
+    def test_cache_round_trip(self):
+        import os
+        import shutil
+        import tempfile
+        from slack_mirror.state import TeamState
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'team', 'T1.json')
+        make_team_state().save(path)
+
+        state = TeamState('T1')
+        self.assertTrue(state.load_cache(path))
+        self.assertEqual(state.email_domain, 'example.com')
+        self.assertEqual(state.get_user('U1').email, 'a@b.com')
+        self.assertEqual(state.channel_ids['random'], 'C2')
+        self.assertFalse(state.load_cache(path))
+
+    def test_prune(self):
+        state = make_team_state()
+        state.prune(['U1'], ['C1'])
+        self.assertEqual(list(state.channels), ['C1'])
+        self.assertEqual(state.channel_ids, {'general': 'C1'})
+
+
+class DispatcherTests(unittest.TestCase):
+
+    def _make_dispatcher(self):
+        from slack_mirror.dispatch import Dispatcher
+
+        class Translator(object):
+            def __init__(self):
+                self.calls = []
+
+            def slack__message(self, msg):
+                self.calls.append('message')
+
+            def slack__message__channel_join(self, msg):
+                self.calls.append('channel_join')
+
+            def slack__channel_created(self, msg):
+                self.calls.append('channel_created')
+
+        translator = Translator()
+        return translator, Dispatcher(translator, 'slack')
+
+    def test_subtype_falls_back_to_type(self):
+        translator, dispatcher = self._make_dispatcher()
+        dispatcher.dispatch({'type': 'message'})
+        dispatcher.dispatch({'type': 'message', 'subtype': 'channel_join'})
+        dispatcher.dispatch({'type': 'message', 'subtype': 'bot_message'})
+        self.assertFalse(dispatcher.dispatch({'type': 'user_typing'}))
+        self.assertEqual(
+            translator.calls, ['message', 'channel_join', 'message'])
+
+    def test_wants(self):
+        translator, dispatcher = self._make_dispatcher()
+        self.assertTrue(dispatcher.wants('{"type": "message", "text": "x"}'))
+        self.assertTrue(dispatcher.wants(
+            '{"channel": {"type": "x"}, "type": "channel_created"}'))
+        self.assertFalse(dispatcher.wants('{"type":"presence_change"}'))
+        self.assertFalse(dispatcher.wants('{"reply_to": 1, "ok": true}'))
+
+
+class JsonCodecTests(unittest.TestCase):
+
+    def test_stdlib_backend(self):
+        from slack_mirror import jsoncodec
+        name, loads = jsoncodec.get_loads('json')
+        self.assertEqual(name, 'json')
+        self.assertEqual(loads('{"type": "message"}'), {'type': 'message'})
+
+    def test_missing_backend(self):
+        from slack_mirror import jsoncodec
+        self.assertRaises(ValueError, jsoncodec.get_loads, 'no_such_json')
+
+    def test_prefilter_default(self):
+        from slack_mirror import jsoncodec
+        self.assertTrue(jsoncodec._use_prefilter('json'))
+        self.assertFalse(jsoncodec._use_prefilter('ujson'))
+        self.assertTrue(jsoncodec._use_prefilter('ujson', 'true'))
+
+
+class DedupCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+
+    def _make_cache(self, **kwargs):
+        from slack_mirror.dedup import DedupCache
+        return DedupCache(clock=lambda: self.now, **kwargs)
+
+    def test_check_consumes(self):
+        cache = self._make_cache()
+        cache.add(('slack', 'C1', '1.0'))
+        self.assertTrue(cache.check(('slack', 'C1', '1.0')))
+        self.assertFalse(cache.check(('slack', 'C1', '1.0')))
+
+    def test_ttl(self):
+        cache = self._make_cache(ttl=10)
+        cache.add(('zulip', 1))
+        self.now = 11
+        self.assertFalse(cache.check(('zulip', 1)))
+
+    def test_maxsize(self):
+        cache = self._make_cache(maxsize=2)
+        for i in range(3):
+            cache.add(('zulip', i))
+        self.assertFalse(cache.check(('zulip', 0)))
+        self.assertTrue(cache.check(('zulip', 2)))
+
+    def test_fingerprint_ignores_markup(self):
+        from slack_mirror.dedup import fingerprint
+        self.assertEqual(
+            fingerprint('a@b.com', 'x/slack', u'see http://a.com/?a=1&b=2'),
+            fingerprint(
+                'a@b.com', 'x/slack', u'see  <http://a.com/?a=1&amp;b=2>'),
+        )
+        self.assertEqual(
+            fingerprint('a@b.com', 'x/slack', u'**bold** move'),
+            fingerprint('a@b.com', 'x/slack', u'*bold* move'),
+        )
+
+
+class EchoSuppressionTests(unittest.TestCase):
+
+    def test_slack_echo_before_zulip_event(self):
+        public, private = make_translators()
+        zulip_msg = {'message': {
+            'id': 7,
+            'sender_email': 'a@b.com',
+            'client': 'website',
+            'display_recipient': u'general/slack',
+            'content': u'hi & bye',
+        }}
+        private.zulip__message(zulip_msg)
+        self.assertEqual(len(private.slack.sent), 1)
+
+        public.slack__message({
+            'user': 'U1', 'channel': 'C1', 'ts': '1.0',
+            'text': u'hi &amp; bye',
+        })
+        public.zulip__message(zulip_msg)
+        self.assertEqual(public.zulip.sent, [])
+
+    def test_other_messages_are_mirrored(self):
+        public, private = make_translators()
+        public.slack__message({
+            'user': 'U1', 'channel': 'C1', 'ts': '2.0', 'text': u'hello',
+        })
+        self.assertEqual(len(public.zulip.sent), 1)
+
+    def test_merged_post_echo(self):
+        from slack_mirror.slack_mirror_script import Slack
+        public, private = make_translators()
+
+        class Response(object):
+            headers = {}
+
+            def json(self):
+                return {'ok': True, 'channel': 'C1', 'ts': '3.0'}
+
+        class SlackAPI(object):
+            def post(self, url, data):
+                # Slack echoes the post before answering it.
+                public.slack__message({
+                    'user': 'U1', 'channel': 'C1', 'ts': '3.0',
+                    'text': data['text'],
+                })
+                return Response()
+
+        slack = Slack(private, SlackAPI())
+        slack._send_message(
+            {'channel': 'C1', 'text': u'one\ntwo', 'as_user': True},
+            (1, 2),
+        )
+        self.assertEqual(public.zulip.sent, [])
+
+    def test_forged_post_event_before_ack(self):
+        public, private = make_translators()
+        public.slack__message({
+            'user': 'U1', 'channel': 'C1', 'ts': '1.0', 'text': u'hi',
+        })
+        # The zulip event for the forged post beats the send's answer.
+        public.zulip__message({'message': {
+            'id': 7,
+            'sender_email': 'a@b.com',
+            'client': 'JabberMirror',
+            'display_recipient': u'general/slack',
+            'content': u'hi',
+        }})
+        public.slack__message({
+            'user': 'U1', 'channel': 'C1', 'ts': '2.0', 'text': u'hi',
+        })
+        self.assertEqual(len(public.zulip.sent), 2)
+
+    def test_replayed_post_echo(self):
+        from slack_mirror.slack_mirror_script import Slack
+        public, private = make_translators()
+        msg = {'channel': 'C1', 'text': u'hi', 'as_user': True}
+
+        class Outbox(object):
+            def pending(self, direction):
+                return [(1, {'msg': msg, 'stream': u'general/slack'})]
+
+        slack = Slack(private, None, scheduler=Recorder(), outbox=Outbox())
+        slack.replay()
+        self.assertEqual(slack.scheduler.calls, [('put', slack, msg, 1)])
+        public.slack__message({
+            'user': 'U1', 'channel': 'C1', 'ts': '3.0', 'text': u'hi',
+        })
+        self.assertEqual(public.zulip.sent, [])
+
+
+class OutboxTests(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import shutil
+        import tempfile
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, 'outbox.db')
+
+    def _open(self):
+        from slack_mirror.outbox import Outbox
+        outbox = Outbox(self.path, flush_interval=0)
+        outbox.start()
+        self.addCleanup(outbox.stop)
+        return outbox
+
+    def test_undelivered_survive_restart(self):
+        outbox = self._open()
+        first = outbox.record('a@b.com', 'slack', {'text': 'one'})
+        outbox.record('a@b.com', 'slack', {'text': 'two'})
+        outbox.record('a@b.com', 'zulip', {'content': 'three'})
+        outbox.delivered('a@b.com', [first])
+        outbox.sync()
+        outbox.stop()
+
+        outbox = self._open()
+        self.assertEqual(
+            [msg for _, msg in outbox.pending('a@b.com', 'slack')],
+            [{'text': 'two'}],
+        )
+        self.assertEqual(
+            [msg for _, msg in outbox.pending('a@b.com', 'zulip')],
+            [{'content': 'three'}],
+        )
+        self.assertTrue(outbox.record('a@b.com', 'slack', {}) > first)
+
+    def test_processes_sharing_a_file(self):
+        first, second = self._open(), self._open()
+        one = first.record('a@b.com', 'slack', {'text': 'one'})
+        two = second.record('c@d.com', 'slack', {'text': 'two'})
+        first.sync()
+        second.sync()
+        self.assertEqual(one, two)
+        # Delivering one mirror's message leaves the other's alone.
+        first.delivered('a@b.com', [one])
+        first.sync()
+        self.assertEqual(first.pending('a@b.com', 'slack'), [])
+        self.assertEqual(
+            second.pending('c@d.com', 'slack'), [(two, {'text': 'two'})])
+
+    def test_failing_rows_are_dropped(self):
+        import sqlite3
+        outbox = self._open()
+        outbox.register('a@b.com')
+        conn = sqlite3.connect(self.path)
+        with conn:
+            conn.execute(
+                'INSERT INTO outbox_message VALUES (?, ?, ?, ?, ?)',
+                ('a@b.com', 1, 'slack', '{}', 0),
+            )
+        conn.close()
+        # Id 1 is taken behind the outbox's back, which no retry fixes.
+        outbox.record('a@b.com', 'slack', {'text': 'one'})
+        outbox.record('a@b.com', 'slack', {'text': 'two'})
+        self.assertTrue(outbox.sync())
+        self.assertEqual(
+            outbox.pending('a@b.com', 'slack'), [(1, {}), (2, {'text': 'two'})])
+
+    def test_posted(self):
+        outbox = self._open()
+        outbox.add_posted('slack', 'C1 1.0')
+        outbox.add_posted('zulip', 12)
+        self.assertEqual(outbox.posted('zulip', [11, 12]), set(['12']))
+        outbox.sync()
+        outbox.stop()
+
+        outbox = self._open()
+        self.assertEqual(
+            outbox.posted('slack', ['C1 1.0', 'C1 2.0']), set(['C1 1.0']))
+        self.assertEqual(outbox.posted('slack', ['12']), set())
+
+    def test_sync_times_out(self):
+        from slack_mirror.outbox import Outbox
+        outbox = Outbox(self.path, flush_interval=0)
+        outbox.record('a@b.com', 'slack', {})
+        self.assertFalse(outbox.sync(timeout=0.01))
+
+    def test_watermarks_survive_restart(self):
+        from slack_mirror.backfill import Watermarks
+        from slack_mirror.outbox import MirrorOutbox
+        outbox = self._open()
+        marks = Watermarks(MirrorOutbox(outbox, 'a@b.com'))
+        marks.advance('slack', 'C1', '10.000200')
+        marks.advance('slack', 'C1', '9.000900')
+        marks.advance('zulip', 'messages', 12)
+        outbox.sync()
+        outbox.stop()
+
+        marks = Watermarks(MirrorOutbox(self._open(), 'a@b.com'))
+        self.assertEqual(marks.get('slack'), {'C1': '10.000200'})
+        self.assertEqual(marks.get('zulip'), {'messages': '12'})
+
+
+class BackfillTests(unittest.TestCase):
+
+    def test_channel_history_is_replayed_in_order(self):
+        from slack_mirror.slack_mirror_script import Slack
+
+        class Translator(object):
+            backfill_sources = ('slack',)
+
+            def __init__(self):
+                self.seen = []
+
+            def slack__message(self, msg):
+                self.seen.append((msg['channel'], msg['ts']))
+
+        pages = [
+            {'messages': [{'ts': '5.0'}, {'ts': '4.0'}], 'has_more': True},
+            {'messages': [{'ts': '3.0'}], 'has_more': False},
+        ]
+        calls = []
+
+        def call(method, **params):
+            calls.append(params)
+            return pages.pop(0)
+
+        translator = Translator()
+        slack = Slack(translator, None)
+        slack._call = call
+        slack._backfill_channel('C1', '2.0', '6.0')
+        self.assertEqual(
+            translator.seen, [('C1', '3.0'), ('C1', '4.0'), ('C1', '5.0')])
+        self.assertEqual(calls[1]['latest'], '4.0')
+        self.assertEqual(calls[1]['oldest'], '2.0')
+
+    def test_posted_messages_are_skipped(self):
+        from slack_mirror.outbox import NullOutbox, posted_key
+        from slack_mirror.slack_mirror_script import Slack
+
+        class Outbox(NullOutbox):
+            def posted(self, source, keys):
+                return set([posted_key('C1', '4.0')])
+
+        class Translator(object):
+            backfill_sources = ('slack',)
+
+            def __init__(self):
+                self.seen = []
+
+            def slack__message(self, msg):
+                if msg['ts'] == '3.0':
+                    raise ValueError(msg)
+                self.seen.append(msg['ts'])
+
+        translator = Translator()
+        slack = Slack(translator, None, outbox=Outbox())
+        slack._call = lambda method, **params: {'messages': [
+            {'ts': '5.0'}, {'ts': '4.0'}, {'ts': '3.0'}]}
+        slack._backfill_channel('C1', '2.0', '6.0')
+        self.assertEqual(translator.seen, ['5.0'])
+
+    def test_run_limited(self):
+        from slack_mirror.backfill import run_limited
+        seen = []
+
+        def func(item):
+            if item == 2:
+                raise ValueError(item)
+            seen.append(item)
+
+        run_limited(func, range(5), 2)
+        self.assertEqual(sorted(seen), [0, 1, 3, 4])
+
+
+class ReconnectorTests(unittest.TestCase):
+
+    def _make_reconnector(self, **kwargs):
+        from slack_mirror.reconnect import Reconnector
+        self.now = 0
+        self.delays = []
+        reconnector = Reconnector(
+            self.id(), random=lambda: 1, clock=lambda: self.now, **kwargs)
+        reconnector.wakeup.wait = self.delays.append
+        return reconnector
+
+    def test_backoff_until_stopped(self):
+        reconnector = self._make_reconnector(base=1, cap=5)
+        attempts = []
+
+        def connect():
+            attempts.append(self.now)
+            self.now += 1
+            if len(attempts) == 3:
+                reconnector.connected()
+            raise IOError('down')
+
+        reconnector.run(connect, lambda: len(attempts) == 5)
+        self.assertEqual(self.delays, [1, 2, 4, 5])
+        self.assertEqual(reconnector.reconnects.value, 1)
+        self.assertEqual(reconnector.downtime.sum, 2)
+
+    def test_stable_connection_resets_backoff(self):
+        reconnector = self._make_reconnector(stable=10)
+        attempts = []
+
+        def connect():
+            attempts.append(self.now)
+            reconnector.connected()
+            self.now += 10 if len(attempts) == 3 else 1
+
+        reconnector.run(connect, lambda: len(attempts) == 4)
+        self.assertEqual(self.delays, [1, 2, 1])
+
+    def test_fatal_error_is_raised(self):
+        from slack_mirror.reconnect import FatalError
+        reconnector = self._make_reconnector()
+
+        def connect():
+            raise FatalError('token_revoked')
+
+        self.assertRaises(
+            FatalError, reconnector.run, connect, lambda: False)
+        self.assertEqual(self.delays, [])
+
+
+class MetricsTests(unittest.TestCase):
+
+    def _make_registry(self):
+        from slack_mirror.metrics import Counter, Histogram, Registry
+        registry = Registry()
+        counter = Counter(
+            'test_total', 'A counter.', ['side'], registry=registry)
+        histogram = Histogram(
+            'test_seconds', 'A histogram.', buckets=(1, 5), registry=registry)
+        return registry, counter, histogram
+
+    def test_merge_and_render(self):
+        from slack_mirror.metrics import merge, render
+        snapshots = []
+        for i in range(2):
+            registry, counter, histogram = self._make_registry()
+            counter.labels('slack').inc(2)
+            histogram.observe(0.5)
+            histogram.observe(3)
+            snapshots.append(registry.collect())
+        counter.labels('zu"lip').inc()
+
+        text = render(merge(snapshots + [registry.collect()]))
+        self.assertIn('# TYPE test_total counter\n', text)
+        self.assertIn('test_total{side="slack"} 6.0\n', text)
+        self.assertIn('test_total{side="zu\\"lip"} 1.0\n', text)
+        self.assertIn('test_seconds_bucket{le="1.0"} 3.0\n', text)
+        self.assertIn('test_seconds_bucket{le="5.0"} 6.0\n', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 6.0\n', text)
+        self.assertIn('test_seconds_sum 10.5\n', text)
+        self.assertIn('test_seconds_count 6.0\n', text)
+
+    def test_file_exporter(self):
+        import os
+        import shutil
+        import tempfile
+        from slack_mirror.metrics import FileExporter, read_snapshots
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        registry, counter, _ = self._make_registry()
+        counter.labels('slack').inc()
+
+        exporter = FileExporter(
+            os.path.join(tmp_dir, '1.json'), registry=registry)
+        exporter.write()
+        self.assertEqual(
+            read_snapshots(tmp_dir, 60), [registry.collect()])
+        self.assertEqual(read_snapshots(tmp_dir, -1), [])
+        exporter.stop()
+        self.assertEqual(os.listdir(tmp_dir), [])
+
+
+class BotStateCacheTests(unittest.TestCase):
+
+    def _make_proxy(self):
+        test = self
+
+        class Supervisor(object):
+            def getAllProcessInfo(self):
+                test.polls += 1
+                return [{
+                    'name': 'a@b.com',
+                    'statename': 'RUNNING',
+                    'description': 'pid 1, uptime 0:01:00',
+                }]
+
+        class Proxy(object):
+            supervisor = Supervisor()
+
+        self.polls = 0
+        return Proxy()
+
+    def test_one_poll_per_ttl(self):
+        from slack_mirror.api import BotStateCache
+        self.now = 0
+        cache = BotStateCache(
+            {}, ttl=2, clock=lambda: self.now, proxy=self._make_proxy())
+        self.assertEqual(cache.get('a@b.com')['state'], 'RUNNING')
+        self.assertEqual(cache.get('x@b.com')['state'], 'Unknown')
+        self.assertEqual(self.polls, 1)
+
+        self.now = 3
+        cache.ready.clear()
+        cache.get('a@b.com')
+        cache.ready.wait(1)
+        self.assertEqual(self.polls, 2)
+
+    def test_log_tail_is_incremental(self):
+        from slack_mirror.api import LogTail
+        log = 'x' * 10
+        calls = []
+
+        def tail(offset, length):
+            calls.append(offset)
+            data = log[offset:]
+            if len(data) > length:
+                return [data[-length:], len(log), True]
+            return [data, len(log), False]
+
+        tail_log = LogTail(size=4)
+        self.assertEqual(tail_log.since(tail), ('xxxx', 10))
+        log += 'ab'
+        self.assertEqual(tail_log.since(tail, 10), ('ab', 12))
+        self.assertEqual(tail_log.since(tail), ('xxab', 12))
+        self.assertEqual(calls, [0, 10, 12])
+
+
+class FleetTests(unittest.TestCase):
+
+    def _make_fleet(self, **kwargs):
+        import xmlrpclib
+        from supervisor.xmlrpc import Faults
+        from slack_mirror.fleet import Fleet
+        test = self
+        self.calls = []
+        self.now = 0.0
+
+        def sleep(seconds):
+            self.now += seconds
+
+        class Supervisor(object):
+            def getAllProcessInfo(self):
+                return [{'name': name} for name in ('b', 'ui_server', 'a')]
+
+            def startProcess(self, name, wait):
+                test.calls.append(('start', name, test.now))
+                if name == 'running':
+                    raise xmlrpclib.Fault(Faults.ALREADY_STARTED, name)
+                if name == 'bad':
+                    raise xmlrpclib.Fault(Faults.BAD_NAME, name)
+
+            def stopProcess(self, name, wait):
+                test.calls.append(('stop', name, test.now))
+                raise xmlrpclib.Fault(Faults.NOT_RUNNING, name)
+
+        class Proxy(object):
+            supervisor = Supervisor()
+
+        class TestFleet(Fleet):
+            def _proxy(self):
+                return Proxy()
+
+        return TestFleet(
+            {}, clock=lambda: self.now, sleep=sleep, **kwargs)
+
+    def test_names_skip_excluded(self):
+        self.assertEqual(self._make_fleet().names(), ['a', 'b'])
+
+    def test_starts_are_paced(self):
+        fleet = self._make_fleet(parallel=1, rate=2.0)
+        self.assertEqual(fleet.run('restart', ['a', 'b', 'c']), {})
+        starts = [at for action, _, at in self.calls if action == 'start']
+        self.assertEqual(starts, [0.0, 0.5, 1.0])
+
+    def test_failures_are_collected(self):
+        fleet = self._make_fleet(rate=1000.0)
+        failed = fleet.run('start', ['running', 'bad', 'a'])
+        self.assertEqual(list(failed), ['bad'])
+
+
+class DaemonModeTests(unittest.TestCase):
+
+    def test_start_and_stop_flip_enabled(self):
+        import transaction
+        from slack_mirror import api
+        from slack_mirror.models import User
+        signals = []
+        self.addCleanup(setattr, api, 'signal_bot', api.signal_bot)
+        api.signal_bot = lambda settings, name, sig: signals.append(
+            (name, sig))
+        settings = {'mirror.daemon': 'true'}
+        user = User('U1', 'a@b.com', 'token')
+
+        transaction.begin()
+        api.stop_bot(settings, user)
+        self.assertFalse(user.enabled)
+        # Not before the daemon can read it.
+        self.assertEqual(signals, [])
+        transaction.commit()
+        self.assertEqual(signals, [('mirrors', 'HUP')])
+        self.assertEqual(
+            api.get_bot_state(settings, user)['state'], 'STOPPED')
+
+        transaction.begin()
+        api.start_bot(settings, user)
+        transaction.abort()
+        self.assertTrue(user.enabled)
+        self.assertEqual(len(signals), 1)
+
+    def test_daemon_skips_disabled_users(self):
+        import transaction
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from zope.sqlalchemy import ZopeTransactionExtension
+        from slack_mirror.daemon import MirrorDaemon
+        from slack_mirror.models import Base, User
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        maker = sessionmaker(bind=engine, extension=ZopeTransactionExtension())
+        with transaction.manager:
+            db = maker()
+            for id_, email, enabled in [('U1', 'a@b.com', True),
+                                        ('U2', 'c@b.com', False)]:
+                user = User(id_, email, 'token')
+                user.zulip_key = 'key'
+                user.enabled = enabled
+                db.add(user)
+
+        daemon = MirrorDaemon({}, maker)
+        self.assertEqual(list(daemon.load_configs()), ['a@b.com'])
+
+
+class ConfigReloaderTests(unittest.TestCase):
+
+    def test_requests_are_batched(self):
+        import threading
+        from slack_mirror.api import ConfigReloader
+        done = threading.Event()
+        calls = []
+
+        def reload(settings):
+            calls.append(settings)
+            done.set()
+
+        reloader = ConfigReloader({}, delay=0.05, reload=reload)
+        for i in range(3):
+            reloader.request()
+        self.assertTrue(done.wait(2))
+        self.assertEqual(len(calls), 1)
+
+        done.clear()
+        reloader.request()
+        self.assertTrue(done.wait(2))
+        self.assertEqual(len(calls), 2)
+
+
+class TeamFeedTests(unittest.TestCase):
+
+    def test_fan_out(self):
+        import json
+        from slack_mirror.slack_mirror_script import (
+            Slack, SlackStateMixin, TeamFeed, TeamSlack)
+
+        class Recorder(SlackStateMixin):
+            def __init__(self):
+                super(Recorder, self).__init__()
+                self.messages = []
+                self.user_changes = 0
+
+            def slack__message(self, msg):
+                self.messages.append(msg['text'])
+
+            def slack__user_change(self, msg):
+                self.user_changes += 1
+
+        feed = TeamFeed('T-fan-out', None)
+        feed.connection = TeamSlack(feed, None)
+        feed.running = True  # No socket in a test.
+        everything, general, team = Recorder(), Recorder(), Recorder()
+        feed.subscribe(Slack(everything, None))
+        feed.subscribe(Slack(general, None), channels=['C1'])
+        feed.subscribe(Slack(team, None), channels=())
+        self.assertIs(everything.slack_state, feed.slack_state)
+
+        for channel in ('C1', 'C2'):
+            feed.connection.on_message(None, json.dumps({
+                'type': 'message', 'channel': channel, 'text': channel}))
+        feed.connection.on_message(None, json.dumps({
+            'type': 'user_change',
+            'user': {'id': 'U1', 'name': 'bob', 'profile': {}},
+        }))
+
+        self.assertEqual(everything.messages, ['C1', 'C2'])
+        self.assertEqual(general.messages, ['C1'])
+        self.assertEqual(team.messages, [])
+        self.assertEqual(feed.slack_state.get_user('U1').name, 'bob')
+        self.assertEqual(everything.user_changes, 0)
+
+        feed.unsubscribe(feed.subscribers[0][0])
+        feed.connection.on_message(None, json.dumps({
+            'type': 'message', 'channel': 'C1', 'text': 'late'}))
+        self.assertEqual(everything.messages, ['C1', 'C2'])
+        self.assertEqual(general.messages, ['C1', 'late'])
+
+    def test_owner_follows_every_channel(self):
+        from slack_mirror.slack_mirror_script import (
+            PrivateTranslator, PublicTranslator, Slack, TeamFeed, TeamSlack)
+
+        class WebSocket(object):
+            closed = False
+
+            def close(self):
+                self.closed = True
+
+        feed = TeamFeed('T-owner', None)
+        feed.running = True  # No socket in a test.
+        private = Slack(PrivateTranslator('a@b.com'), 'user-token')
+        feed.subscribe(private, channels=())
+        feed.connection = TeamSlack(feed, None)
+        feed.connection.ws = WebSocket()
+        self.assertIs(feed.owner, private)
+
+        # A user token only streams that user's channels.
+        public = Slack(PublicTranslator(), 'bot-token')
+        feed.subscribe(public)
+        self.assertIs(feed.owner, public)
+        self.assertEqual(feed.connection.slack_api, 'bot-token')
+        self.assertTrue(feed.connection.ws.closed)
+
+        feed.unsubscribe(public)
+        self.assertIs(feed.owner, private)
+        self.assertEqual(feed.connection.slack_api, 'user-token')
+
+
+class ZulipSendTests(unittest.TestCase):
+
+    def test_only_transient_failures_are_replayed(self):
+        from slack_mirror.slack_mirror_script import PublicTranslator, Zulip
+        replies = [
+            {'result': 'connection-error'},
+            {'result': 'http-error', 'status_code': 502},
+            {'result': 'error', 'msg': 'Stream does not exist'},
+            {'result': 'success', 'id': 9},
+        ]
+
+        class Client(object):
+            def send_message(self, msg):
+                return replies.pop(0)
+
+        zulip = Zulip(PublicTranslator(), Client(), outbox=Recorder())
+        for outbox_id in range(4):
+            zulip._send_message({}, None, outbox_id)
+        self.assertEqual(zulip.outbox.calls, [
+            ('delivered', [2]),
+            ('delivered', [3]),
+            ('add_posted', 'zulip', 9),
+        ])
+
+
+class ZulipRegisterTests(unittest.TestCase):
+
+    def test_queue_is_narrowed(self):
+        from slack_mirror.dispatch import DROPPED
+        from slack_mirror.slack_mirror_script import PrivateTranslator, Zulip
+
+        class Client(object):
+            def register(self, **kwargs):
+                self.kwargs = kwargs
+                return {'result': 'success', 'queue_id': 'q1',
+                        'last_event_id': -1}
+
+        translator = PrivateTranslator('a@b.com')
+        zulip = Zulip(translator, Client())
+        self.assertEqual(zulip._register(), ('q1', -1))
+        self.assertEqual(zulip.zulip_client.kwargs, {
+            'event_types': [
+                'delete_message', 'message', 'subscription', 'update_message'],
+            'narrow': [['sender', 'a@b.com']],
+        })
+
+        dropped = DROPPED.labels('zulip', 'sender')
+        before = dropped.value
+        translator.zulip__message({'message': {'sender_email': 'c@b.com'}})
+        self.assertEqual(dropped.value, before + 1)
+
+
+class MarkupTests(unittest.TestCase):
+
+    def test_slack_to_zulip(self):
+        from slack_mirror.markup import slack_to_zulip
+        state = make_team_state()
+        self.assertEqual(
+            slack_to_zulip(
+                u'<@U1> see <#C1|general>, <https://a.com/?x=1&amp;y=2|this> '
+                u'and <https://b.com> <!here>',
+                state,
+            ),
+            u'@**bob** see #**general/slack**, [this](https://a.com/?x=1&y=2) '
+            u'and https://b.com @**all**',
+        )
+        self.assertEqual(
+            slack_to_zulip(u'*hi* _there_ ~no~ `*a* &lt; b` snake_case_name',
+                           state),
+            u'**hi** *there* ~~no~~ `*a* < b` snake_case_name',
+        )
+        self.assertEqual(slack_to_zulip(u'<@U2|al>', state), u'@al')
+
+    def test_zulip_to_slack(self):
+        from slack_mirror.markup import zulip_to_slack
+        state = make_team_state()
+        self.assertEqual(
+            zulip_to_slack(
+                u'@**bob** see #**general/slack** and [this](https://a.com) '
+                u'@**all**',
+                state,
+            ),
+            u'<@U1> see <#C1> and <https://a.com|this> <!channel>',
+        )
+        self.assertEqual(
+            zulip_to_slack(u'**hi** *there* ~~no~~ `a < b` & @**carol**',
+                           state),
+            u'*hi* _there_ ~no~ `a &lt; b` &amp; @carol',
+        )
+
+    def test_renames_invalidate_cache(self):
+        from slack_mirror.markup import slack_to_zulip, zulip_to_slack
+        state = make_team_state()
+        self.assertEqual(slack_to_zulip(u'<@U1>', state), u'@**bob**')
+        self.assertEqual(zulip_to_slack(u'#**general/slack**', state),
+                         u'<#C1>')
+        state.set_user({'id': 'U1', 'name': 'robert'})
+        state.set_channel({'id': 'C1', 'name': 'random'})
+        self.assertEqual(slack_to_zulip(u'<@U1>', state), u'@**robert**')
+        self.assertEqual(slack_to_zulip(u'<#C1>', state),
+                         u'#**random/slack**')
+        self.assertEqual(zulip_to_slack(u'@**bob**', state), u'@bob')
+        self.assertEqual(zulip_to_slack(u'#**general/slack**', state),
+                         u'#general/slack')
+
+    def test_misses_are_cached_until_the_user_joins(self):
+        from slack_mirror.markup import zulip_to_slack
+        state = make_team_state()
+        self.assertEqual(zulip_to_slack(u'@**carol**', state), u'@carol')
+        self.assertEqual(state.mentions.get(('@name', u'carol')), False)
+        self.assertEqual(zulip_to_slack(u'@**carol**', state), u'@carol')
+        state.set_user({'id': 'U2', 'name': 'carol'})
+        self.assertEqual(zulip_to_slack(u'@**carol**', state), u'<@U2>')
+        state.prune(['U1'], ['C1', 'C2'])
+        self.assertEqual(state.user_ids, {'bob': 'U1'})
+        self.assertEqual(zulip_to_slack(u'@**carol**', state), u'@carol')
+
+    def test_lru_cache(self):
+        from slack_mirror.markup import LRUCache
+        cache = LRUCache(size=4)
+        for key in 'abc':
+            cache.put(key, key.upper())
+        self.assertEqual(cache.get('a'), 'A')
+        for key in 'de':
+            cache.put(key, key.upper())
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'A')
+        cache.pop('a')
+        self.assertEqual(cache.get('a'), None)
+
+
+class ThreadStoreTests(unittest.TestCase):
+
+    def _make_sessionmaker(self):
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from zope.sqlalchemy import ZopeTransactionExtension
+        from slack_mirror.models import Base
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        return sessionmaker(bind=engine, extension=ZopeTransactionExtension())
+
+    def test_topic_names(self):
+        from slack_mirror.threads import topic_name
+        self.assertEqual(topic_name(u'deploy  is\nbroken'), u'deploy is broken')
+        self.assertEqual(topic_name(u'deploy', 2), u'deploy (2)')
+        name = topic_name(u'x' * 100, 3)
+        self.assertEqual(len(name), 60)
+        self.assertTrue(name.endswith(u'... (3)'))
+        self.assertEqual(topic_name(u''), u'thread')
+
+    def test_assign_and_look_up(self):
+        from slack_mirror.threads import ThreadStore
+        sessionmaker = self._make_sessionmaker()
+        store = ThreadStore(sessionmaker)
+        self.assertEqual(store.thread(u'general/slack', u'deploy'), None)
+        self.assertEqual(
+            store.assign('C1', '1.0', u'general/slack', u'deploy'), u'deploy')
+        self.assertEqual(
+            store.assign('C1', '2.0', u'general/slack', u'deploy'),
+            u'deploy (2)')
+        self.assertEqual(
+            store.assign('C1', '1.0', u'general/slack', u'other'), u'deploy')
+        # The cached miss is replaced as soon as the topic is assigned.
+        self.assertEqual(
+            store.thread(u'general/slack', u'deploy'), ('C1', '1.0'))
+
+        # A fresh store, as in another process, finds them in the database.
+        other = ThreadStore(sessionmaker)
+        self.assertEqual(other.topic('C1', '2.0'), u'deploy (2)')
+        self.assertEqual(
+            other.thread(u'general/slack', u'deploy (2)'), ('C1', '2.0'))
+
+    def test_replies_go_to_thread_topic(self):
+        from slack_mirror.transport import SendQueue
+        public, private = make_translators()
+        fetched = []
+        public.slack.fetch_message = lambda channel_id, ts: (
+            fetched.append(ts) or {'text': u'old news'})
+        for ts, thread_ts, text in [
+            ('1.0', None, u'deploy is broken'),
+            ('2.0', '1.0', u'looking'),
+            ('3.0', None, u'lunch?'),
+            ('4.0', '1.0', u'fixed'),
+            ('5.0', '0.5', u'me too'),
+        ]:
+            msg = {'type': 'message', 'channel': 'C1', 'user': 'U1',
+                   'ts': ts, 'text': text}
+            if thread_ts:
+                msg['thread_ts'] = thread_ts
+            public.slack__message(msg)
+
+        def sent():
+            return [(m['subject'], m['content']) for m in public.zulip.sent]
+
+        # Replies wait for their topic on the lookup worker.
+        self.assertEqual(sent(), [
+            ('(no topic)', u'deploy is broken'),
+            ('(no topic)', u'lunch?'),
+        ])
+        public.lookups.queue.put((None, SendQueue._STOP, None))
+        public.lookups.run()
+        self.assertEqual(sent()[2:], [
+            (u'deploy is broken', u'looking'),
+            (u'deploy is broken', u'fixed'),
+            (u'old news', u'me too'),
+        ])
+        self.assertEqual(fetched, ['0.5'])
+        self.assertEqual(public.looking_up, {})
+
+        # Once known, the topic is used straight away.
+        public.slack__message({
+            'type': 'message', 'channel': 'C1', 'user': 'U1', 'ts': '6.0',
+            'thread_ts': '1.0', 'text': u'thanks'})
+        self.assertEqual(sent()[-1], (u'deploy is broken', u'thanks'))
+
+
+class CorrelationTests(unittest.TestCase):
+
+    def test_oldest_minutes_are_evicted_to_spill(self):
+        import os
+        import shutil
+        import tempfile
+        from slack_mirror.correlation import CorrelationIndex, Spill
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        now = [0.0]
+        spill = Spill(os.path.join(tmpdir, 'correlation'))
+        index = CorrelationIndex(
+            'a@b.com', maxsize=2, spill=spill, clock=lambda: now[0])
+        index.add('C1', '1.0', 1)
+        now[0] = 60
+        index.add('C1', '2.0', 2)
+        index.add('C1', '3.0', 3)
+        self.assertEqual(len(index), 2)
+        self.assertNotIn(1, index.by_zulip)
+        # Evicted pairs are still found, in the spill.
+        self.assertEqual(index.zulip_id('C1', '1.0'), 1)
+        self.assertEqual(index.slack(1), ('C1', '1.0'))
+        self.assertEqual(index.slack(3), ('C1', '3.0'))
+        index.forget(1)
+        self.assertEqual(index.slack(1), None)
+        self.assertEqual(
+            CorrelationIndex('c@b.com', spill=spill).slack(2), None)
+
+        now[0] = 60 + 86400 + 60
+        index.add('C1', '4.0', 4)
+        self.assertEqual(len(index), 1)
+
+    def test_slack_edits_and_deletes(self):
+        public, private = make_translators()
+        public.slack__message({
+            'user': 'U1', 'channel': 'C1', 'ts': '1.0', 'text': u'helo'})
+        name, msg, callback, source_time = public.zulip.calls.pop()
+        callback({'id': 7})
+
+        message = {'user': 'U1', 'ts': '1.0', 'text': u'*hello*'}
+        public.slack__message__message_changed({
+            'channel': 'C1', 'message': message,
+            'previous_message': dict(message, text=u'helo'),
+        })
+        # An unfurl changes the message but not its text.
+        public.slack__message__message_changed({
+            'channel': 'C1', 'message': message, 'previous_message': message,
+        })
+        public.slack__message__message_deleted(
+            {'channel': 'C1', 'deleted_ts': '1.0'})
+        # Messages this mirror did not post are left alone.
+        public.slack__message__message_deleted(
+            {'channel': 'C1', 'deleted_ts': '2.0'})
+        self.assertEqual(public.zulip.calls, [
+            ('update_message', {'message_id': 7, 'content': u'**hello**'}),
+            ('delete_message', 7),
+        ])
+
+    def test_cold_start_waits_for_channels(self):
+        import threading
+        from slack_mirror.slack_mirror_script import PrivateTranslator
+        from slack_mirror.state import TeamState
+        private = PrivateTranslator('a@b.com')
+        private.slack = Recorder()
+        # rtm.connect with no cache: the socket is open, channels.list is not
+        # done yet.
+        state = TeamState('T-cold')
+        private.slack_set_state(state)
+
+        def refresh():
+            state.set_channel(CHANNELS[0])
+            state.ready.set()
+        timer = threading.Timer(0.05, refresh)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        private.zulip__message({'message': {
+            'id': 7, 'sender_email': 'a@b.com', 'client': 'website',
+            'display_recipient': u'general/slack', 'content': u'hi',
+        }})
+        self.assertEqual(private.slack.sent[0]['channel'], 'C1')
+
+        # Once the state is loaded an unknown name is dropped straight away.
+        private.zulip__message({'message': {
+            'id': 8, 'sender_email': 'a@b.com', 'client': 'website',
+            'display_recipient': u'missing/slack', 'content': u'hi',
+        }})
+        self.assertEqual(len(private.slack.sent), 1)
+
+    def test_zulip_edits_and_deletes(self):
+        public, private = make_translators()
+        private.zulip__message({'message': {
+            'id': 7, 'sender_email': 'a@b.com', 'client': 'website',
+            'display_recipient': u'general/slack', 'content': u'helo',
+        }})
+        name, msg, source_time, source_id, stream = private.slack.calls.pop()
+        self.assertEqual(source_id, 7)
+        private.correlation.add('C1', '1.0', source_id)
+
+        private.zulip__update_message({'message_id': 7, 'subject': u'x'})
+        private.zulip__update_message(
+            {'message_id': 7, 'content': u'**hello**'})
+        private.zulip__delete_message({'message_ids': [7, 8]})
+        self.assertEqual(private.slack.calls, [
+            ('update_message', 'C1', '1.0', u'*hello*'),
+            ('delete_message', 'C1', '1.0'),
+        ])
+
+
+class FileTransferTests(unittest.TestCase):
+
+    class Response(object):
+        def __init__(self, data, length=None):
+            self.data = data
+            self.headers = {}
+            if length is not None:
+                self.headers['Content-Length'] = str(length)
+            self.closed = False
+
+        def raise_for_status(self):
+            pass
+
+        def iter_content(self, chunk_size):
+            for i in range(0, len(self.data), chunk_size):
+                yield self.data[i:i + chunk_size]
+
+        def close(self):
+            self.closed = True
+
+    def test_spool_stops_past_max_size(self):
+        from slack_mirror.files import FileTooLarge, spool
+        response = self.Response(b'x' * 100)
+        spooled, size, digest = spool(response, 100, chunk_size=7)
+        self.assertEqual((spooled.read(), size), (b'x' * 100, 100))
+        self.assertTrue(response.closed)
+        self.assertRaises(
+            FileTooLarge, spool, self.Response(b'x' * 101), 100, 7)
+        self.assertRaises(
+            FileTooLarge, spool, self.Response(b'', length=101), 100)
+
+    def test_multipart_body_is_read_in_blocks(self):
+        import io
+        from slack_mirror.files import MultipartFile
+        body = MultipartFile(
+            io.BytesIO(b'abc' * 1000), 3000, u'r\xe9sum\xe9.txt',
+            [('channels', 'C1')], content_type='text/plain')
+        blocks = []
+        while True:
+            block = body.read(512)
+            if not block:
+                break
+            self.assertTrue(len(block) <= 512)
+            blocks.append(block)
+        data = b''.join(blocks)
+        self.assertEqual(len(data), len(body))
+        boundary = body.content_type.split('boundary=')[1].encode('ascii')
+        self.assertTrue(data.startswith(b'--' + boundary + b'\r\n'))
+        self.assertTrue(data.endswith(b'\r\n--' + boundary + b'--\r\n'))
+        self.assertIn(b'name="channels"\r\n\r\nC1\r\n', data)
+        self.assertIn(u'filename="r\xe9sum\xe9.txt"'.encode('utf-8'), data)
+        self.assertIn(b'\r\n\r\n' + b'abc' * 1000 + b'\r\n--', data)
+
+    def test_files_are_copied_once(self):
+        from slack_mirror.files import FileTooLarge, FileTransfers
+        transfers = FileTransfers(max_size=10)
+        downloads = []
+        uploads = []
+
+        def download(data):
+            downloads.append(data)
+            return self.Response(data)
+
+        def upload(fileobj, size):
+            uploads.append(fileobj.read())
+            return '/uploads/%d' % len(uploads)
+
+        def copy(source, data):
+            return transfers.copy(
+                'slack_to_zulip', 'zulip', source,
+                lambda: download(data), upload)
+
+        self.assertEqual(copy('F1', b'one'), ('/uploads/1', False))
+        # Shared again, in another channel.
+        self.assertEqual(copy('F1', b'one'), ('/uploads/1', True))
+        # Uploaded again, as another file.
+        self.assertEqual(copy('F2', b'one'), ('/uploads/1', True))
+        self.assertEqual(copy('F3', b'two'), ('/uploads/2', False))
+        self.assertEqual(downloads, [b'one', b'one', b'two'])
+        self.assertEqual(uploads, [b'one', b'two'])
+        self.assertRaises(
+            FileTooLarge, transfers.copy, 'slack_to_zulip', 'zulip', 'F4',
+            None, upload, 11)
+
+
+    def test_refused_share_links_to_slack(self):
+        public, private = make_translators()
+        public.files.stop()
+        public.slack__message__file_share({
+            'user': 'U1', 'channel': 'C1', 'ts': '1.0', 'text': u'look',
+            'files': [{'id': 'F1', 'name': 'a.png',
+                       'permalink': 'https://slack/F1'}],
+        })
+        self.assertEqual(
+            [msg['content'] for msg in public.zulip.sent],
+            [u'look\n[a.png](https://slack/F1)'])
+
+    def test_edits_keep_file_links(self):
+        public, private = make_translators()
+        public.files.cache.copies.put(('zulip', 'F1'), '/user_uploads/1/a')
+        public.correlation.add('C1', '1.0', 7)
+        message = {
+            'user': 'U1', 'ts': '1.0', 'text': u'*look*',
+            'files': [{'id': 'F1', 'name': 'a.png'}],
+        }
+        public.slack__message__message_changed({
+            'channel': 'C1', 'message': message,
+            'previous_message': dict(message, text=u'look'),
+        })
+
+        private.zulip.upload_url = lambda path: 'https://zulip' + path
+        private.correlation.add('C1', '2.0', 8)
+        private.zulip__update_message(
+            {'message_id': 8, 'content': u'see [b.txt](/user_uploads/1/b)'})
+        self.assertEqual(public.zulip.calls, [('update_message', {
+            'message_id': 7,
+            'content': u'**look**\n[a.png](/user_uploads/1/a)',
+        })])
+        self.assertEqual(private.slack.calls, [(
+            'update_message', 'C1', '2.0',
+            u'see <https://zulip/user_uploads/1/b|b.txt>',
+        )])
+
+
+class TracingTests(unittest.TestCase):
+
+    def test_stages_are_timed_from_what_they_follow(self):
+        from slack_mirror.tracing import Tracer
+        now = [0.0]
+        tracer = Tracer(percent=100, size=2, clock=lambda: now[0])
+        for direction in ('slack_to_zulip', 'zulip_to_slack', 'slack_to_zulip'):
+            now[0] = 0.0
+            trace = tracer.begin(direction)
+            for stage, at in [('decode', 0.001), ('translate', 0.003),
+                              ('queue', 0.004), ('handle', 0.005),
+                              ('send', 0.104)]:
+                now[0] = at
+                trace.mark(stage)
+        # Only the last two are kept.
+        self.assertEqual(tracer.folded(), [
+            'slack_to_zulip;decode 1000',
+            'slack_to_zulip;handle 2000',
+            'slack_to_zulip;queue 1000',
+            'slack_to_zulip;send 100000',
+            'slack_to_zulip;translate 2000',
+            'zulip_to_slack;decode 1000',
+            'zulip_to_slack;handle 2000',
+            'zulip_to_slack;queue 1000',
+            'zulip_to_slack;send 100000',
+            'zulip_to_slack;translate 2000',
+        ])
+
+    def test_unsampled_events_cost_no_trace(self):
+        from slack_mirror import tracing
+        tracer = tracing.Tracer(percent=0)
+        self.assertEqual(tracer.begin('slack_to_zulip'), None)
+        self.assertEqual(tracing.current(), None)
+        self.assertEqual(list(tracer.traces), [])
+
+    def test_profiler_folds_stacks(self):
+        import threading
+        from slack_mirror.tracing import SamplingProfiler
+        spinning = threading.Event()
+        stop = []
+
+        def spin_in_test():
+            spinning.set()
+            while not stop:
+                pass
+
+        thread = threading.Thread(name='spin:a@b.com', target=spin_in_test)
+        thread.start()
+        spinning.wait()
+        profiler = SamplingProfiler(interval=0.001)
+        try:
+            profiler.sample()
+            profiler.sample()
+        finally:
+            stop.append(True)
+            thread.join()
+        stacks = dict(
+            line.rsplit(' ', 1) for line in profiler.folded()
+            if line.startswith('spin;')
+        )
+        # Mirror threads are named <role>:<email>; only the role is kept.
+        self.assertEqual(sum(int(c) for c in stacks.values()), 2)
+        self.assertTrue(any(
+            ';spin_in_test (' in stack for stack in stacks))
+
+    def test_profiler_samples_until_stopped(self):
+        import time
+        from slack_mirror.tracing import SamplingProfiler
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.start()
+        self.assertTrue(profiler.running)
+        while not profiler.counts:
+            time.sleep(0.001)
+        profiler.stop()
+        self.assertFalse(profiler.running)
+        samples = sum(profiler.counts.values())
+        time.sleep(0.005)
+        self.assertEqual(sum(profiler.counts.values()), samples)
+        # The sampler's own stack is left out.
+        self.assertFalse(any(
+            'run (tracing.py' in line for line in profiler.folded()))
@@ -0,0 +1,150 @@
+""" Which Zulip topic each Slack thread is mirrored to, and back. """
+import itertools
+import logging
+import re
+import threading
+import time
+
+from sqlalchemy.exc import IntegrityError
+import transaction
+
+import slack_mirror
+from slack_mirror.markup import LRUCache
+from slack_mirror.models import ThreadTopic
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_TOPIC = '(no topic)'
+MAX_TOPIC_LENGTH = 60
+
+_SPACE_RE = re.compile(r'\s+')
+
+
+def topic_name(text, number=1):
+    """ A topic for a thread starting with ``text``, with `` (number)``
+    added to tell apart threads starting the same way. """
+    suffix = u' ({})'.format(number) if number > 1 else u''
+    name = _SPACE_RE.sub(u' ', text).strip()
+    limit = MAX_TOPIC_LENGTH - len(suffix)
+    if len(name) > limit:
+        name = name[:limit - 3].rstrip() + u'...'
+    return (name or u'thread') + suffix
+
+
+class ThreadStore(object):
+    """ Maps Slack ``(channel, thread_ts)`` to Zulip ``(stream, topic)``.
+
+    Mappings live in the ``thread_topic`` table, with an ``LRUCache`` of
+    recent ones in front so the message path does not query the database.
+    Without a ``sessionmaker`` they only live in the cache.
+
+    Most Zulip topics never had a Slack thread, and every message to one
+    looks it up, so misses are cached too, for ``miss_ttl`` seconds in case
+    another process maps the topic meanwhile.
+    """
+
+    def __init__(self, sessionmaker=None, size=4096, miss_ttl=30,
+                 clock=time.time):
+        self.sessionmaker = sessionmaker
+        self.miss_ttl = miss_ttl
+        self.clock = clock
+        self.topics = LRUCache(size)
+        self.threads = LRUCache(size)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        sessionmaker = None
+        if settings.get('sqlalchemy.url'):
+            sessionmaker = slack_mirror.get_sessionmaker(settings)
+        return cls(
+            sessionmaker,
+            size=int(settings.get('mirror.thread_cache_size', 4096)),
+        )
+
+    def _query(self, **filters):
+        if self.sessionmaker is None:
+            return None
+        with transaction.manager:
+            row = self.sessionmaker().query(ThreadTopic).filter_by(
+                **filters).first()
+            if row is None:
+                return None
+            return row.channel_id, row.thread_ts, row.stream, row.topic
+
+    def _insert(self, channel_id, thread_ts, stream, topic):
+        if self.sessionmaker is None:
+            return True
+        try:
+            with transaction.manager:
+                self.sessionmaker().add(
+                    ThreadTopic(channel_id, thread_ts, stream, topic))
+        except IntegrityError:
+            return False
+        return True
+
+    def _remember(self, channel_id, thread_ts, stream, topic):
+        self.topics.put((channel_id, thread_ts), (stream, topic))
+        self.threads.put((stream, topic), (channel_id, thread_ts))
+
+    def topic(self, channel_id, thread_ts):
+        """ The topic the thread is mirrored to, or None. """
+        found = self.topics.get((channel_id, thread_ts))
+        if found is None:
+            row = self._query(channel_id=channel_id, thread_ts=thread_ts)
+            if row is None:
+                return None
+            self._remember(*row)
+            found = row[2:]
+        return found[1]
+
+    def cached_topic(self, channel_id, thread_ts):
+        """ The topic if the cache has it, without asking the database. """
+        found = self.topics.get((channel_id, thread_ts))
+        return None if found is None else found[1]
+
+    def thread(self, stream, topic):
+        """ The ``(channel_id, thread_ts)`` mirrored to a topic, or None. """
+        key = (stream, topic)
+        found = self.threads.get(key)
+        if found is not None:
+            if found[0] is not None:
+                return found
+            if found[1] > self.clock():
+                return None
+        row = self._query(stream=stream, topic=topic)
+        if row is None:
+            self.threads.put(key, (None, self.clock() + self.miss_ttl))
+            return None
+        self._remember(*row)
+        return row[:2]
+
+    def assign(self, channel_id, thread_ts, stream, text):
+        """ The thread's topic, naming a new one after ``text``, its first
+        message, if it has none yet. """
+        with self.lock:
+            for number in itertools.count(1):
+                topic = self.topic(channel_id, thread_ts)
+                if topic is not None:
+                    return topic
+                topic = topic_name(text, number)
+                if self.thread(stream, topic) is not None:
+                    continue
+                # Another process can take the name first; the unique
+                # index turns that into a failed insert.
+                if self._insert(channel_id, thread_ts, stream, topic):
+                    self._remember(channel_id, thread_ts, stream, topic)
+                    return topic
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def get_thread_store(settings):
+    """ The store shared by every mirror in the process. """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = ThreadStore.from_settings(settings)
+        return _shared
@@ -0,0 +1,307 @@
+""" Where the time goes between a message arriving and its copy being sent.
+
+A sample of the events read from either side gets a ``Trace``, stamped as
+the event is decoded, handled, queued for sending and sent. Traces are kept
+in a ring buffer, and a ``SamplingProfiler`` can be switched on at runtime.
+Both are written out as folded stacks, which ``flamegraph.pl`` and
+speedscope read::
+
+    kill -USR1 <pid>    # traces to <trace.dir>/<pid>.traces.folded
+    kill -USR2 <pid>    # start the profiler; again to stop it and write
+                        # <trace.dir>/<pid>.profile.folded
+
+The web app's ``/admin/{name}/{kind}`` routes do the same through
+supervisord.
+"""
+import collections
+import logging
+import os
+import random
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# What each dump is asked for with, as supervisord names signals.
+SIGNALS = {'traces': 'USR1', 'profile': 'USR2'}
+
+# Each stage is timed from the end of the one it follows, or, when that did
+# not happen, from the one before that.
+FOLLOWS = {
+    'decode': 'receive',
+    'translate': 'decode',  # the handler, up to queueing a send
+    'handle': 'translate',  # the rest of the handler
+    'queue': 'translate',  # waiting for the send worker and rate limits
+    'send': 'queue',  # the API call
+}
+
+_local = threading.local()
+
+
+class Trace(object):
+    __slots__ = ('direction', 'marks', 'clock')
+
+    def __init__(self, direction, now=None, clock=time.time):
+        self.direction = direction
+        self.clock = clock
+        self.marks = [('receive', clock() if now is None else now)]
+
+    def mark(self, stage):
+        # list.append is atomic, and sends stamp from other threads.
+        self.marks.append((stage, self.clock()))
+
+    def spans(self):
+        """ ``(stage, seconds)`` for every stage after the first. """
+        spans = []
+        marks = list(self.marks)
+        for i, (stage, end) in enumerate(marks[1:], 1):
+            previous = FOLLOWS.get(stage)
+            while previous is not None:
+                # The latest earlier stamp, for events sent more than once.
+                start = None
+                for other, at in marks[:i]:
+                    if other == previous:
+                        start = at
+                if start is not None:
+                    spans.append((stage, end - start))
+                    break
+                previous = FOLLOWS.get(previous)
+        return spans
+
+
+class Tracer(object):
+    """ Traces ``percent`` of events, keeping the last ``size``. """
+
+    def __init__(self, percent=1.0, size=1000, clock=time.time):
+        self.rate = percent / 100.0
+        self.clock = clock
+        self.traces = collections.deque(maxlen=size)
+
+    def begin(self, direction, now=None):
+        if not self.rate or random.random() >= self.rate:
+            _local.trace = None
+            return None
+        trace = _local.trace = Trace(direction, now, self.clock)
+        self.traces.append(trace)
+        return trace
+
+    def folded(self):
+        """ Microseconds spent in each stage, summed over the kept traces,
+        as ``direction;stage microseconds`` lines. """
+        totals = collections.defaultdict(float)
+        for trace in list(self.traces):
+            for stage, seconds in trace.spans():
+                totals[(trace.direction, stage)] += seconds
+        return [
+            '{};{} {}'.format(direction, stage, int(round(seconds * 1e6)))
+            for (direction, stage), seconds in sorted(totals.items())
+        ]
+
+
+TRACER = Tracer(percent=0)
+
+
+def begin(direction, now=None):
+    """ Maybe starts tracing an event read at ``now``; the trace, or None,
+    is then ``current()`` on this thread until ``end``. """
+    return TRACER.begin(direction, now)
+
+
+def current():
+    return getattr(_local, 'trace', None)
+
+
+def end(trace):
+    _local.trace = None
+    if trace is not None:
+        trace.mark('handle')
+
+
+def _frame_name(code):
+    return '{} ({}:{})'.format(
+        code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def _gevent_patched():
+    monkey = sys.modules.get('gevent.monkey')
+    return monkey is not None and monkey.is_module_patched('threading')
+
+
+def _native(module, name):
+    """ ``module.name`` as it was before gevent patched it, if it did. """
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None:
+        return monkey.get_original(module, name)
+    return getattr(__import__(module), name)
+
+
+_THREAD_MODULE = 'thread' if sys.version_info[0] == 2 else '_thread'
+
+
+class SamplingProfiler(object):
+    """ Counts the stacks of every other thread, ``interval`` seconds apart.
+
+    Stacks are kept as tuples of code objects and only named when written,
+    so a sample costs a walk of each stack. Threads are told apart by the
+    part of their name before any ``:``, so each mirror's ``slack:<email>``
+    thread adds to the same ``slack`` stacks.
+
+    The sampler runs on an OS thread even under gevent's monkey patching,
+    since greenlets share one thread and only from another one can the
+    running greenlet's stack be seen. Their stacks are counted as
+    ``greenlet``, as greenlets cannot be told apart from outside.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.stopping = False
+        self.done = None
+
+    @property
+    def running(self):
+        return self.done is not None
+
+    def sample(self, own=None):
+        names = dict(
+            (thread.ident, thread.name.split(':', 1)[0])
+            for thread in threading.enumerate()
+        )
+        unnamed = 'greenlet' if _gevent_patched() else 'thread'
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.append(names.get(ident, unnamed))
+            self.counts[tuple(stack)] += 1
+
+    def run(self):
+        sleep = _native('time', 'sleep')
+        own = _native(_THREAD_MODULE, 'get_ident')()
+        try:
+            while not self.stopping:
+                sleep(self.interval)
+                self.sample(own)
+        except Exception:
+            LOGGER.exception('The profiler failed')
+        finally:
+            self.done.release()
+
+    def start(self):
+        self.counts.clear()
+        self.stopping = False
+        self.done = _native(_THREAD_MODULE, 'allocate_lock')()
+        self.done.acquire()
+        _native(_THREAD_MODULE, 'start_new_thread')(self.run, ())
+
+    def stop(self):
+        if self.done is None:
+            return
+        self.stopping = True
+        # At most one interval and a sample away.
+        self.done.acquire()
+        self.done = None
+
+    def folded(self):
+        """ ``thread;outer;...;inner samples`` lines. """
+        lines = []
+        for stack, count in self.counts.items():
+            frames = [stack[-1]] + [_frame_name(c) for c in stack[-2::-1]]
+            lines.append('{} {}'.format(';'.join(frames), count))
+        return sorted(lines)
+
+
+def dump_path(directory, pid, kind):
+    return os.path.join(directory, '{}.{}.folded'.format(pid, kind))
+
+
+def write_dump(directory, kind, lines):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = dump_path(directory, os.getpid(), kind)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(''.join(line + '\n' for line in lines))
+    os.rename(tmp_path, path)
+    LOGGER.info('Wrote %d %s lines to %r', len(lines), kind, path)
+    return path
+
+
+class Controls(object):
+    """ What the signals do: dump the traces, and start or stop the
+    profiler, which stops itself after ``max_seconds``. """
+
+    def __init__(self, directory, tracer=TRACER, interval=0.005,
+                 max_seconds=60):
+        self.directory = directory
+        self.tracer = tracer
+        self.profiler = SamplingProfiler(interval)
+        self.max_seconds = max_seconds
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def dump_traces(self, *args):
+        try:
+            write_dump(self.directory, 'traces', self.tracer.folded())
+        except (IOError, OSError):
+            LOGGER.exception('Failed to write traces')
+
+    def toggle_profiler(self, *args):
+        # Signal handlers run on the main thread, which must not wait for
+        # the profiler thread to stop.
+        thread = threading.Thread(name='profiler_toggle', target=self._toggle)
+        thread.daemon = True
+        thread.start()
+
+    def _toggle(self):
+        with self.lock:
+            if not self.profiler.running:
+                LOGGER.info('Starting the profiler')
+                self.profiler.start()
+                self.timer = threading.Timer(self.max_seconds, self._expire)
+                self.timer.daemon = True
+                self.timer.start()
+                return
+            self._stop()
+
+    def _expire(self):
+        with self.lock:
+            if self.profiler.running:
+                LOGGER.info('Profiled for %ss, stopping', self.max_seconds)
+                self._stop()
+
+    def _stop(self):
+        self.timer.cancel()
+        self.profiler.stop()
+        try:
+            write_dump(self.directory, 'profile', self.profiler.folded())
+        except (IOError, OSError):
+            LOGGER.exception('Failed to write profile')
+
+
+def configure(settings):
+    """ Sets up ``TRACER`` from ``trace.*`` settings and, with a
+    ``trace.dir``, the signals; call it from the main thread. """
+    global TRACER
+    TRACER = Tracer(
+        percent=float(settings.get('trace.sample_percent', 1)),
+        size=int(settings.get('trace.buffer_size', 1000)),
+    )
+    directory = settings.get('trace.dir')
+    if not directory:
+        return None
+    controls = Controls(
+        directory,
+        TRACER,
+        interval=float(settings.get('trace.profile_interval', 0.005)),
+        max_seconds=float(settings.get('trace.profile_max_seconds', 60)),
+    )
+    signal.signal(signal.SIGUSR1, controls.dump_traces)
+    signal.signal(signal.SIGUSR2, controls.toggle_profiler)
+    return controls
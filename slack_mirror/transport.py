@@ -0,0 +1,138 @@
+import logging
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from slack_mirror.metrics import Counter, Gauge, Histogram
+
+LOGGER = logging.getLogger(__name__)
+
+
+SEND_QUEUE_DEPTH = Gauge(
+    'slack_mirror_send_queue_depth',
+    'Outbound calls waiting to be sent.',
+    ['queue'],
+)
+SEND_QUEUE_LATENCY = Histogram(
+    'slack_mirror_send_queue_latency_seconds',
+    'Time outbound calls spent waiting in the send queue.',
+    ['queue'],
+)
+SEND_QUEUE_DROPPED = Counter(
+    'slack_mirror_send_queue_dropped_total',
+    'Outbound calls dropped because the send queue was full.',
+    ['queue'],
+)
+
+OVERFLOW_POLICIES = ('drop_newest', 'drop_oldest', 'block')
+
+
+class SendQueue(object):
+    """ Runs outbound API calls on their own worker.
+
+    Receivers hand calls to ``put`` and go straight back to reading their
+    socket, so a slow POST to one side never stalls the other side's events.
+    The queue holds at most ``maxsize`` calls; once full, ``overflow``
+    decides whether the new call is dropped (``drop_newest``), the oldest
+    waiting call is dropped (``drop_oldest``), or the caller waits
+    (``block``, which lets a slow remote stall the reader again).
+    ``on_drop(func, args)`` is called for each call dropped that way.
+    """
+
+    _STOP = object()
+
+    def __init__(self, name, maxsize=1000, overflow='drop_newest',
+                 on_drop=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %r' % overflow)
+        self.name = name
+        self.overflow = overflow
+        self.on_drop = on_drop
+        self.queue = queue.Queue(maxsize)
+        self.thread = None
+        self.stopped = False
+        self.depth = SEND_QUEUE_DEPTH.labels(name)
+        self.latency = SEND_QUEUE_LATENCY.labels(name)
+        self.dropped = SEND_QUEUE_DROPPED.labels(name)
+
+    @classmethod
+    def from_settings(cls, settings, name):
+        return cls(
+            name,
+            maxsize=int(settings.get('mirror.send_queue_size', 1000)),
+            overflow=settings.get('mirror.send_queue_overflow', 'drop_newest'),
+        )
+
+    def put(self, func, *args):
+        item = (time.time(), func, args)
+        if self.overflow == 'block':
+            self.queue.put(item)
+            self.depth.inc()
+            return
+
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if self.overflow == 'drop_oldest':
+                try:
+                    dropped = self.queue.get_nowait()
+                except queue.Empty:
+                    dropped = item
+                else:
+                    self.depth.dec()
+                    self.queue.put_nowait(item)
+                    self.depth.inc()
+            else:
+                dropped = item
+            self.dropped.inc()
+            LOGGER.warning(
+                '%s: send queue full, dropping %r', self.name, dropped[1])
+            if self.on_drop is not None:
+                self.on_drop(dropped[1], dropped[2])
+        else:
+            self.depth.inc()
+
+    def start(self, thread_name=None):
+        self.thread = threading.Thread(
+            name=thread_name or self.name,
+            target=self.run,
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        try:
+            self.queue.put_nowait((None, self._STOP, None))
+        except queue.Full:
+            pass
+
+    def run(self):
+        while True:
+            queued_at, func, args = self.queue.get()
+            if func is self._STOP:
+                break
+            self.depth.dec()
+            if self.stopped:
+                # stop() could not queue _STOP if we were full.
+                if self.queue.empty():
+                    break
+                continue
+            self.latency.observe(time.time() - queued_at)
+            try:
+                func(*args)
+            except Exception:
+                LOGGER.exception('%s: failed to call %r', self.name, func)
+
+        # Anything still queued belongs to a mirror that is going away.
+        while True:
+            try:
+                queued_at, func, args = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if func is not self._STOP:
+                self.depth.dec()
@@ -1,14 +1,16 @@
 import logging
+import os
 from datetime import datetime
 
 from pyramid.i18n import TranslationStringFactory
 from pyramid.security import remember, forget, authenticated_userid
 from pyramid.view import view_config, forbidden_view_config
-from pyramid.httpexceptions import HTTPFound
+from pyramid.httpexceptions import HTTPAccepted, HTTPFound, HTTPNotFound
+from pyramid.response import Response
 from sqlalchemy.orm.exc import NoResultFound
 
 from slack_mirror.models import User, get_service, add_bot_config
-from slack_mirror import api
+from slack_mirror import api, metrics, tracing
 
 
 LOGGER = logging.getLogger(__name__)
@@ -97,8 +99,10 @@ def oauth2_callback(request):
     except NoResultFound:
         user = User(user_id, email, access_token)
         request.db.add(user)
-        add_bot_config(request.registry.settings, user)
-        api.reload_config(request.registry.settings)
+        # The daemon starts a mirror once the user has a zulip key.
+        if not api.daemon_mode(request.registry.settings):
+            add_bot_config(request.registry.settings, user)
+            api.request_reload(request.registry.settings)
 
     user.last_log = datetime.utcnow()
     user.email = email
@@ -121,11 +125,34 @@ def index(request):
     if user.zulip_key is None:
         return HTTPFound(location=request.route_url('zulip_key'))
 
+    # Logs are fetched separately from bot_log, so this never waits on
+    # supervisord once the state cache is warm.
     return {
         'state': api.get_bot_state(request.registry.settings, user)
     }
 
 
+@view_config(
+    route_name='bot_log',
+    request_method='GET',
+    permission='loggedin',
+    renderer='json',
+)
+def bot_log(request):
+    stream = request.matchdict['stream']
+    if stream not in ('stdout', 'stderr'):
+        raise HTTPNotFound()
+    user_id = authenticated_userid(request)
+    user = request.db.query(User).filter(User.id == user_id).one()
+    offset = request.params.get('offset')
+    return api.get_bot_log(
+        request.registry.settings,
+        user,
+        stream,
+        int(offset) if offset else None,
+    )
+
+
 @view_config(
     route_name='zulip_key',
     request_method='GET',
@@ -149,6 +176,8 @@ def set_zulip_key(request):
     user_id = authenticated_userid(request)
     user = request.db.query(User).filter(User.id == user_id).one()
     user.zulip_key = request.POST['zulip_key']
+    if api.daemon_mode(request.registry.settings):
+        api.reload_daemon(request.registry.settings)
 
     return HTTPFound(location=request.route_url('home'))
 
@@ -179,3 +208,57 @@ def stop_mirror(request):
     api.stop_bot(request.registry.settings, user)
 
     return HTTPFound(location=request.route_url('home'))
+
+
+@view_config(route_name='metrics', request_method='GET')
+def metrics_view(request):
+    settings = request.registry.settings
+    snapshots = [metrics.REGISTRY.collect()]
+    directory = settings.get('mirror.metrics_dir')
+    if directory and os.path.isdir(directory):
+        # Snapshots that missed a few writes are from dead processes.
+        max_age = 3 * float(settings.get('mirror.metrics_interval', 15))
+        snapshots.extend(metrics.read_snapshots(directory, max_age))
+    return Response(
+        metrics.render(metrics.merge(snapshots)),
+        content_type='text/plain',
+        charset='utf-8',
+    )
+
+
+def _dump_kind(request):
+    kind = request.matchdict['kind']
+    if kind not in tracing.SIGNALS:
+        raise HTTPNotFound()
+    return kind
+
+
+@view_config(route_name='admin_dump', request_method='POST',
+             permission='admin')
+def request_dump(request):
+    """ Asks a process for its traces, or to start or stop profiling. """
+    kind = _dump_kind(request)
+    api.signal_bot(
+        request.registry.settings,
+        request.matchdict['name'],
+        tracing.SIGNALS[kind],
+    )
+    return HTTPAccepted()
+
+
+@view_config(route_name='admin_dump', request_method='GET',
+             permission='admin')
+def read_dump(request):
+    """ The last traces or profile a process wrote, as folded stacks. """
+    kind = _dump_kind(request)
+    settings = request.registry.settings
+    directory = settings.get('trace.dir')
+    pid = api.get_pid(settings, request.matchdict['name'])
+    if not directory or pid is None:
+        raise HTTPNotFound()
+    try:
+        with open(tracing.dump_path(directory, pid, kind)) as f:
+            body = f.read()
+    except IOError:
+        raise HTTPNotFound()
+    return Response(body, content_type='text/plain', charset='utf-8')